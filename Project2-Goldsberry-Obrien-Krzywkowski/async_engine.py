@@ -0,0 +1,137 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from connection import StreamConnection, RECEIVED_BYTES
+from protocol import FrameBuffer
+from logger import logger
+
+try:
+    # resource is only available on Unix, it is used to raise the open file limit
+    import resource
+except ImportError:
+    resource = None
+
+
+def raise_open_file_limit():
+    """
+    Raise the soft limit on open file descriptors up to the hard limit.
+    Every idle client holds one descriptor, so the default soft limit (often 1024)
+    would otherwise cap the number of connections long before memory does.
+    """
+    if resource is None:
+        return
+
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        logger.warning('Could not raise open file limit: %s', e)
+
+
+class AsyncioEngine:
+    """
+    Event loop engine for the bulletin board server.
+
+    Instead of a thread (and its stack) per connection, every client is a small
+    coroutine waiting on its stream, so one process can hold tens of thousands of
+    mostly idle connections. Requests are handed to the same handlers used by the
+    threaded engine through a StreamConnection. Handlers that may block (e.g.
+    a post waiting for its batch to reach the disk, or for the broker of a
+    cluster) run on a small thread pool instead, so one slow request never
+    stalls every other client.
+    """
+
+    # Threads running blocking handlers, posts waiting on the same group commit or broker round trip share the wait
+    BLOCKING_THREADS = 32
+
+    def __init__(self, server):
+        """AsyncioEngine constructor"""
+        self.server = server
+        self.executor = ThreadPoolExecutor(self.BLOCKING_THREADS, thread_name_prefix='blocking')
+
+    def serve(self):
+        """Run the event loop until the server is stopped"""
+        raise_open_file_limit()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.executor.shutdown()
+
+    async def _serve(self):
+        """Accept connections on the server's (already bound) listening socket"""
+
+        # The listening socket was bound by the server, hand it to asyncio in non-blocking mode
+        self.server.socket.setblocking(False)
+        listener = await asyncio.start_server(self.handle_connection, sock=self.server.socket)
+
+        async with listener:
+            # Poll the running flag the same way the threaded accept loop does
+            while self.server.running:
+                await asyncio.sleep(1)
+
+    async def handle_connection(self, reader, writer):
+        """Read and dispatch requests for a single client"""
+
+        # Wrap the stream so the server handlers can treat it like a socket
+        loop = asyncio.get_running_loop()
+        connection = StreamConnection(writer, loop, **self.server.connection_options)
+        logger.debug('New client connection from %s', connection.addr)
+        self.server.add_client(connection)
+
+        # Per-connection buffer that splits the byte stream into individual requests
+        buffer = FrameBuffer()
+        open_connection = True
+
+        try:
+            while open_connection and self.server.running:
+                # Receive whatever the client sent
+                data = await reader.read(FrameBuffer.CHUNK_SIZE)
+                if not data:
+                    # The client closed its side of the connection
+                    break
+
+                # Handle every complete request that arrived, in order, coalescing their responses
+                RECEIVED_BYTES.inc(len(data))
+                buffer.feed(data)
+                connection.begin_batch()
+                for message in buffer.frames():
+                    # Dispatch the request, stop reading if the handler ended the connection
+                    if not self.server.handle_request(connection, connection.addr, message):
+                        open_connection = False
+                        break
+
+                    # Run a blocking handler on the pool, the client's next request waits for it
+                    if connection.deferred:
+                        call, connection.deferred = connection.deferred, None
+                        await loop.run_in_executor(self.executor, call)
+                        if connection.closing or connection.closed:
+                            open_connection = False
+                            break
+
+                    # Send the rest of a streamed response as fast as the client reads it, before its next request
+                    while connection.stream:
+                        connection.flush()
+                        await asyncio.sleep(0)
+                        await writer.drain()
+                        self.server.advance_stream(connection)
+
+                    # The client may have switched to the binary encoding on connect
+                    buffer.length_prefixed = connection.codec.length_prefixed
+
+                # Write all of the responses to the batch at once, then stop reading from a
+                # client that is not reading its responses until the transport has caught up
+                connection.flush()
+                await asyncio.sleep(0)
+                await writer.drain()
+
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug('Connection to %s lost: %s', connection.addr, e)
+
+        except Exception as e:
+            # Notify if any error occurs within this function
+            logger.error('Error when handling request from %s: %s', connection.addr, e)
+
+        finally:
+            # Drop whatever state the client left behind and close the stream
+            self.server.remove_client(connection, connection.username)
+            connection.close()
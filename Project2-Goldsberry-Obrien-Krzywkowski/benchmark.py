@@ -0,0 +1,439 @@
+import os
+import sys
+import json
+import math
+import time
+import signal
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from protocol import JSON, FrameBuffer, negotiate
+from async_engine import raise_open_file_limit
+from server import BulletinBoardServer
+
+# Operations a simulated client can be told to perform and the default share of each
+OPERATIONS = ('post', 'message', 'join', 'groupjoin', 'exit')
+DEFAULT_MIX = 'post=60,message=25,join=5,groupjoin=5,exit=5'
+
+# Posts carry the time they were sent, so receivers can measure how long the fan-out took
+STAMP_PREFIX = '@@sent:'
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list (None if it is empty)"""
+    if not values:
+        return None
+    rank = min(len(values), max(1, math.ceil(fraction * len(values))))
+    return values[rank - 1]
+
+
+def summarize(values):
+    """Count, mean and percentiles of a list of durations in seconds, reported in milliseconds"""
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000,
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'p999_ms': percentile(values, 0.999) * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+
+def parse_mix(text):
+    """Parse an operation mix like 'post=60,message=40' into a dictionary of weights"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'Unknown operation {name!r}, expected one of {OPERATIONS}')
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Invalid weight for {name}: {weight!r}')
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError('At least one operation needs a positive weight')
+    return mix
+
+
+def resident_memory(pid):
+    """Resident set size of a process in bytes, or None if it can not be read (only Linux is supported)"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    """Commit the benchmarked code was checked out at, so results can be compared across commits"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Results:
+    """Measurements collected by every simulated client during the measured window."""
+
+    def __init__(self):
+        """Results constructor"""
+        self.recording = False
+        self.latencies = {operation: [] for operation in ('connect', *OPERATIONS)}
+        self.failures = {operation: 0 for operation in ('connect', *OPERATIONS)}
+        self.fanout_delays = []
+        self.notifications = 0
+        self.rss_samples = []
+
+    def record(self, operation, latency, ok=True):
+        """Record the latency of a completed operation"""
+        if not self.recording:
+            return
+        self.latencies[operation].append(latency)
+        if not ok:
+            self.failures[operation] += 1
+
+
+class SimulatedClient:
+    """
+    A headless client that speaks the same protocol as client.py.
+    Requests are tagged with IDs and their responses matched up by a reader task,
+    notifications of posts are timed to measure the fan-out delay.
+    """
+
+    def __init__(self, number, options, results):
+        """SimulatedClient constructor"""
+        self.username = f'bench{number}'
+        self.options = options
+        self.results = results
+        self.random = random.Random(options.seed + number)
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.buffer = None
+        self.codec = JSON
+
+        # Requests sent but not yet answered, keyed by request ID
+        self.request_count = 0
+        self.pending = {}
+
+        # Highest message ID seen on the public board, used to pick messages to fetch
+        self.newest_id = 0
+
+    async def request(self, command, group=None, data=None, codec=None):
+        """Send a request and wait for its response, returning (status, data, latency)"""
+        self.request_count += 1
+        request_id = self.request_count
+        response = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = response
+
+        started = time.perf_counter()
+        self.writer.write((codec or self.codec).encode_request(command, self.username, group, data, request_id=request_id))
+        message = await response
+        latency = time.perf_counter() - started
+
+        return message['header'].get('status'), message['body'].get('data'), latency
+
+    async def read_loop(self):
+        """Read frames from the server, resolving responses and timing post notifications"""
+        try:
+            while True:
+                data = await self.reader.read(FrameBuffer.CHUNK_SIZE)
+                if not data:
+                    break
+                self.buffer.feed(data)
+                for frame in self.buffer.frames():
+                    self.handle_message(self.codec.decode(frame))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            # Fail whatever is still waiting so the client does not hang on a dropped connection
+            for response in self.pending.values():
+                if not response.done():
+                    response.set_exception(ConnectionError('Connection closed'))
+            self.pending.clear()
+
+    def handle_message(self, message):
+        """Handle one decoded message from the server"""
+        header = message['header']
+        data = message['body'].get('data')
+
+        if header.get('status'):
+            # Switch to the negotiated encoding straight after the connect response
+            if header.get('command') == 'connect' and isinstance(data, dict):
+                self.codec = negotiate(data.get('encoding'), data.get('compression'))
+                self.buffer.length_prefixed = self.codec.length_prefixed
+            response = self.pending.pop(header.get('request_id'), None)
+            if response is not None and not response.done():
+                response.set_result(message)
+            return
+
+        # Notification of a post, the body carries the time it was sent
+        if isinstance(data, str) and STAMP_PREFIX in data:
+            self.results.notifications += 1
+            sent = data[data.index(STAMP_PREFIX) + len(STAMP_PREFIX):].split('@', 1)[0]
+            if self.results.recording:
+                self.results.fanout_delays.append(time.perf_counter() - float(sent))
+            if data.startswith('public board; Message ID: '):
+                self.newest_id = max(self.newest_id, int(data[len('public board; Message ID: '):].split(',', 1)[0]))
+
+    async def open(self):
+        """Connect, negotiate the encoding and join the public board"""
+        self.reader, self.writer = await asyncio.open_connection(self.options.host, self.options.port)
+        self.buffer = FrameBuffer()
+        self.codec = JSON
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+        connect_options = {'encoding': self.options.encoding, 'compression': self.options.compression}
+        status, _, latency = await self.request('connect', data=connect_options, codec=JSON)
+        self.results.record('connect', latency, status == 'OK')
+        await self.request('join', data={'last': 0})
+
+    async def close(self):
+        """Send exit and wait for the server to close the connection"""
+        try:
+            status, _, latency = await asyncio.wait_for(self.request('exit'), timeout=5)
+            self.results.record('exit', latency, status == 'OK')
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        self.writer.close()
+        await asyncio.gather(self.reader_task, return_exceptions=True)
+
+    async def run(self, mix, deadline):
+        """Perform randomly chosen operations from the mix until the deadline"""
+        operations, weights = list(mix), list(mix.values())
+        filler = 'x' * self.options.post_size
+
+        while time.perf_counter() < deadline:
+            operation = self.random.choices(operations, weights)[0]
+
+            if operation == 'post':
+                data = f'bench post\n{STAMP_PREFIX}{time.perf_counter()!r}@ {filler}'
+                status, _, latency = await self.request('post', data=data)
+
+            elif operation == 'message':
+                status, _, latency = await self.request('message', data=str(self.random.randint(1, max(self.newest_id, 1))))
+
+            elif operation == 'join':
+                # Leave first so the join is not refused, only the join itself is timed
+                await self.request('leave')
+                status, _, latency = await self.request('join', data={'last': self.options.history})
+
+            elif operation == 'groupjoin':
+                group = self.random.choice(BulletinBoardServer.GROUPS)
+                status, _, latency = await self.request('groupjoin', group=group, data={'last': self.options.history})
+                await self.request('groupleave', group=group)
+
+            else:
+                # Disconnect and connect again, the exit is timed and the new connect is recorded by open()
+                await self.close()
+                await self.open()
+                continue
+
+            self.results.record(operation, latency, status == 'OK')
+            if self.options.think:
+                await asyncio.sleep(self.options.think)
+
+
+async def sample_memory(pid, results, interval=0.5):
+    """Sample the server's resident memory until cancelled"""
+    while True:
+        rss = resident_memory(pid)
+        if rss is not None:
+            results.rss_samples.append(rss)
+        await asyncio.sleep(interval)
+
+
+async def benchmark(options, server_pid):
+    """Connect every simulated client, run the mix for the configured duration and return the results"""
+    results = Results()
+    clients = [SimulatedClient(number, options, results) for number in range(options.clients)]
+
+    # Ramp up, connecting a batch of clients at a time so the listen backlog is not overrun
+    for start in range(0, len(clients), 100):
+        await asyncio.gather(*(client.open() for client in clients[start:start + 100]))
+
+    sampler = asyncio.create_task(sample_memory(server_pid, results)) if server_pid else None
+    rss_before = resident_memory(server_pid) if server_pid else None
+
+    # Only the window in which every client is running the mix is measured
+    results.recording = True
+    started = time.perf_counter()
+    await asyncio.gather(*(client.run(options.mix, started + options.duration) for client in clients))
+    elapsed = time.perf_counter() - started
+    results.recording = False
+
+    rss_after = resident_memory(server_pid) if server_pid else None
+    if sampler:
+        sampler.cancel()
+    await asyncio.gather(*(client.close() for client in clients))
+
+    operations = {operation: {**summarize(latencies), 'failures': results.failures[operation]}
+                  for operation, latencies in results.latencies.items() if latencies}
+    completed = sum(len(latencies) for latencies in results.latencies.values())
+
+    return {
+        'completed_operations': completed,
+        'duration_seconds': elapsed,
+        'throughput_ops_per_second': completed / elapsed if elapsed else 0,
+        'operations': operations,
+        'fanout_delay': summarize(results.fanout_delays),
+        'notifications_received': results.notifications,
+        'server_rss_bytes': {
+            'before': rss_before,
+            'after': rss_after,
+            'peak': max(results.rss_samples, default=rss_after),
+        },
+    }
+
+
+def wait_for_server(host, port, timeout=10):
+    """Block until the server accepts connections"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start listening on {host}:{port}')
+
+
+def start_server(options, data_dir):
+    """Start a local server in its own process (so its memory can be measured on its own)"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+               '--host', options.host, '--port', str(options.port), '--engine', options.engine,
+               '--slow-consumer-policy', options.slow_consumer_policy, '--workers', str(options.workers)]
+    command += ['--in-memory'] if options.in_memory else ['--data-dir', data_dir]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL if not options.server_output else None)
+    try:
+        wait_for_server(options.host, options.port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def stop_server(process):
+    """Stop the server the same way Ctrl+C would, killing it if it does not exit"""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def compare(baseline, results):
+    """Print how the headline numbers changed relative to an earlier result file"""
+    def change(old, new):
+        if not old or new is None:
+            return 'n/a'
+        return f'{(new - old) / old * 100:+.1f}%'
+
+    print(f"\nCompared to {baseline.get('commit') or 'baseline'} ({baseline.get('started_at')}):")
+    old, new = baseline['results'], results['results']
+    print(f"  throughput        {change(old['throughput_ops_per_second'], new['throughput_ops_per_second'])}")
+    for operation, stats in new['operations'].items():
+        previous = old['operations'].get(operation)
+        if previous and stats.get('count'):
+            print(f"  {operation:<17} p50 {change(previous.get('p50_ms'), stats['p50_ms'])}, "
+                  f"p99 {change(previous.get('p99_ms'), stats['p99_ms'])}")
+    print(f"  fan-out p99       {change(old['fanout_delay'].get('p99_ms'), new['fanout_delay'].get('p99_ms'))}")
+    print(f"  server peak RSS   {change(old['server_rss_bytes'].get('peak'), new['server_rss_bytes'].get('peak'))}")
+
+
+def report(results):
+    """Print a human readable summary of a run"""
+    run = results['results']
+    print(f"\n{run['completed_operations']} operations in {run['duration_seconds']:.1f} s "
+          f"({run['throughput_ops_per_second']:.0f} ops/s) with {results['config']['clients']} clients")
+
+    print(f"{'operation':<12}{'count':>9}{'failed':>8}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for operation, stats in run['operations'].items():
+        print(f"{operation:<12}{stats['count']:>9}{stats['failures']:>8}{stats['p50_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['p999_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+
+    fanout = run['fanout_delay']
+    if fanout['count']:
+        print(f"fan-out delay: {fanout['count']} deliveries, p50 {fanout['p50_ms']:.2f} ms, "
+              f"p99 {fanout['p99_ms']:.2f} ms, p999 {fanout['p999_ms']:.2f} ms")
+
+    rss = run['server_rss_bytes']
+    if rss['peak']:
+        print(f"server RSS: {rss['before'] / 2**20:.1f} MiB before, {rss['peak'] / 2**20:.1f} MiB peak, "
+              f"{rss['after'] / 2**20:.1f} MiB after")
+
+
+def main():
+    """Parse the command line, run the benchmark and write the results"""
+    parser = argparse.ArgumentParser(description='Load generator and benchmark for the bulletin board server')
+    parser.add_argument('--clients', type=int, default=50, help='number of simulated clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run the mix for once every client is connected')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'weights of the operations each client performs (default {DEFAULT_MIX})')
+    parser.add_argument('--post-size', type=int, default=200, help='bytes of filler in every post')
+    parser.add_argument('--history', type=int, default=2, help='messages asked for by join and groupjoin')
+    parser.add_argument('--think', type=float, default=0, help='seconds a client waits between operations')
+    parser.add_argument('--encoding', default='binary', help='encoding the clients ask for (binary or json)')
+    parser.add_argument('--compression', default=None, help='compression the clients ask for (e.g. zlib)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the operation choices')
+
+    parser.add_argument('--host', default='127.0.0.1', help='address of the server')
+    parser.add_argument('--port', type=int, default=6790, help='port of the server')
+    parser.add_argument('--external', action='store_true',
+                        help='benchmark a server that is already running instead of starting one (no RSS is reported)')
+    parser.add_argument('--engine', choices=BulletinBoardServer.ENGINES, default='threaded', help='engine of the started server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes of the started server (RSS is then only that of the broker process)')
+    parser.add_argument('--in-memory', action='store_true', help='start the server without a message log')
+    parser.add_argument('--slow-consumer-policy', default='disconnect', help='slow consumer policy of the started server')
+    parser.add_argument('--server-output', action='store_true', help="show the started server's output")
+
+    parser.add_argument('--output', help='file to write the results to (default benchmark_results/<time>.json)')
+    parser.add_argument('--compare', help='earlier result file to compare this run against')
+    options = parser.parse_args()
+
+    raise_open_file_limit()
+    started_at = datetime.now().isoformat(timespec='seconds')
+
+    with tempfile.TemporaryDirectory(prefix='board_bench_') as data_dir:
+        process = None if options.external else start_server(options, data_dir)
+        try:
+            run = asyncio.run(benchmark(options, process.pid if process else None))
+        finally:
+            if process:
+                stop_server(process)
+
+    config = {key: value for key, value in vars(options).items() if key not in ('output', 'compare', 'server_output')}
+    results = {'started_at': started_at, 'commit': git_commit(), 'python': sys.version.split()[0],
+               'config': config, 'results': run}
+    report(results)
+
+    # Write the machine readable results
+    output = options.output or os.path.join('benchmark_results', f"{started_at.replace(':', '-')}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'\nResults written to {output}')
+
+    if options.compare:
+        with open(options.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == '__main__':
+    main()
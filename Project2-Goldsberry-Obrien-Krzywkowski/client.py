@@ -1,14 +1,23 @@
 from socket import *
 import threading
-import json
+import argparse
 import re
+import shlex
+import random
 from time import sleep
-from protocol import Protocol
+from protocol import CODECS, COMPRESSIONS, JSON, FrameBuffer, negotiate
 
 class Client:
     
+    # Options of the %users, %groupusers and %groups listings
+    PAGE_OPTIONS = ('after', 'prefix', 'limit', 'count')
+    LISTING_OPTIONS = '[after "<name>"] [prefix "<text>"] [limit <count>] [count]'
 
-    def __init__(self):
+    # Attempts to reconnect after the connection was lost, and the longest wait before the first one (doubled after every failure)
+    RECONNECT_ATTEMPTS = 6
+    RECONNECT_DELAY = 0.5
+
+    def __init__(self, encoding='binary', compression='zlib'):
         """Client constructor to set up host, port and socket"""
 
         # Initialize all variables to None type as they will be defined in the connect command
@@ -18,6 +27,21 @@ class Client:
         self.username = None
         self.running = True
         self.exit_confirmed = False
+        self.buffer = None
+
+        # Encoding and compression asked for on connect and the codec in use (every connection starts out in JSON)
+        self.encoding = encoding
+        self.compression = compression
+        self.codec = JSON
+
+        # Requests sent but not yet answered, keyed by request ID, so responses can be matched up
+        self.request_count = 0
+        self.pending_requests = {}
+
+        # Token the server issued on connect, used to resume the session if the connection drops, and the
+        # number of the last notification received on every board (None for the server-wide ones)
+        self.session = None
+        self.seen = {}
 
 
     def run(self):
@@ -66,20 +90,10 @@ class Client:
                 self.socket.connect((self.host, self.port))
                 print(f'Connected to the server at {self.host}: port {self.port}')
 
-                # Start a thread to listen for incoming messages from the server
-                receive_thread = threading.Thread(target=self.receive_messages)
-                receive_thread.daemon = True
-                receive_thread.start()
-
-                # Send username to the server
+                # Send username to the server and wait for its response
                 self.username = input("Enter your username: ")
-                connection_request = Protocol.build_request('connect', self.username)
-                self.socket.send(connection_request.encode())
-
-                # Wait for the server's response
-                response = self.socket.recv(1024).decode().strip()
-                if response:
-                    response_dict = json.loads(response)
+                response_dict = self.handshake()
+                if response_dict:
                     status = response_dict['header'].get('status')
                     message = response_dict['body'].get('data')
 
@@ -95,6 +109,11 @@ class Client:
                     self.socket.close()
                     self.socket = socket(AF_INET, SOCK_STREAM)
 
+            # Start a thread to listen for incoming messages from the server
+            receive_thread = threading.Thread(target=self.receive_messages)
+            receive_thread.daemon = True
+            receive_thread.start()
+
             # Start sending messages after successful connection
             self.send_messages()
 
@@ -102,77 +121,136 @@ class Client:
             print('Problem connecting and interacting with the server. Make sure it is running')
             print(f'Error encountered: {e}')
 
+
+    def handshake(self):
+        """
+        Send the connect request on a new connection, asking for the encoding to use from now on and to resume
+        the previous session if there is one, and wait for the server's response (before the receive thread
+        reads the socket). Returns the response as a dictionary, None if the server closed the connection.
+        """
+        # Fresh receive buffer for the new connection
+        self.buffer = FrameBuffer()
+        self.codec = JSON
+
+        request_id = self.next_request_id('connect')
+        options = {'encoding': self.encoding, 'compression': self.compression}
+        if self.session:
+            # The server sends everything after the last notification received on each board
+            options['resume'] = self.session
+            options['seen'] = [[board, number] for board, number in self.seen.items()]
+        self.socket.sendall(JSON.encode_request('connect', self.username, data=options, request_id=request_id))
+
+        response_dict = self.read_response(request_id)
+        data = response_dict['body'].get('data') if response_dict else None
+        if response_dict and response_dict['header'].get('status') == 'OK' and isinstance(data, dict):
+            # Switch to the encoding the server agreed to (older servers do not answer and stay on JSON)
+            self.codec = negotiate(data.get('encoding'), data.get('compression'))
+            self.buffer.length_prefixed = self.codec.length_prefixed
+            self.session = data.get('session')
+
+            # A new session numbers its notifications afresh
+            if data.get('resumed') is None:
+                self.seen = {}
+        return response_dict
+
+
+    def reconnect(self):
+        """
+        Connect to the server again after the connection was lost and resume the session, which puts the
+        client back on its boards and groups and has the server send the notifications it missed. The
+        client waits a random time before every attempt, up to twice as long after each failure, so clients
+        that lost their connections at the same time do not all come back at once.
+        Returns True once reconnected.
+        """
+        delay = self.RECONNECT_DELAY
+        for _ in range(self.RECONNECT_ATTEMPTS):
+            sleep(random.uniform(0, delay))
+            delay *= 2
+            try:
+                self.socket.close()
+                self.socket = socket(AF_INET, SOCK_STREAM)
+                self.socket.connect((self.host, self.port))
+                response_dict = self.handshake()
+            except OSError:
+                continue
+            if not response_dict or response_dict['header'].get('status') != 'OK':
+                continue
+
+            resumed = response_dict['body']['data'].get('resumed') if self.session else None
+            if resumed is None:
+                print('\rReconnected to the server, but the session could not be resumed. Use %join to join the board again.\n>> ', end='')
+            else:
+                print(f'\rReconnected to the server, back on {", ".join(resumed) or "no boards"}.\n>> ', end='')
+
+            # Show the notifications the server sent right behind its response (those missed while away)
+            for message in self.buffer.frames():
+                self.handle_message(self.codec.decode(message))
+            return True
+        return False
+
+
+    def next_request_id(self, command):
+        """Allocate an ID for a new request and remember which command it was for"""
+        self.request_count += 1
+        self.pending_requests[self.request_count] = command
+        return self.request_count
+
+
+    def send_request(self, command, group=None, data=None):
+        """
+        Build a request tagged with a fresh request ID and send it without waiting for the response.
+        Several requests can be in flight at once, the receive thread matches the responses by ID.
+        """
+        request = self.codec.encode_request(command, self.username, group, data, request_id=self.next_request_id(command))
+        try:
+            self.socket.sendall(request)
+        except OSError:
+            # The connection dropped, the receive thread is reconnecting
+            print('Not connected to the server, try again in a moment.')
+
+
+    def read_response(self, request_id):
+        """
+        Block until the response to the given request arrives and return it as a dictionary.
+        Any notifications received while waiting are displayed as usual.
+        Returns None if the server closed the connection first.
+        """
+        while True:
+            # Handle complete frames already in the buffer first
+            for message in self.buffer.frames():
+                message_dict = self.codec.decode(message)
+                header = message_dict.get('header')
+                if header.get('status') and header.get('request_id') == request_id:
+                    self.pending_requests.pop(request_id, None)
+                    return message_dict
+                self.handle_message(message_dict)
+
+            # Read more from the server, an empty read means the connection was closed
+            if not self.buffer.read_from(self.socket):
+                return None
+
     
     def receive_messages(self):
         """Listen for incoming messages from the server"""
 
-        # Buffer to hold incomplete messages
-        buffer = ""
-
         while self.running:
             try:
-                # Receive a message from the server
-                data = self.socket.recv(1024).decode()
-                if not data:
-                    continue
-
-                buffer += data
-                while '\n' in buffer:
-                    # Split the buffer at the newline character
-                    message, buffer = buffer.split('\n', 1)
-
-                    # If a message exist, evaluate it to determine what actions to take
-                    if message:
-                        # Convert from the JSON string to a dictionary
-                        message_dict = json.loads(message)
-
-                        # Safely grab the header and body dictionaries within the read message
-                        header = message_dict.get('header')
-                        body = message_dict.get('body')
-
-                        # If a status value exists in the header, a response has been read, handle accordingly
-                        if header.get('status'):
-                            # Safely grab the command and status values
-                            command = header.get('command')
-                            status = header.get('status')
-                            data = body.get('data')
-
-                            # If the response is a failure output the message
-                            if status == 'FAIL':
-                                # Display Error Message from the Server
-                                print(f'\rFAILURE: {data}\n>> ', end='')
-
-                            # Handle if the response is a successful exit command
-                            elif command == 'exit' and status == 'OK':
-                                self.exit_confirmed = True # bool flag to let send_messages know it is ok to shutdown
-                                # Shutdown the Client Side
-                                print('\rShutting down client...')
-                                self.shutdown()
-                                break
-                            
-                            # Handle if the response is join or groupjoin (ones containing historical messages)
-                            elif command == 'join' or command == 'groupjoin':
-                                # Display the message history or "no messages" notice
-                                print("You have joined the message board.")
-                                if isinstance(data, list):  # Display the last two messages if available
-                                    print('Last two messages:')
-                                    for msg in data:
-                                        print(f'\rMessage ID: {msg["id"]}, Sender: {msg["sender"]}, '
-                                            f'Time Posted: {msg["timestamp"]}, Subject: {msg["subject"]}\n>> ', end='')
-                                else:
-                                    print(f'\r{data}\n>> ', end='')
-
-                            # Handle any other, OK responses
-                            elif data:
-                                # Display the data contained in the response 
-                                print(f'\r{data}\n', end='')
-
-                        # If the command is 'notify' (a broadcast signal) display the message it contains in data
-                        elif header.get('command') == 'notify':
-                            message = body.get('data')
-                            message = message.replace('\\n', '\n')
-                            if message:
-                                print(f'\r{message}\n>> ', end='')
+                # Receive whatever the server sent into the frame buffer
+                if not self.buffer.read_from(self.socket):
+                    # The server closed the connection, try to pick the session up again on a new one
+                    if self.running:
+                        print('\rConnection to the server was closed, reconnecting...')
+                        if self.reconnect():
+                            continue
+                        self.shutdown()
+                    break
+
+                # Handle every complete message that arrived, in order
+                for message in self.buffer.frames():
+                    # Decode the message into a dictionary and evaluate it
+                    self.handle_message(self.codec.decode(message))
+                    if not self.running:
+                        break
 
             except Exception as e:
                 # Only throw an error if the client is still running
@@ -180,8 +258,94 @@ class Client:
                 if self.running:
                     print('Error receiving message or connection to the server may have been lost')
                     print(f'Error encountered: {e}')
+                    if isinstance(e, OSError) and self.reconnect():
+                        continue
                 break
 
+
+    def handle_message(self, message_dict):
+        """Evaluate a message from the server to determine what actions to take"""
+
+        # Safely grab the header and body dictionaries within the read message
+        header = message_dict.get('header')
+        body = message_dict.get('body')
+
+        # If a status value exists in the header, a response has been read, handle accordingly
+        if header.get('status'):
+            # Safely grab the command and status values, matching the response to its request by ID
+            command = self.pending_requests.pop(header.get('request_id'), None) or header.get('command')
+            status = header.get('status')
+            data = body.get('data')
+
+            # If the response is a failure output the message
+            if status == 'FAIL':
+                # Display Error Message from the Server
+                print(f'\rFAILURE: {data}\n>> ', end='')
+
+            # Handle if the response is a successful exit command
+            elif command == 'exit' and status == 'OK':
+                self.exit_confirmed = True # bool flag to let send_messages know it is ok to shutdown
+                # Shutdown the Client Side
+                print('\rShutting down client...')
+                self.shutdown()
+            
+            # Handle if the response is join or groupjoin (ones containing historical messages)
+            elif command == 'join' or command == 'groupjoin':
+                # Display the message history or "no messages" notice
+                print("You have joined the message board.")
+                if isinstance(data, list):  # Display the message history if available
+                    print('Message history:')
+                    for msg in data:
+                        print(f'\rMessage ID: {msg["id"]}, Sender: {msg["sender"]}, '
+                            f'Time Posted: {msg["timestamp"]}, Subject: {msg["subject"]}\n>> ', end='')
+                else:
+                    print(f'\r{data}\n>> ', end='')
+
+            # Handle a page of the user or group list (or only its size), telling the user how to get the next page
+            elif command in ('users', 'groupusers', 'groups') and isinstance(data, dict):
+                kind = 'groups' if command == 'groups' else 'users'
+                if kind not in data:
+                    print(f"\r{data['total']} {kind}\n>> ", end='')
+                else:
+                    print(f"\r{', '.join(data[kind]) or f'No {kind} found.'}\n", end='')
+                    if data['next']:
+                        print(f'{data["total"]} {kind} in total, repeat the command with after "{data["next"]}" for more\n>> ', end='')
+
+            # Handle a page of search hits, best match first
+            elif command == 'search':
+                for hit in data['hits']:
+                    print(f'\rMessage ID: {hit["id"]}, Sender: {hit["sender"]}, Time Posted: {hit["timestamp"]}, '
+                          f'Subject: {hit["subject"]} (score {hit["score"]})\n\t{hit["message"]}')
+                about = '' if data['exact'] else 'about '
+                print(f'{about}{data["total"]} matching messages' if data['hits'] else 'No matching messages.', end='')
+                if data['next'] is not None:
+                    print(f', repeat the search with offset {data["next"]} for more', end='')
+                print('\n>> ', end='')
+
+            # Handle one part of a streamed history, more parts follow until next is null
+            elif command == 'history':
+                for msg in data['messages']:
+                    print(f'\rMessage ID: {msg["id"]}, Sender: {msg["sender"]}, Time Posted: {msg["timestamp"]}, '
+                          f'Subject: {msg["subject"]}\n\t{msg["message"]}')
+                if data['next'] is None:
+                    print('End of the message history.\n>> ', end='')
+
+            # Handle any other, OK responses
+            elif data:
+                # Display the data contained in the response 
+                print(f'\r{data}\n', end='')
+
+        # If the command is 'notify' (a broadcast signal) display the message it contains in data
+        elif header.get('command') == 'notify':
+            # Remember how far the board's notifications got, a resumed session carries on from there
+            if header.get('sequence') is not None:
+                self.seen[header.get('group')] = header['sequence']
+
+            message = body.get('data')
+            message = message.replace('\\n', '\n')
+            if message:
+                print(f'\r{message}\n>> ', end='')
+
     
     def send_messages(self):
         """Prompt user and send messages to the server"""
@@ -194,32 +358,41 @@ class Client:
                 if not message:
                     continue  # Ignore empty input
 
-                # If the user types '%join', send it to the server
+                # If the user types '%join', send it to the server (with an optional history window)
                 if message.startswith('%join'):
-                    join_request = Protocol.build_request('join', self.username)
-                    self.socket.send(join_request.encode())
+                    match = re.match(r'%join(?:\s+(last|since)\s+(\d+))?\s*$', message)
+                    if not match:
+                        print("ERROR: Must use the format, %join [last <count> | since <message_id>]")
+                    else:
+                        self.send_request('join', data=self.history_window(match))
 
-                # If the user types '%groupjoin', send it to the server
+                # If the user types '%groupjoin', send it to the server (with an optional history window)
                 elif message.startswith('%groupjoin'):
-                    group_name = message.split(maxsplit=1)[1].strip('"').strip("'")
-                    join_request = Protocol.build_request('groupjoin', self.username, group=group_name)
-                    self.socket.send(join_request.encode())
+                    match = re.match(r'%groupjoin\s+["\']?(.+?)["\']?(?:\s+(last|since)\s+(\d+))?\s*$', message)
+                    if not match:
+                        print('ERROR: Must use the format, %groupjoin "<group>" [last <count> | since <message_id>]')
+                    else:
+                        group_name = match.group(1)
+                        self.send_request('groupjoin', group=group_name, data=self.history_window(match, first=2))
 
                 # If the user types '%groupleave', send it to the server
                 elif message.startswith('%groupleave'):
                     group_name = message.split(maxsplit=1)[1].strip('"').strip("'")
-                    leave_request = Protocol.build_request('groupleave', self.username, group=group_name)
-                    self.socket.send(leave_request.encode())
+                    self.send_request('groupleave', group=group_name)
 
                 # If the user types '%leave', send it to the server
                 elif message.startswith('%leave'):
-                    leave_request = Protocol.build_request('leave', self.username)
-                    self.socket.send(leave_request.encode())
+                    self.send_request('leave')
 
-                # If the user types '%users', send it to the server    
+                # If the user types '%users', send it to the server (with optional page options)
                 elif message.startswith('%users'):
-                    users_request = Protocol.build_request('users', self.username)
-                    self.socket.send(users_request.encode())
+                    try:
+                        words, page = self.listing_request(message[len('%users'):])
+                        if words:
+                            raise ValueError(f'Unexpected {words}')
+                        self.send_request('users', data=page)
+                    except ValueError:
+                        print(f'ERROR: Must use the format, %users {self.LISTING_OPTIONS}')
 
                 # If the user types '%message', send it to the server  
                 elif message.startswith('%message'):
@@ -229,13 +402,11 @@ class Client:
                     else:
                         # build protocol with the ID given by the user
                         message_id = message.split()[1]
-                        message_request = Protocol.build_request('message', self.username, data=message_id)
-                        self.socket.send(message_request.encode())
+                        self.send_request('message', data=message_id)
                 
                 # If the user types '%exit', send it to the server and break the loop
                 elif message == '%exit':
-                    message = Protocol.build_request('exit', self.username)
-                    self.socket.send(message.encode())
+                    self.send_request('exit')
                     sleep(.2) # Short wait to allow for server and client to handle request/response before ending
                     if self.exit_confirmed: # Only break if the and OK response is recieved from server
                         break
@@ -244,10 +415,57 @@ class Client:
                 elif message.startswith('%post'):
                     self.post_helper(message)
 
-                # If the user types '%groups', send it to the server
-                elif message == '%groups':
-                    message = Protocol.build_request('groups')
-                    self.socket.send(message.encode())
+                # If the user types '%groups', send it to the server (with optional page options)
+                elif message.startswith('%groups'):
+                    try:
+                        words, page = self.listing_request(message[len('%groups'):])
+                        if words:
+                            raise ValueError(f'Unexpected {words}')
+                        self.send_request('groups', data=page)
+                    except ValueError:
+                        print(f'ERROR: Must use the format, %groups {self.LISTING_OPTIONS}')
+
+                # If the user types '%groupcreate' or '%groupdelete', send it to the server
+                elif message.startswith('%groupcreate') or message.startswith('%groupdelete'):
+                    parts = message.split(maxsplit=1)
+                    if len(parts) < 2:
+                        print(f'ERROR: Must use the format, {parts[0]} "<group>"')
+                    else:
+                        self.send_request(parts[0][1:], group=parts[1].strip('"').strip("'"))
+
+                # If the user types '%search', search the board or a group for the words of the query
+                elif message.startswith('%search'):
+                    try:
+                        words = shlex.split(message[len('%search'):])
+                        options = dict(zip(words[1::2], words[2::2]))
+                        if not words or len(words) % 2 == 0 or set(options) - {'group', 'limit', 'offset'}:
+                            raise ValueError('Unexpected options')
+                        search = {'query': words[0], **{key: int(value) for key, value in options.items() if key != 'group'}}
+                        self.send_request('search', group=options.get('group'), data=search)
+                    except ValueError:
+                        print('ERROR: Must use the format, %search "<words>" [group "<group>"] [limit <count>] [offset <count>]')
+
+                # If the user types '%history', fetch every message after an ID or a range of IDs
+                elif message.startswith('%history'):
+                    try:
+                        words = shlex.split(message[len('%history'):])
+                        if words[:1] == ['since']:
+                            history, options = {'since': int(words[1])}, words[2:]
+                        else:
+                            history, options = {'from': int(words[0]), 'to': int(words[1])}, words[2:]
+                        options = dict(zip(options[::2], options[1::2]))
+                        if len(words) % 2 or set(options) - {'group', 'chunk'}:
+                            raise ValueError('Unexpected options')
+                        if 'chunk' in options:
+                            history['chunk'] = int(options['chunk'])
+                        self.send_request('history', group=options.get('group'), data=history)
+                    except (ValueError, IndexError):
+                        print('ERROR: Must use the format, %history since <message_id> | <first_id> <last_id> '
+                              '[group "<group>"] [chunk <count>]')
+
+                # If the user types '%stats', ask the server for its metrics
+                elif message == '%stats':
+                    self.send_request('stats')
 
                 # If the user's prompt starst with '%post', call the post_helper method to handle it
                 elif message.startswith('%grouppost'):
@@ -255,14 +473,16 @@ class Client:
                     
                 # find users based on groups
                 elif message.startswith('%groupusers'):
-                    parts = message.split(' ', 1)
+                    # The group comes first, any page options after it
+                    try:
+                        group, page = self.listing_request(message[len('%groupusers'):], leading=1)
+                    except ValueError:
+                        group = None
                     # Prevent formatting issues
-                    if len(parts) < 2:
-                        print("ERROR: Must use the format, %groupusers <group>")
+                    if not group:
+                        print(f"ERROR: Must use the format, %groupusers <group> {self.LISTING_OPTIONS}")
                     else:
-                        group = parts[1]
-                        groupusers_request = Protocol.build_request('groupusers', username=self.username, group=group)
-                        self.socket.send((groupusers_request + '\n').encode())
+                        self.send_request('groupusers', group=group, data=page)
                     
                 # find message based on groups and an ID
                 elif message.startswith('%groupmessage'):
@@ -272,8 +492,7 @@ class Client:
                     else:
                         group = match.group(1)
                         message_id = match.group(2)
-                        groupmessage_request = Protocol.build_request('groupmessage', username=self.username, group=group, data=message_id)
-                        self.socket.send((groupmessage_request + '\n').encode())
+                        self.send_request('groupmessage', group=group, data=message_id)
 
                 # Display the help menu
                 elif message == '%help':
@@ -288,11 +507,44 @@ class Client:
 
         except KeyboardInterrupt:
             print('\nExiting...')
-            message = Protocol.build_request('exit', self.username)
-            self.socket.send(message.encode()) # Send exit command to server
+            self.send_request('exit') # Send exit command to server
             sleep(.1) # Short wait to allow for server and client to handle request/response before ending
 
 
+    def history_window(self, match, first=1):
+        """
+        Build the history window for a join request from the optional 'last <count>' or
+        'since <message_id>' part of the command. None lets the server use its default.
+        """
+        mode, value = match.group(first), match.group(first + 1)
+        if not mode:
+            return None
+        return {mode: int(value)}
+
+
+    def listing_request(self, arguments, leading=0):
+        """
+        Split the arguments of %users, %groupusers and %groups into the words before the page options
+        (at least leading of them, e.g. the group) and the page options: after "<name>", prefix "<text>",
+        limit <count> and count. Returns (the leading words, the request data or None if there are no
+        options) and raises ValueError if the options are malformed.
+        """
+        words = shlex.split(arguments)
+        position = next((position for position in range(leading, len(words)) if words[position] in self.PAGE_OPTIONS),
+                        len(words))
+        options, data = words[position:], {}
+        while options:
+            option = options.pop(0)
+            if option == 'count':
+                data['count'] = True
+            elif option in self.PAGE_OPTIONS and options:
+                value = options.pop(0)
+                data[option] = int(value) if option == 'limit' else value
+            else:
+                raise ValueError(f'Unknown option {option}')
+        return ' '.join(words[:position]), data or None
+
+
     def post_helper(self, message, group=False):
         """Helper function to format data passed in post command into a request"""
         """
@@ -321,8 +573,7 @@ class Client:
                 print('ERROR: Must use the format, %post "<subject>" "<content>"')
 
             # Build the request for the post command and send to server
-            request = Protocol.build_request('post', self.username, data=data)
-            self.socket.send(request.encode())
+            self.send_request('post', data=data)
 
         elif group:
             try:
@@ -343,8 +594,7 @@ class Client:
                 print('ERROR: Must use the format, %grouppost "<group>" "<subject>" "<content>"')
 
             # Build the request for the post command and send to server
-            request = Protocol.build_request('grouppost', self.username, group, data)
-            self.socket.send(request.encode())
+            self.send_request('grouppost', group, data)
 
         else:
             # Something with the message format was wrong, let the user know
@@ -367,11 +617,12 @@ class Client:
         - %grouppost "<group>" "<subject>" "<content>"
         Post a message to a specific group.
 
-        - %join
-        Join the main bulletin board.
+        - %join [last <count> | since <message id>]
+        Join the main bulletin board. By default the last two messages are shown,
+        'last' shows the newest <count> messages and 'since' every message after <message id>.
 
-        - %groupjoin "<group>"
-        Join a specific group.
+        - %groupjoin "<group>" [last <count> | since <message id>]
+        Join a specific group, optionally choosing the message history shown.
 
         - %leave
         Leave the main bulletin board.
@@ -379,14 +630,34 @@ class Client:
         - %groupleave "<group>"
         Leave a specific group.
 
-        - %groups
-        List all available groups.
+        - %groups [after "<name>"] [prefix "<text>"] [limit <count>] [count]
+        List the available groups in alphabetical order, a page at a time. 'after' shows the
+        page following <name>, 'prefix' only lists names starting with <text>, 'limit' sets
+        the page size and 'count' only shows how many there are.
+
+        - %groupcreate "<group>"
+        Create a new group, only you can delete it again.
+
+        - %groupdelete "<group>"
+        Delete a group you created, its members are removed and its messages discarded.
+
+        - %search "<words>" [group "<group>"] [limit <count>] [offset <count>]
+        Find the messages of the main bulletin board (or of a group you are in) containing
+        every word, best match first. 'offset' skips that many hits to see the next page.
 
-        - %users
-        Show all users in the main bulletin board.
+        - %history since <message id> | <first id> <last id> [group "<group>"] [chunk <count>]
+        Show every message of the main bulletin board (or of a group you are in) posted after
+        <message id>, or those from <first id> to <last id>. Long stretches arrive in several
+        parts of <count> messages.
 
-        - %groupusers <group>
-        Show all users in a specific group.
+        - %stats
+        Show the server's metrics (requests, latencies, connections, queues).
+
+        - %users [after "<name>"] [prefix "<text>"] [limit <count>] [count]
+        Show the users in the main bulletin board, a page at a time (options as for %groups).
+
+        - %groupusers <group> [after "<name>"] [prefix "<text>"] [limit <count>] [count]
+        Show the users in a specific group, a page at a time.
 
         - %message "<message id>"
         View details of a specific message in the main bulletin board.
@@ -414,6 +685,14 @@ class Client:
 
 
 if __name__ == "__main__":
+    # Allow the encoding to be selected at startup, JSON is easier to read when debugging
+    parser = argparse.ArgumentParser(description='Bulletin Board Client')
+    parser.add_argument('--encoding', choices=sorted(CODECS), default='binary',
+                        help='encoding asked for when connecting, binary is smaller and faster to handle')
+    parser.add_argument('--compression', choices=[*sorted(COMPRESSIONS), 'none'], default='zlib',
+                        help='compression of large messages (needs the binary encoding), useful on slow links')
+    args = parser.parse_args()
+
     # Initialize the client object and run it
-    client = Client()        
+    client = Client(encoding=args.encoding, compression=None if args.compression == 'none' else args.compression)
     client.run()
\ No newline at end of file
@@ -0,0 +1,689 @@
+import os
+import json
+import signal
+import socket
+import tempfile
+import threading
+from time import sleep
+from collections import deque
+import multiprocessing
+from protocol import FrameBuffer
+from groups import Group, GroupRegistry
+from message_store import MessageStore
+from search import SearchIndex
+from logger import logger, configure as configure_logging
+
+# Newest messages of every board in use on the broker sent to a node joining the cluster, it reads
+# older ones from the broker when they are asked for
+SNAPSHOT_TAIL = 500
+
+
+def parse_address(text):
+    """
+    Parse a broker address: host:port for TCP (between machines), anything else is the path of a Unix socket.
+    Returns (address family, address).
+    """
+    host, separator, port = text.rpartition(':')
+    if separator and port.isdigit():
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, text
+
+
+def send_event(sock, event):
+    """Send one event to the other end of a broker link as a line of JSON"""
+    sock.sendall(json.dumps(event).encode('utf-8') + FrameBuffer.DELIMITER)
+
+
+def read_events(sock, buffer):
+    """Yield the events arriving on a broker link until the other end closes it"""
+    while buffer.read_from(sock):
+        for frame in buffer.frames():
+            yield json.loads(frame)
+
+
+class Broker:
+    """
+    Hub of a cluster of servers (the workers of a multi-process server or separate nodes).
+
+    Every node holds its own clients and the newest messages of the boards in
+    use, older messages are read from the broker when a node needs them. Nodes
+    hand posts to the broker, which is the only place message IDs are assigned
+    (and the history is persisted), so IDs are unique and ordered per board
+    across the whole cluster. A post is only relayed once it is synced to disk,
+    posts from every node that queued up together share the sync. Every post,
+    notification and roster change is relayed to all nodes in a single order,
+    so a post made on one node reaches the subscribers connected to every other
+    node and every replica sees the same history. Groups are created and
+    deleted through the broker too, it holds the cluster's group registry.
+    Reads of old messages are not sequenced, they only take the lock to send
+    the answer.
+
+    The broker does not care how nodes reach it: each attached peer only needs
+    a deliver(event) method (see BrokerListener and InProcessBackplane).
+    """
+
+    def __init__(self, messages, groups):
+        """Broker constructor, starts evicting the history of idle groups in the background"""
+        self.messages = messages
+        self.groups = groups
+
+        # Node ID to the peer events for it are delivered to
+        self.peers = {}
+        self.next_node = 1
+
+        # Usernames on every board held by each node: board to {(node, username): count}, only boards someone is on
+        self.rosters = {}
+
+        # Events are sequenced and relayed under this lock, so all nodes see them in the same order
+        self.lock = threading.Lock()
+
+        # Message events of posts waiting for their group commit, (position, event) in ID order,
+        # and the position of the newest post queued
+        self.unpublished = deque()
+        self.queued = 0
+
+        threading.Thread(target=self.evict_loop, name='broker-evictor', daemon=True).start()
+
+    def attach(self, peer):
+        """
+        Add a node, sending it its ID, the number of messages on every board along with the newest ones
+        of the boards in use, and the rosters. Returns the node ID.
+        """
+        with self.lock:
+            node = self.next_node
+            self.next_node += 1
+
+            # Posts still waiting for the disk go out first, the snapshot only holds what was relayed
+            self.drain()
+
+            peer.deliver({'op': 'welcome', 'node': node})
+            peer.deliver({'op': 'groups', 'groups': [group.to_dict() for group in self.groups.all()]})
+            for board, count in self.messages.counts().items():
+                records = self.messages.last(board, SNAPSHOT_TAIL) if board in self.messages else []
+                peer.deliver({'op': 'history', 'board': board, 'count': count, 'records': records})
+            rosters = {board: [[origin, username, count] for (origin, username), count in roster.items()]
+                       for board, roster in self.rosters.items()}
+            peer.deliver({'op': 'ready', 'rosters': rosters})
+
+            self.peers[node] = peer
+        logger.info('Node %d joined the cluster', node)
+        return node
+
+    def handle(self, node, event):
+        """Sequence an event from a node and relay it to every node"""
+        op = event.get('op')
+        if op == 'post':
+            self.post(node, event)
+            return
+
+        if op == 'range':
+            # Nodes only ask for messages they were sent, so they are on disk already (of deleted groups there are none)
+            board = event['board']
+            records = []
+            if board == 'public board' or board in self.groups:
+                records = self.messages.range(board, event['start'], event['end'])
+            with self.lock:
+                self.reply(node, {**event, 'records': records, 'origin': node})
+            return
+
+        with self.lock:
+            if op == 'roster':
+                roster = self.rosters.setdefault(event['board'], {})
+                key = (node, event['username'])
+                roster[key] = roster.get(key, 0) + event['change']
+                if roster[key] <= 0:
+                    del roster[key]
+                if not roster:
+                    del self.rosters[event['board']]
+                self.broadcast({**event, 'origin': node}, skip=node)
+
+            elif op == 'group':
+                # Create or delete a group, only the creator of a group may delete it
+                name, username = event['group'], event['username']
+                created = None
+                if event['action'] == 'create':
+                    group = self.groups.create(name, username)
+                    ok = group is not None
+                    created = group.created if ok else None
+                else:
+                    existing = self.groups.get(name)
+                    ok = existing is not None and existing.creator is not None and existing.creator == username
+                    if ok:
+                        # The group's messages still waiting for the disk are relayed before it goes
+                        self.drain()
+                        self.groups.delete(name)
+                        self.messages.delete(name)
+                        self.rosters.pop(name, None)
+
+                # Every node applies a change, a refused one is only answered to the node that asked
+                answer = {**event, 'ok': ok, 'created': created, 'origin': node}
+                if ok:
+                    self.broadcast(answer)
+                else:
+                    self.reply(node, answer)
+
+            elif op == 'notify':
+                self.broadcast({**event, 'origin': node}, skip=node)
+
+    def post(self, node, event):
+        """Assign a post its ID and persist it, then hand it to every node (including the poster) once it is on disk"""
+        failed = {'op': 'message', 'board': event['board'], 'record': None, 'origin': node, 'ref': event.get('ref')}
+        with self.lock:
+            try:
+                record = self.messages.add(event['board'], sender=event['sender'], subject=event['subject'],
+                                           message=event['message'], durable=False)
+            except OSError as e:
+                logger.error('Could not store a post from node %d: %s', node, e)
+                self.reply(node, failed)
+                return
+            self.queued += 1
+            position = self.queued
+            self.unpublished.append((position, {**failed, 'record': record}))
+
+        # Wait for the group commit without holding up the other nodes
+        try:
+            self.messages.sync()
+        except OSError as e:
+            logger.error('Could not store a post from node %d: %s', node, e)
+            with self.lock:
+                # Every post queued after a failed batch fails too, so none of them is relayed
+                entry = next((entry for entry in self.unpublished if entry[0] == position), None)
+                if entry is not None:
+                    self.unpublished.remove(entry)
+                    self.reply(node, failed)
+            return
+
+        with self.lock:
+            self.publish(position)
+
+    def publish(self, position):
+        """Relay the message events of every post queued up to position, in ID order (called with the lock held)"""
+        while self.unpublished and self.unpublished[0][0] <= position:
+            self.broadcast(self.unpublished.popleft()[1])
+
+    def drain(self):
+        """Wait for every queued post to reach the disk and relay it (called with the lock held)"""
+        try:
+            self.messages.sync()
+        except OSError:
+            # The posters are told their posts failed once the lock is free
+            return
+        self.publish(self.queued)
+
+    def reply(self, node, event):
+        """Deliver an event to a single node, if it is still attached (called with the lock held)"""
+        if node in self.peers:
+            self.peers[node].deliver(event)
+
+    def broadcast(self, event, skip=None):
+        """Deliver an event to every node but skip (called with the lock held)"""
+        for node, peer in list(self.peers.items()):
+            if node != skip:
+                peer.deliver(event)
+
+    def remove(self, node):
+        """Forget a node that went away and drop its clients from every roster"""
+        with self.lock:
+            if self.peers.pop(node, None) is None:
+                return
+            for board, roster in list(self.rosters.items()):
+                for key in [key for key in roster if key[0] == node]:
+                    del roster[key]
+                if not roster:
+                    del self.rosters[board]
+            self.broadcast({'op': 'gone', 'node': node})
+        logger.info('Node %d left the cluster', node)
+
+    def evict_loop(self):
+        """Let go of the history of groups no node has used for a while, it is read back from the log when needed"""
+        from server import BulletinBoardServer
+
+        while True:
+            sleep(BulletinBoardServer.EVICT_INTERVAL)
+            self.messages.evict(BulletinBoardServer.GROUP_IDLE_SECONDS, keep=("public board",))
+
+
+class SocketPeer:
+    """A node connected to the broker over a socket."""
+
+    def __init__(self, sock):
+        """SocketPeer constructor"""
+        self.socket = sock
+
+    def deliver(self, event):
+        """Send an event to the node (always called under the broker's lock)"""
+        try:
+            send_event(self.socket, event)
+        except OSError:
+            # The node died, the thread reading from it removes it from the broker
+            self.socket.close()
+
+
+class BrokerListener:
+    """Lets nodes reach a Broker over a Unix socket (workers on one machine) or TCP (nodes on several)."""
+
+    def __init__(self, broker, address):
+        """BrokerListener constructor, binds the listening socket"""
+        self.broker = broker
+        self.family, self.address = parse_address(address)
+
+        self.listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family != socket.AF_UNIX:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen()
+
+    def start(self):
+        """Accept nodes in a background thread"""
+        threading.Thread(target=self.accept_loop, name='broker', daemon=True).start()
+
+    def accept_loop(self):
+        """Accept nodes until the listening socket is closed"""
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            if self.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve_node, args=(sock,), name='broker-link', daemon=True).start()
+
+    def serve_node(self, sock):
+        """Attach a node to the broker and pass its events on until it goes away"""
+        node = self.broker.attach(SocketPeer(sock))
+        try:
+            for event in read_events(sock, FrameBuffer()):
+                self.broker.handle(node, event)
+        except ConnectionResetError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error('Error on the link to node %d: %s', node, e)
+        finally:
+            self.broker.remove(node)
+            sock.close()
+
+    def close(self):
+        """Stop accepting nodes (and remove the socket file of a Unix socket)"""
+        self.listener.close()
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+
+class BrokerBoardLog:
+    """A board's history on the broker as seen by a node, in place of a BoardLog (see Board)."""
+
+    def __init__(self, log, name):
+        """BrokerBoardLog constructor"""
+        self.log = log
+        self.name = name
+
+    @property
+    def count(self):
+        """Number of messages the broker relayed for the board"""
+        return self.log.counts.get(self.name, 0)
+
+    @property
+    def committed_id(self):
+        """Newest message that can be read, the broker only relays messages once they are on its disk"""
+        return self.count
+
+    def read_range(self, start, end):
+        """Fetch the messages with IDs from start to end (inclusive) from the broker"""
+        return self.log.backplane.request({'op': 'range', 'board': self.name, 'start': start, 'end': end})
+
+
+class BrokerLog:
+    """
+    What a node's MessageStore has in place of a MessageLog.
+
+    The broker persists the history, so nothing is written here. The store
+    keeps the newest messages of every board in use in memory and evicts idle
+    boards like it would with a log of its own, older messages are fetched
+    from the broker. Only the number of messages on every board is kept for
+    all boards, as messages are relayed.
+    """
+
+    def __init__(self, backplane):
+        """BrokerLog constructor"""
+        self.backplane = backplane
+        self.counts = {}
+
+    def open(self, board):
+        """Return the BrokerBoardLog of a board"""
+        return BrokerBoardLog(self, board)
+
+    def append(self, board, record):
+        """Count a message relayed by the broker (it is on the broker's disk already, there is nothing to wait for)"""
+        self.counts[board] = record['id']
+        return 0
+
+    def flush(self):
+        """Nothing is ever queued"""
+
+    def release(self, board):
+        """Nothing is held open"""
+
+    def remove(self, board):
+        """Forget a deleted board"""
+        self.counts.pop(board, None)
+
+    def names(self):
+        """Return the name of every board with messages"""
+        return sorted(self.counts)
+
+    def close(self):
+        """Nothing to close"""
+
+
+class Backplane:
+    """
+    A node's side of the cluster, the server only talks to its backplane.
+
+    Posts and group changes are sent to the broker and wait until the
+    sequenced event comes back, so the poster gets the cluster-wide ID. Events
+    relayed by the broker are applied to the server: messages are added to the
+    newest messages kept by the node and announced to local subscribers,
+    notifications are passed on to local clients, roster changes update the
+    remote part of the rosters and group changes the group registry. Older
+    messages are fetched from the broker (see BrokerLog).
+
+    Subclasses decide how events reach the broker by implementing send().
+    """
+
+    # Seconds a post waits for the broker before it fails
+    TIMEOUT = 10
+
+    def __init__(self, server):
+        """Backplane constructor"""
+        self.server = server
+        self.node = None
+
+        # Requests waiting for the broker's answer: reference to [event, result]
+        self.pending = {}
+        self.next_ref = 0
+        self.ref_lock = threading.Lock()
+
+        # The broker holds the history, the node's store only keeps the newest messages of the boards in use
+        self.log = BrokerLog(self)
+        server.messages = MessageStore(log=self.log)
+        server.search = SearchIndex(server.messages)
+
+    def send(self, event):
+        """Hand an event to the broker"""
+        raise NotImplementedError
+
+    def request(self, event):
+        """Send an event tagged with a fresh reference and wait for the broker's answer, returning its result"""
+        waiter = [threading.Event(), None]
+        with self.ref_lock:
+            self.next_ref += 1
+            ref = self.next_ref
+            self.pending[ref] = waiter
+
+        self.send({**event, 'ref': ref})
+        if not waiter[0].wait(self.TIMEOUT):
+            self.pending.pop(ref, None)
+            raise TimeoutError(f"The broker did not answer the {event['op']} in time")
+        return waiter[1]
+
+    def answer(self, event, result):
+        """Hand the result of an event we asked the broker for to the handler waiting for it"""
+        if event['origin'] == self.node:
+            waiter = self.pending.pop(event['ref'], None)
+            if waiter:
+                waiter[1] = result
+                waiter[0].set()
+
+    def post(self, board, sender, subject, message):
+        """Have the broker sequence and persist a post, returning the stored record once it was replicated here"""
+        record = self.request({'op': 'post', 'board': board, 'sender': sender, 'subject': subject, 'message': message})
+        if record is None:
+            raise OSError('The broker could not store the message')
+        return record
+
+    def group_change(self, action, group, username):
+        """Have the broker create or delete a group (action 'create' or 'delete'), returns whether it did"""
+        return self.request({'op': 'group', 'action': action, 'group': group, 'username': username})
+
+    def notify(self, board, data):
+        """Pass a notification for a board (every client if board is None) on to the other nodes"""
+        self.send({'op': 'notify', 'board': board, 'data': data})
+
+    def roster_change(self, board, username, change):
+        """Tell the other nodes a local client joined (change 1) or left (change -1) a board"""
+        self.send({'op': 'roster', 'board': board, 'username': username, 'change': change})
+
+    def apply(self, event):
+        """Apply a single event from the broker to the local server"""
+        op = event['op']
+        server = self.server
+
+        if op == 'message':
+            # A post the broker could not store only goes back to the node it came from, without a record
+            board, record = event['board'], event['record']
+            if record is not None:
+                server.messages.replicate(board, record)
+                server.deliver(server.post_notice(board, record), board)
+
+            # Our own post, hand the record to the handler waiting for it
+            self.answer(event, record)
+
+        elif op == 'group':
+            if event['ok'] and event['action'] == 'create':
+                server.groups.insert(Group(event['group'], event['username'], event['created']))
+            elif event['ok']:
+                server.remove_group(event['group'], event['username'])
+            self.answer(event, event['ok'])
+
+        elif op == 'notify':
+            server.deliver(event['data'], event['board'])
+
+        elif op == 'roster':
+            server.membership.remote_change(event['board'], event['origin'], event['username'], event['change'])
+
+        elif op == 'gone':
+            server.membership.remote_gone(event['node'])
+
+        # Sent once when the node attaches, before any other event
+        elif op == 'welcome':
+            self.node = event['node']
+
+        elif op == 'groups':
+            server.groups.reset(Group(entry['name'], entry['creator'], entry['created']) for entry in event['groups'])
+
+        elif op == 'range':
+            self.answer(event, event['records'])
+
+        elif op == 'history':
+            self.log.counts[event['board']] = event['count'] - len(event['records'])
+            for record in event['records']:
+                server.messages.replicate(event['board'], record)
+
+        elif op == 'ready':
+            for board, entries in event['rosters'].items():
+                for origin, username, count in entries:
+                    server.membership.remote_change(board, origin, username, count)
+
+            # Like on a standalone server the public board is always loaded
+            server.messages.history('public board')
+
+    def close(self):
+        """Leave the cluster"""
+
+
+class SocketBackplane(Backplane):
+    """Backplane connected to a broker in another process, over a Unix socket or TCP (see BrokerListener)."""
+
+    def __init__(self, address, server):
+        """SocketBackplane constructor, connects and loads the snapshot the broker sends"""
+        super().__init__(server)
+        family, address = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        if family != socket.AF_UNIX:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+
+        # Apply the snapshot before serving any client, then follow the broker in the background
+        self.events = read_events(self.socket, FrameBuffer())
+        for event in self.events:
+            self.apply(event)
+            if event['op'] == 'ready':
+                break
+        threading.Thread(target=self.read_loop, name='broker-link', daemon=True).start()
+
+    def send(self, event):
+        """Send an event to the broker"""
+        with self.send_lock:
+            send_event(self.socket, event)
+
+    def read_loop(self):
+        """Apply the events relayed by the broker"""
+        try:
+            for event in self.events:
+                self.apply(event)
+        except ConnectionResetError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error('Error on the broker link: %s', e)
+        if self.server.running:
+            logger.warning('Lost the connection to the broker')
+
+    def close(self):
+        """Close the link, the broker drops this node's clients from the rosters"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class InProcessBackplane(Backplane):
+    """
+    Backplane for several servers running in one process, attached straight to a shared Broker.
+    Events are applied synchronously, which makes it the stand-in of choice for trying out a cluster.
+    """
+
+    def __init__(self, broker, server):
+        """InProcessBackplane constructor, attaches to the broker (which sends the snapshot right away)"""
+        super().__init__(server)
+        self.broker = broker
+        self.broker.attach(self)
+
+    def deliver(self, event):
+        """Called by the broker for every event relayed to this node"""
+        self.apply(event)
+
+    def send(self, event):
+        """Hand an event straight to the broker"""
+        self.broker.handle(self.node, event)
+
+    def close(self):
+        """Detach from the broker"""
+        self.broker.remove(self.node)
+
+
+def open_history(data_dir):
+    """The message store a broker sequences posts with, persisted to data_dir unless it is None"""
+    from message_log import MessageLog
+
+    return MessageStore(["public board"], log=MessageLog(data_dir) if data_dir else None)
+
+
+def open_groups(data_dir):
+    """The group registry of a broker, saved in data_dir unless it is None"""
+    from server import BulletinBoardServer
+
+    return GroupRegistry(os.path.join(data_dir, 'groups.json') if data_dir else None, defaults=BulletinBoardServer.GROUPS)
+
+
+def wait_for_interrupt():
+    """Block until SIGINT (Ctrl+C)"""
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    while not stopping.wait(1):
+        pass
+
+
+def serve_broker(address, data_dir):
+    """Run a standalone broker that server nodes join with --cluster <address>, until SIGINT"""
+    messages = open_history(data_dir)
+    listener = BrokerListener(Broker(messages, open_groups(data_dir)), address)
+    listener.start()
+    logger.info('Broker listening on %s', address)
+    try:
+        wait_for_interrupt()
+    finally:
+        listener.close()
+        messages.close()
+
+
+def run_worker(number, broker_address, server_options, log_level, admin_port, profile_dir):
+    """Entry point of a worker process: serve clients on the shared port, linked to the broker"""
+    from server import BulletinBoardServer
+    from metrics import MetricsEndpoint
+
+    configure_logging(log_level)
+    server = BulletinBoardServer(**server_options, data_dir=None, reuse_port=True, profile_dir=profile_dir)
+    server.attach(SocketBackplane(broker_address, server))
+
+    # Every worker has its own metrics, on consecutive admin ports
+    if admin_port is not None:
+        admin = MetricsEndpoint('127.0.0.1', admin_port + number)
+        if profile_dir:
+            admin.route('/profile', server.profile_report)
+        admin.start()
+
+    server.run()
+
+
+def serve_workers(workers, server_options, data_dir, log_level='info', admin_port=None, profile_dir=None,
+                  broker_address=None):
+    """
+    Run the server as several worker processes sharing one port (SO_REUSEPORT), the kernel spreads
+    new connections over them so JSON encoding and dispatch use more than one core. Unless the workers
+    join the broker of a cluster (broker_address), this process runs their broker over a Unix socket
+    and owns the persisted history. The workers are stopped on SIGINT.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('Running several workers needs SO_REUSEPORT')
+
+    messages = listener = None
+    if broker_address is None:
+        messages = open_history(data_dir)
+        broker_address = os.path.join(tempfile.mkdtemp(prefix='bulletin-board-'), 'broker.sock')
+        listener = BrokerListener(Broker(messages, open_groups(data_dir)), broker_address)
+        listener.start()
+
+    # Workers are started fresh rather than forked, this process already runs threads
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, name=f'worker-{number}',
+                                 args=(number, broker_address, server_options, log_level, admin_port, profile_dir))
+                 for number in range(workers)]
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    for process in processes:
+        process.start()
+    logger.info('Started %d workers on port %s', workers, server_options.get('port'))
+
+    try:
+        while not stopping.wait(1):
+            if not any(process.is_alive() for process in processes):
+                break
+    finally:
+        # Let every worker shut down the way it would on Ctrl+C
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.kill()
+        if listener:
+            listener.close()
+            os.rmdir(os.path.dirname(broker_address))
+            messages.close()
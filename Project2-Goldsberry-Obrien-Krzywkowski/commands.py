@@ -0,0 +1,65 @@
+class Command:
+    """A registered command: its handler and the request fields the handler takes."""
+
+    __slots__ = ('name', 'handler', 'fields', 'blocking')
+
+    # How each type is described when a request field has the wrong one
+    TYPE_NAMES = {str: 'a string', int: 'an integer', dict: 'an object', list: 'a list'}
+
+    def __init__(self, name, handler, fields, blocking=False):
+        """Command constructor"""
+        self.name = name
+        self.handler = handler
+
+        # Whether the handler may wait on the disk or the broker of a cluster (see BulletinBoardServer.handle_request())
+        self.blocking = blocking
+
+        # Field name to the tuple of types it may have, None among them means the field may be left out
+        self.fields = {field: types if isinstance(types, tuple) else (types,) for field, types in fields.items()}
+
+    def validate(self, request):
+        """Check the request's fields against the command's schema, returning an error message or None"""
+        for field, types in self.fields.items():
+            value = request.get(field)
+            if value is None:
+                if None not in types:
+                    return f'Invalid request: {field} is required.'
+            elif type(value) not in types:
+                expected = ' or '.join(self.TYPE_NAMES.get(kind, kind.__name__) for kind in types if kind is not None)
+                return f'Invalid request: {field} must be {expected}.'
+        return None
+
+    def arguments(self, request):
+        """Pick the fields the handler takes out of the request, as keyword arguments"""
+        return {field: request.get(field) for field in self.fields}
+
+
+class CommandRegistry:
+    """
+    Table of every command the server understands.
+
+    Each command is registered with its handler and a schema: the request
+    fields (username, group, data) the handler takes and the types each may
+    have. A request is checked against the schema before its handler runs, and
+    only the listed fields are passed to the handler as keyword arguments, so
+    adding a command is a single register() call.
+    """
+
+    def __init__(self):
+        """CommandRegistry constructor"""
+        self.commands = {}
+
+    def register(self, name, handler, blocking=False, **fields):
+        """
+        Register a handler for a command, e.g. register('post', handler, username=(str, None), data=str).
+        blocking marks handlers that may wait on the disk or the broker of a cluster.
+        """
+        self.commands[name] = Command(name, handler, fields, blocking)
+
+    def get(self, name):
+        """Return the registered Command, or None if the command is unknown"""
+        return self.commands.get(name)
+
+    def __contains__(self, name):
+        """Whether a command is registered"""
+        return name in self.commands
@@ -0,0 +1,489 @@
+import queue
+import threading
+import sys
+import selectors
+from itertools import islice
+from socket import SHUT_RDWR
+import socket as socket_module
+from protocol import JSON
+from metrics import REGISTRY
+from logger import logger
+
+# Flag for sends that must not block, not every platform has it (e.g. Windows), in which case sends block
+DONTWAIT = getattr(socket_module, 'MSG_DONTWAIT', 0)
+
+# Most buffers a single sendmsg call may gather (the usual IOV_MAX)
+MAX_IOVECS = 1024
+
+# Traffic is counted once per read and once per batch handed to a writer, not per frame
+RECEIVED_BYTES = REGISTRY.counter('bulletin_received_bytes_total', 'Bytes of requests received from clients')
+SENT_BYTES = REGISTRY.counter('bulletin_sent_bytes_total', 'Bytes of responses and notifications handed to the writers')
+SLOW_CONSUMERS = REGISTRY.counter('bulletin_slow_consumer_events_total',
+                                  'Notifications dropped or coalesced and clients disconnected because their queue was full',
+                                  labels=('policy',))
+
+
+class Session:
+    """
+    Everything the server keeps about one connected client.
+
+    The session holds the client's username, the boards it is on and its
+    outbound queue, and wraps the raw socket (threaded engine) or the asyncio
+    stream (asyncio engine) behind the same small interface, so both engines
+    share every handler. Rosters refer to sessions rather than keeping their own
+    copies of sockets and usernames. Sessions use __slots__ and only allocate
+    what an idle client needs, so a server can hold 100k of them; footprint()
+    reports how much memory one takes.
+
+    Nothing is written on the caller's thread. Responses and notifications are
+    appended to a bounded outbound queue that a writer (a WriterPool thread or
+    the event loop) drains in the background, so a slow or stalled client never
+    holds up the thread that posted to it. Frames are queued by reference, a
+    broadcast is encoded once and the same bytes object sits in every
+    recipient's queue; writers hand the queued frames to the kernel as a list
+    (scatter I/O) instead of joining them into a per-client copy. While a batch
+    is open (the engine is working through pipelined requests that arrived
+    together) the queue is not drained, so all of the responses go out in a
+    single write when the batch is flushed.
+
+    A response too large to build in one piece (e.g. a long stretch of message
+    history) is streamed instead: the handler leaves a generator in stream that
+    queues one chunk each time it is advanced, and the engine only advances it
+    once the client has read enough of the previous chunks, so neither side
+    ever holds the whole response. No other request from the client is handled
+    until the stream is done.
+
+    When a notification would push the queue past max_queue_bytes the slow
+    consumer policy decides what happens:
+        drop        - the notification is discarded
+        disconnect  - the client is disconnected
+        coalesce    - every queued notification is replaced by a single notice
+                      saying how many were skipped
+    """
+
+    POLICIES = ('drop', 'disconnect', 'coalesce')
+    MAX_QUEUE_BYTES = 1024 * 1024
+
+    __slots__ = ('addr', 'username', 'boards', 'request_id', 'codec', 'outbox', 'queued_bytes', 'policy', 'max_queue_bytes',
+                 'dropped', 'skipped', 'batching', 'scheduled', 'closing', 'closed', 'lock', 'drained', 'stream',
+                 'token')
+
+    def __init__(self, addr, policy='disconnect', max_queue_bytes=MAX_QUEUE_BYTES):
+        """Session constructor to record the peer address and username"""
+
+        # Address of the remote client and the username it connected with (set on connect)
+        self.addr = addr
+        self.username = None
+
+        # Boards and groups the client is on (kept up to date by the Membership registry)
+        self.boards = set()
+
+        # ID of the request currently being handled, echoed back in its responses
+        self.request_id = None
+
+        # Encoding of everything sent to and received from the client (JSON until binary is negotiated on connect)
+        self.codec = JSON
+
+        # Outbound queue of (frame, is_notification) pairs and its size in bytes
+        self.outbox = []
+        self.queued_bytes = 0
+        self.policy = policy
+        self.max_queue_bytes = max_queue_bytes
+
+        # Notifications discarded (drop) or folded into a notice (coalesce)
+        self.dropped = 0
+        self.skipped = 0
+
+        # State of the queue, all guarded by the lock
+        self.batching = False
+        self.scheduled = False
+        self.closing = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+        # Signalled by the writer whenever it has sent something, only created once a reader
+        # has to wait for the queue to drain (see wait_for_room())
+        self.drained = None
+
+        # Rest of a streamed response, advanced a chunk at a time by the engine (None if there is none)
+        self.stream = None
+
+        # Token the client can resume its session with after losing the connection (issued on connect)
+        self.token = None
+
+    def begin_batch(self):
+        """Hold the queue back until flush() so responses to pipelined requests are written together"""
+        with self.lock:
+            self.batching = True
+
+    def flush(self):
+        """Stop batching and hand everything queued to the writer"""
+        with self.lock:
+            self.batching = False
+            schedule = self.claim()
+        if schedule:
+            self.schedule()
+
+    def claim(self):
+        """
+        Decide (with the lock held) whether the writer needs to be woken up.
+        Only one writer drains a connection at a time, which keeps frames in order.
+        """
+        if self.scheduled or self.batching or self.closed:
+            return False
+        if self.outbox or self.skipped or self.closing:
+            self.scheduled = True
+            return True
+        return False
+
+    def send(self, data, codec=None):
+        """
+        Queue a response for the client.
+        Responses are never dropped, instead the engine stops reading requests from a
+        client whose queue is full until it catches up (see wait_for_room()).
+        If a codec is given the client is switched to it right after this response,
+        under the same lock, so no notification is queued in between in the wrong encoding.
+        """
+        with self.lock:
+            if self.closed or self.closing:
+                return 0
+            self.outbox.append((data, False))
+            self.queued_bytes += len(data)
+            if codec is not None:
+                self.codec = codec
+            schedule = self.claim()
+
+        if schedule:
+            self.schedule()
+        return len(data)
+
+    def sendall(self, data):
+        """Queue all of the encoded bytes for the client"""
+        self.send(data)
+
+    def notify(self, encode):
+        """
+        Queue a notification for the client, applying the slow consumer policy if the queue is full.
+        encode is called with the client's codec (under the lock, so the encoding can not change
+        underneath it) and returns the encoded frame, see BulletinBoardServer.notify().
+        Returns True if the notification was queued.
+        """
+        schedule = False
+        with self.lock:
+            if self.closed or self.closing:
+                return False
+            data = encode(self.codec)
+
+            full = self.queued_bytes + self.backlog() + len(data) > self.max_queue_bytes
+            if not full:
+                self.outbox.append((data, True))
+                self.queued_bytes += len(data)
+                schedule = self.claim()
+
+            elif self.policy == 'drop':
+                self.dropped += 1
+
+            elif self.policy == 'coalesce':
+                # Fold every queued notification (and this one) into a single "skipped" notice
+                responses = [entry for entry in self.outbox if not entry[1]]
+                self.skipped += len(self.outbox) - len(responses) + 1
+                self.outbox = responses
+                self.queued_bytes = sum(len(frame) for frame, _ in responses)
+                schedule = self.claim()
+
+        if full:
+            SLOW_CONSUMERS.inc(labels=(self.policy,))
+        if full and self.policy == 'disconnect':
+            logger.warning('Disconnecting slow client %s', self.username or self.addr)
+            self.abort()
+        if schedule:
+            self.schedule()
+        return not full
+
+    def full(self, limit=None):
+        """Whether the queue (including what the writer is still sending) is over limit bytes (its own limit by default)"""
+        return self.queued_bytes + self.backlog() > (self.max_queue_bytes if limit is None else limit)
+
+    def wait_for_room(self, limit=None):
+        """Block until the writer has brought the queue under limit bytes, its own limit by default (or the connection closed)"""
+        with self.lock:
+            while self.full(limit) and not self.closed:
+                if self.drained is None:
+                    self.drained = threading.Condition(self.lock)
+                self.drained.wait(1)
+
+    def wake(self):
+        """Wake a reader waiting in wait_for_room() (called with the lock held)"""
+        if self.drained is not None:
+            self.drained.notify_all()
+
+    def take(self):
+        """
+        Remove and return every queued frame (called by the writer).
+        Returns None, and marks the connection as no longer scheduled, if there is nothing to write.
+        """
+        with self.lock:
+            if not self.outbox and not self.skipped:
+                self.scheduled = False
+                return None
+
+            frames = [frame for frame, _ in self.outbox]
+            self.outbox = []
+            self.queued_bytes = 0
+            self.wake()
+
+            # Tell a coalesced client how much it missed before anything else
+            if self.skipped:
+                notice = f'{self.skipped} notifications were skipped because the connection could not keep up.'
+                frames.insert(0, self.codec.encode_request("notify", data=notice))
+                self.skipped = 0
+
+        SENT_BYTES.inc(sum(len(frame) for frame in frames))
+        return frames
+
+    def finish(self):
+        """Close the transport if a close was requested, once the queue has been written (called by the writer)"""
+        with self.lock:
+            if not self.closing or self.closed or self.outbox:
+                return
+            self.closed = True
+        self.shutdown()
+
+    def close(self):
+        """Close the connection once everything already queued has been written"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closing = True
+            self.batching = False
+            schedule = self.claim()
+        if schedule:
+            self.schedule()
+
+    def abort(self):
+        """Drop everything queued and close the connection immediately"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.outbox = []
+            self.queued_bytes = 0
+            self.wake()
+        self.shutdown()
+
+    def backlog(self):
+        """Bytes already handed to the writer but not yet sent"""
+        return 0
+
+    def footprint(self):
+        """Approximate number of bytes the session takes up while idle (the object, its containers and its lock)"""
+        return sys.getsizeof(self) + sys.getsizeof(self.boards) + sys.getsizeof(self.outbox) + sys.getsizeof(self.lock)
+
+    def schedule(self):
+        """Wake the writer to drain this connection"""
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Close the underlying transport"""
+        raise NotImplementedError
+
+
+class WriterPool:
+    """
+    Small pool of threads that drain the outbound queues of SocketConnections.
+
+    Sends never block a writer: a socket whose kernel buffer is full is parked
+    with a selector until it becomes writable again, so a handful of threads
+    can serve every connection and a stalled client only ever delays itself.
+    """
+
+    WORKERS = 4
+
+    def __init__(self, workers=WORKERS):
+        """WriterPool constructor, starts the writer and poller threads"""
+        self.ready = queue.SimpleQueue()
+
+        # Parked sockets waiting to become writable, and a socket pair to interrupt the poller when one is added
+        self.selector = selectors.DefaultSelector()
+        self.parked = queue.SimpleQueue()
+        self.wakeup_reader, self.wakeup_writer = socket_module.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+        for number in range(workers):
+            threading.Thread(target=self.work, name=f'writer-{number}', daemon=True).start()
+        threading.Thread(target=self.poll, name='writer-poller', daemon=True).start()
+
+    def schedule(self, connection):
+        """Queue a connection to be drained by the next free writer"""
+        self.ready.put(connection)
+
+    def park(self, connection):
+        """Wait for a connection's socket to become writable before draining it again"""
+        self.parked.put(connection)
+        self.wakeup_writer.send(b'\0')
+
+    def work(self):
+        """Drain connections as they become ready"""
+        while True:
+            connection = self.ready.get()
+            try:
+                connection.drain(self)
+            except Exception as e:
+                logger.error('Error writing to client %s: %s', connection.addr, e)
+                connection.abort()
+
+    def poll(self):
+        """Reschedule parked connections once their sockets become writable"""
+        while True:
+            for key, _ in self.selector.select(timeout=1):
+                if key.fileobj is self.wakeup_reader:
+                    try:
+                        self.wakeup_reader.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                self.schedule(key.data)
+
+            # Start watching newly parked connections
+            while not self.parked.empty():
+                connection = self.parked.get()
+                try:
+                    self.selector.register(connection.socket, selectors.EVENT_WRITE, connection)
+                except (ValueError, OSError, KeyError):
+                    # The socket was closed (or is already being watched) in the meantime
+                    self.schedule(connection)
+
+
+class SocketConnection(Session):
+    """Session backed by a blocking socket, used by the threaded engine."""
+
+    __slots__ = ('socket', 'writers', 'unsent', 'unsent_bytes')
+
+    def __init__(self, client_socket, addr, writers, **options):
+        """SocketConnection constructor"""
+        super().__init__(addr, **options)
+        self.socket = client_socket
+        self.writers = writers
+
+        # Frames (or the remainder of one) the socket has not taken yet, only touched by the writer draining it
+        self.unsent = []
+        self.unsent_bytes = 0
+
+    def recv_into(self, buffer):
+        """Receive bytes from the client socket directly into a buffer"""
+        return self.socket.recv_into(buffer)
+
+    def backlog(self):
+        """Bytes of the current write the socket has not accepted yet"""
+        return self.unsent_bytes
+
+    def schedule(self):
+        """Hand the connection to the writer pool"""
+        self.writers.schedule(self)
+
+    def drain(self, writers):
+        """Write queued frames until the queue is empty or the socket would block"""
+        while not self.closed:
+            if not self.unsent:
+                frames = self.take()
+                if frames is None:
+                    self.finish()
+                    return
+                self.unsent.extend(frames)
+                self.unsent_bytes = sum(len(frame) for frame in frames)
+
+            # Send as much as the socket takes without blocking
+            try:
+                sent = self.write()
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.abort()
+                return
+
+            if sent:
+                self.consume(sent)
+                with self.lock:
+                    self.wake()
+            if self.unsent:
+                # The kernel buffer is full, come back when the client has read some of it
+                writers.park(self)
+                return
+
+    def write(self):
+        """Hand the unsent frames to the socket in one call and return the number of bytes it took"""
+        if hasattr(self.socket, 'sendmsg'):
+            return self.socket.sendmsg(list(islice(self.unsent, MAX_IOVECS)), (), DONTWAIT)
+
+        # No scatter I/O on this platform (e.g. Windows), fall back to a single joined buffer
+        return self.socket.send(b''.join(self.unsent), DONTWAIT)
+
+    def consume(self, sent):
+        """Drop the frames the socket has taken and keep the rest of a partly sent one"""
+        self.unsent_bytes -= sent
+        done = 0
+        while sent and sent >= len(self.unsent[done]):
+            sent -= len(self.unsent[done])
+            done += 1
+        del self.unsent[:done]
+        if sent:
+            self.unsent[0] = memoryview(self.unsent[0])[sent:]
+
+    def shutdown(self):
+        """Close the underlying socket, waking the thread blocked reading from it"""
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class StreamConnection(Session):
+    """
+    Session backed by an asyncio stream, used by the asyncio engine.
+
+    A handler that may block (see Command.blocking) is not run on the event
+    loop, it is left in deferred and the engine runs it on a thread before
+    reading the client's next request.
+    """
+
+    __slots__ = ('writer', 'loop', 'loop_thread', 'deferred')
+
+    def __init__(self, writer, loop, **options):
+        """StreamConnection constructor"""
+        super().__init__(writer.get_extra_info('peername'), **options)
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+
+        # Blocking handler call waiting to be run off the event loop (None if there is none)
+        self.deferred = None
+
+    def backlog(self):
+        """Bytes sitting in the transport's write buffer"""
+        return self.writer.transport.get_write_buffer_size()
+
+    def schedule(self):
+        """Drain the queue on the event loop (writes on an asyncio transport never block)"""
+        if threading.get_ident() == self.loop_thread:
+            self.loop.call_soon(self.drain)
+        else:
+            self.loop.call_soon_threadsafe(self.drain)
+
+    def drain(self):
+        """Move everything queued onto the transport, handing it the frames as a list rather than one joined copy"""
+        while not self.closed:
+            frames = self.take()
+            if frames is None:
+                self.finish()
+                return
+            self.writer.writelines(frames)
+
+    def shutdown(self):
+        """Close the stream (safe to call more than once)"""
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.shutdown)
+        elif not self.writer.is_closing():
+            self.writer.close()
@@ -0,0 +1,258 @@
+import os
+import json
+from time import time
+from locks import InstrumentedLock
+from logger import logger
+from sorted_index import SortedIndex
+
+
+class Group:
+    """A private group: its name, who created it (None for the built-in groups) and when."""
+
+    __slots__ = ('name', 'creator', 'created')
+
+    def __init__(self, name, creator=None, created=None):
+        """Group constructor"""
+        self.name = name
+        self.creator = creator
+        self.created = created or time()
+
+    def to_dict(self):
+        """The group as stored in the registry file"""
+        return {'name': self.name, 'creator': self.creator, 'created': self.created}
+
+
+class GroupRegistry:
+    """
+    Every private group on the server, created and deleted at runtime.
+
+    Groups are spread over a fixed number of shards by the hash of their name,
+    each with its own lock, so creating or looking up groups never contends on
+    a single lock no matter how many thousands of groups there are. Only the
+    name, creator and creation time are kept here: a group's history and
+    roster are allocated when it is first used (see MessageStore and
+    Membership) and dropped again while it is idle.
+
+    A sorted index of the names is kept next to the shards so the group list
+    can be paged through (and filtered by prefix) without sorting or joining
+    every name. If a path is given the registry is saved there and loaded on
+    startup: every change is appended to a journal next to the file, and the
+    file is only rewritten once the journal has grown as long as the registry
+    (or on startup), so a change costs the same however many groups there are.
+    """
+
+    SHARDS = 16
+
+    # Journal entries the registry file is only rewritten after, even for a small registry
+    COMPACT_AFTER = 1000
+
+    # Longest group name that can be created, and names no group can have (the board, and the path components
+    # for the current and parent directory, which a group's files must never be written to)
+    MAX_NAME_LENGTH = 64
+    RESERVED_NAMES = ('public board', '.', '..')
+
+    def __init__(self, path=None, defaults=(), shards=SHARDS):
+        """GroupRegistry constructor, loading the saved groups or creating the defaults"""
+        self.path = path
+        self.shards = [({}, InstrumentedLock(f'groups:{number}')) for number in range(shards)]
+
+        # Sorted names, its lock guards the registry file as well
+        self.names = SortedIndex()
+        self.index_lock = InstrumentedLock('groups:index')
+
+        # Changes since the registry file was last written, open for appending once one is made
+        self.journal = None
+        self.journal_entries = 0
+
+        saved = self.load()
+        for group in saved if saved is not None else (Group(name) for name in defaults):
+            self.insert(group)
+        self.save()
+
+    def shard(self, name):
+        """Return the (groups, lock) shard a group name belongs to"""
+        return self.shards[hash(name) % len(self.shards)]
+
+    def __contains__(self, name):
+        """Whether a group with the given name exists"""
+        return name in self.shard(name)[0]
+
+    def __len__(self):
+        """Number of groups"""
+        return len(self.names)
+
+    def get(self, name):
+        """Return the Group with the given name, or None"""
+        return self.shard(name)[0].get(name)
+
+    def insert(self, group):
+        """Add a group, returns False if one with the same name already exists"""
+        groups, lock = self.shard(group.name)
+        with lock:
+            if group.name in groups:
+                return False
+            groups[group.name] = group
+        with self.index_lock:
+            self.names.add(group.name)
+        return True
+
+    @classmethod
+    def valid_name(cls, name):
+        """Whether a group can be created with the given (already cleaned up) name"""
+        return 0 < len(name) <= cls.MAX_NAME_LENGTH and name.isprintable() and name not in cls.RESERVED_NAMES
+
+    def create(self, name, creator):
+        """Create a group, returns the new Group or None if the name is taken"""
+        group = Group(name, creator)
+        if not self.insert(group):
+            return None
+        self.record(name)
+        return group
+
+    def delete(self, name):
+        """Delete a group, returns the deleted Group or None if there was no such group"""
+        groups, lock = self.shard(name)
+        with lock:
+            group = groups.pop(name, None)
+        if group is None:
+            return None
+        with self.index_lock:
+            self.names.remove(name)
+        self.record(name)
+        return group
+
+    def page(self, after=None, limit=50, prefix=''):
+        """
+        Return (names, next) for up to limit group names starting with prefix in alphabetical order,
+        starting after the given name. next is the name to continue after, or None on the last page.
+        """
+        with self.index_lock:
+            return self.names.page(after, limit, prefix)
+
+    def count(self, prefix=''):
+        """Number of groups whose name starts with prefix"""
+        with self.index_lock:
+            return self.names.count(prefix)
+
+    def all(self):
+        """Return every group, sorted by name"""
+        with self.index_lock:
+            names = list(self.names)
+        return [group for group in map(self.get, names) if group]
+
+    def reset(self, groups):
+        """Replace every group with the given ones (e.g. the registry of a cluster's broker)"""
+        for shard, lock in self.shards:
+            with lock:
+                shard.clear()
+        with self.index_lock:
+            self.names.clear()
+        for group in groups:
+            self.insert(group)
+        self.save()
+
+    @property
+    def journal_path(self):
+        """Path of the journal of changes made since the registry file was written"""
+        return f'{self.path}.journal'
+
+    def load(self):
+        """
+        Read the saved groups and replay the journal over them, None if nothing was saved yet.
+        A registry file that can not be read is set aside and treated as missing, a torn
+        write at the end of the journal is ignored.
+        """
+        if not self.path:
+            return None
+
+        groups = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as saved:
+                    groups = {entry['name']: Group(entry['name'], entry.get('creator'), entry.get('created'))
+                              for entry in json.load(saved)}
+            except (ValueError, TypeError, KeyError) as e:
+                logger.error('Group registry %s can not be read, setting it aside: %s', self.path, e)
+                os.replace(self.path, f'{self.path}.corrupt')
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning('Ignoring torn write at the end of %s', self.journal_path)
+                        break
+                    groups = groups if groups is not None else {}
+                    if entry.get('deleted'):
+                        groups.pop(entry['name'], None)
+                    else:
+                        groups[entry['name']] = Group(entry['name'], entry.get('creator'), entry.get('created'))
+
+        return None if groups is None else list(groups.values())
+
+    def record(self, name):
+        """
+        Append the current state of a group to the journal, rewriting the registry file instead
+        once the journal is as long as the registry. The state is read under the journal's lock,
+        so of concurrent changes to the same group the last one written is the one that stuck.
+        """
+        if not self.path:
+            return
+        with self.index_lock:
+            if self.journal_entries >= max(self.COMPACT_AFTER, len(self.names)):
+                self.write()
+                return
+
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'ab')
+                sync_directory(self.journal_path)
+            group = self.get(name)
+            entry = group.to_dict() if group else {'name': name, 'deleted': True}
+            self.journal.write(json.dumps(entry).encode() + b'\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_entries += 1
+
+    def save(self):
+        """Write the whole registry to its file and empty the journal"""
+        if not self.path:
+            return
+        with self.index_lock:
+            self.write()
+
+    def write(self):
+        """
+        Write the registry file atomically and durably (through a synced temporary file that
+        replaces it), then empty the journal. The caller holds index_lock.
+        """
+        groups = [group.to_dict() for group in map(self.get, self.names) if group]
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as saved:
+            json.dump(groups, saved)
+            saved.flush()
+            os.fsync(saved.fileno())
+        os.replace(temporary, self.path)
+        sync_directory(self.path)
+
+        # The journal is only emptied once the file holds every change in it
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'ab')
+            sync_directory(self.journal_path)
+        self.journal.truncate(0)
+        os.fsync(self.journal.fileno())
+        self.journal_entries = 0
+
+    def locks(self):
+        """Return the lock of every shard and of the index"""
+        return [self.index_lock, *(lock for _, lock in self.shards)]
+
+
+def sync_directory(path):
+    """fsync the directory a file is in, so a file created or renamed in it survives a crash"""
+    descriptor = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
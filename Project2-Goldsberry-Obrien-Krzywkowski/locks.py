@@ -0,0 +1,61 @@
+import threading
+from time import perf_counter
+
+
+class InstrumentedLock:
+    """
+    Lock that keeps track of how it is used.
+
+    Every acquisition records how long the caller waited for the lock and how
+    long it was held, so contention on the shared server state can be seen
+    (see stats()). Use it as a context manager just like threading.Lock.
+    """
+
+    def __init__(self, name):
+        """InstrumentedLock constructor"""
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_at = 0.0
+
+        # Counters, only updated while the lock is held
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.hold_time = 0.0
+        self.max_hold = 0.0
+
+    def __enter__(self):
+        """Acquire the lock, timing the wait if another thread holds it"""
+        if self.lock.acquire(blocking=False):
+            waited = 0.0
+        else:
+            started = perf_counter()
+            self.lock.acquire()
+            waited = perf_counter() - started
+            self.contended += 1
+
+        self.acquisitions += 1
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.acquired_at = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Release the lock and record how long it was held"""
+        held = perf_counter() - self.acquired_at
+        self.hold_time += held
+        self.max_hold = max(self.max_hold, held)
+        self.lock.release()
+
+    def stats(self):
+        """Return a dictionary describing how the lock has been used so far"""
+        return {
+            'name': self.name,
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait_seconds': self.wait_time,
+            'max_wait_seconds': self.max_wait,
+            'hold_seconds': self.hold_time,
+            'max_hold_seconds': self.max_hold,
+        }
@@ -0,0 +1,36 @@
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# Logger every server module writes to
+logger = logging.getLogger('bulletin_board')
+
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+
+def configure(level='info', stream=None):
+    """
+    Send the server's log records to a stream (stdout by default) at the given level.
+
+    Handlers only put the record on a queue, a background thread formats and
+    writes it, so logging never blocks a handler on a slow terminal or pipe.
+    Records below the level are discarded before any formatting happens, which
+    is why log calls pass their arguments separately instead of as f-strings.
+    """
+    records = queue.SimpleQueue()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = QueueListener(records, output)
+
+    logger.handlers.clear()
+    logger.addHandler(QueueHandler(records))
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    # Write out whatever is still queued when the process exits
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
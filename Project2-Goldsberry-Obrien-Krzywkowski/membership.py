@@ -0,0 +1,230 @@
+from locks import InstrumentedLock
+from sorted_index import SortedIndex
+
+
+class Roster:
+    """
+    Members of a single board or group.
+
+    Members are the sessions themselves, kept as the keys of a dictionary
+    mapping each to the username it joined with, so joining, leaving and
+    membership checks are O(1). The usernames of local and remote members are
+    also kept in a sorted index, so the user list is paged through and
+    filtered by prefix without sorting or joining every name.
+    """
+
+    def __init__(self, name):
+        """Roster constructor"""
+        self.name = name
+        self.members = {}
+
+        # Clients of the other nodes of a cluster: (node, username) to how many are on the board
+        self.remote = {}
+
+        # Every username on the board (here and on other nodes) in sorted order
+        self.usernames = SortedIndex()
+
+        # Guards the members, never held while taking another roster's lock
+        self.lock = InstrumentedLock(f'roster:{name}')
+
+        # Set once the roster was dropped from the registry (it was empty), joins then use a new one
+        self.retired = False
+
+
+class Membership:
+    """
+    Registry of the connected clients and of who is on every board and group.
+
+    Every session carries the set of boards it is on (a reverse index), so a
+    disconnecting client is only removed from the rosters it is actually in
+    instead of every roster on the server being scanned. Rosters are created
+    when the first client joins a board and dropped again by sweep() once they
+    are empty, so groups nobody is in cost nothing.
+    """
+
+    def __init__(self, boards=()):
+        """Membership constructor, creating an empty roster for each given board name up front"""
+        self.clients = {}
+
+        # Called with (board, username, change) whenever a local client joins (1) or leaves (-1) a board
+        self.observer = None
+        self.clients_lock = InstrumentedLock('roster:clients')
+
+        # Guards creating and dropping rosters, never held while taking a roster's lock
+        self.rosters_lock = InstrumentedLock('roster:rosters')
+        self.rosters = {board: Roster(board) for board in boards}
+        self.permanent = set(boards)
+
+    def __contains__(self, board):
+        """Whether the given board or group currently has a roster"""
+        return board in self.rosters
+
+    def roster(self, board, create=True):
+        """Return the Roster of a board, creating it if needed (None if create is False and it has none)"""
+        roster = self.rosters.get(board)
+        if roster is None and create:
+            with self.rosters_lock:
+                roster = self.rosters.get(board)
+                if roster is None:
+                    roster = self.rosters[board] = Roster(board)
+        return roster
+
+    def sweep(self):
+        """Drop the rosters of boards nobody is on anymore (here or on another node), returns how many"""
+        dropped = 0
+        for board, roster in list(self.rosters.items()):
+            if board in self.permanent or roster.members or roster.remote:
+                continue
+            with roster.lock:
+                if roster.members or roster.remote:
+                    continue
+                roster.retired = True
+            with self.rosters_lock:
+                if self.rosters.get(board) is roster:
+                    del self.rosters[board]
+                    dropped += 1
+        return dropped
+
+    def connect(self, session):
+        """Register the session of a newly accepted connection"""
+        with self.clients_lock:
+            self.clients[session] = None
+
+    def join(self, board, session, announce=True):
+        """
+        Add a session to a board, returns False if it was already a member. With announce False the
+        observer is not called, the caller does so with announce() once it holds no locks the observer
+        could be waiting on.
+        """
+        while True:
+            roster = self.roster(board)
+            with roster.lock:
+                # Swept away while waiting for the lock, the next roster() call creates a new one
+                if roster.retired:
+                    continue
+                if session in roster.members:
+                    return False
+                roster.members[session] = session.username
+                if session.username:
+                    roster.usernames.add(session.username)
+            break
+        session.boards.add(board)
+        if announce:
+            self.announce(board, session.username, 1)
+        return True
+
+    def announce(self, board, username, change):
+        """Tell the observer a local client joined (change 1) or left (change -1) a board"""
+        if self.observer:
+            self.observer(board, username, change)
+
+    def leave(self, board, session):
+        """Remove a session from a board, returns False if it was not a member"""
+        roster = self.roster(board, create=False)
+        if roster is None:
+            return False
+        with roster.lock:
+            if session not in roster.members:
+                return False
+            username = roster.members.pop(session)
+            if username:
+                roster.usernames.remove(username)
+        session.boards.discard(board)
+        self.announce(board, username, -1)
+        return True
+
+    def drop(self, board):
+        """
+        Remove every session from a board that is going away and return them. The observer is not
+        called, every node of a cluster drops the board's members itself.
+        """
+        roster = self.roster(board, create=False)
+        if roster is None:
+            return []
+        with roster.lock:
+            members = list(roster.members)
+            roster.members.clear()
+            roster.remote.clear()
+            roster.usernames.clear()
+        for session in members:
+            session.boards.discard(board)
+        return members
+
+    def is_member(self, board, session):
+        """Whether the session is on the given board"""
+        return board in session.boards
+
+    def members(self, board=None):
+        """
+        Return a snapshot of the sessions on a board (every connected client if board is None).
+        Taken under the roster's lock so callers can iterate it while other threads join and leave.
+        """
+        if board is None:
+            with self.clients_lock:
+                return list(self.clients)
+
+        roster = self.roster(board, create=False)
+        if roster is None:
+            return []
+        with roster.lock:
+            return list(roster.members)
+
+    def page(self, board, after=None, limit=50, prefix=''):
+        """
+        Return (usernames, next, total) for one page of the distinct usernames on a board (here and on
+        the other nodes of a cluster) that start with prefix, in alphabetical order after the given
+        name. next is the name to continue after (None on the last page), total counts every match.
+        """
+        roster = self.roster(board, create=False)
+        if roster is None:
+            return [], None, 0
+        with roster.lock:
+            usernames, cursor = roster.usernames.page(after, limit, prefix)
+            return usernames, cursor, roster.usernames.count(prefix)
+
+    def count(self, board, prefix=''):
+        """Number of distinct usernames on a board starting with prefix"""
+        roster = self.roster(board, create=False)
+        if roster is None:
+            return 0
+        with roster.lock:
+            return roster.usernames.count(prefix)
+
+    def remote_change(self, board, node, username, change):
+        """Record that a client of another node joined (change > 0) or left (change < 0) a board"""
+        key = (node, username)
+        while True:
+            roster = self.roster(board)
+            with roster.lock:
+                if roster.retired:
+                    continue
+                previous = roster.remote.get(key, 0)
+                count = max(previous + change, 0)
+                if count:
+                    roster.remote[key] = count
+                else:
+                    roster.remote.pop(key, None)
+                if count > previous:
+                    roster.usernames.add(username, count - previous)
+                elif count < previous:
+                    roster.usernames.remove(username, previous - count)
+            return
+
+    def remote_gone(self, node):
+        """Drop every client of a node that went away from the rosters"""
+        for roster in list(self.rosters.values()):
+            with roster.lock:
+                for key in [key for key in roster.remote if key[0] == node]:
+                    roster.usernames.remove(key[1], roster.remote.pop(key))
+
+    def disconnect(self, session):
+        """Remove a session from every board it is on and from the connected clients (safe to repeat)"""
+        for board in list(session.boards):
+            self.leave(board, session)
+
+        with self.clients_lock:
+            self.clients.pop(session, None)
+
+    def locks(self):
+        """Return the lock of the connected clients and of every roster"""
+        return [self.clients_lock, self.rosters_lock, *(roster.lock for roster in list(self.rosters.values()))]
@@ -0,0 +1,417 @@
+import os
+import json
+import mmap
+import shutil
+import struct
+import bisect
+import threading
+from urllib.parse import quote, unquote
+from logger import logger
+
+# Every entry of a segment's offset index is the byte offset of one message, as a little-endian uint64
+OFFSET = struct.Struct('<Q')
+
+
+def directory_name(board):
+    """
+    Name of a board's directory inside the log directory: the percent-encoded board name with dots
+    encoded too, so it is never '.' or '..' and never collides with a file next to the boards (those
+    all have an extension, e.g. groups.json)
+    """
+    return quote(board, safe='').replace('.', '%2E')
+
+
+class MappedFile:
+    """
+    Read-only memory map of a file that may still be growing.
+
+    The map is recreated whenever a read needs bytes past its current end. Old
+    maps are not closed explicitly, a reader may still be slicing one, they are
+    released once nothing refers to them anymore.
+    """
+
+    def __init__(self, path):
+        """MappedFile constructor"""
+        self.path = path
+        self.map = None
+
+    def view(self, end):
+        """Return a map covering at least the first end bytes of the file"""
+        current = self.map
+        if current is None or len(current) < end:
+            with open(self.path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size < end:
+                    raise ValueError(f'{self.path} is shorter than {end} bytes')
+                current = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.map = current
+        return current
+
+
+class BoardLog:
+    """
+    On-disk files of a single board inside the log directory.
+
+    Messages are appended as JSON lines to segment files named after the ID of
+    the first message they hold. Next to every segment an offset index holds the
+    byte offset of each of its messages, so message N is found by picking the
+    segment from the file names, reading entry N - base of its index and
+    slicing the line out of the memory-mapped segment. Nothing but the list of
+    segment base IDs is kept on the Python heap.
+    """
+
+    def __init__(self, directory, name):
+        """BoardLog constructor"""
+        self.name = name
+        self.directory = directory
+
+        # Base IDs of every segment, oldest first, and their memory maps (opened on first read)
+        self.segments = []
+        self.maps = {}
+
+        # Active segment and its offset index, open for appending
+        self.file = None
+        self.index = None
+        self.size = 0
+        self.dirty = False
+
+        # Newest message written to the log, and newest message known to be synced to disk
+        self.count = 0
+        self.committed_id = 0
+
+    def segment_path(self, base_id):
+        """Path of the segment file whose first message has the given ID"""
+        return os.path.join(self.directory, f'{base_id:020d}.log')
+
+    def index_path(self, base_id):
+        """Path of the offset index of a segment"""
+        return os.path.join(self.directory, f'{base_id:020d}.idx')
+
+    def open_segment(self, base_id):
+        """Open (or continue) the segment that starts at the given message ID for appending"""
+        self.close()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.file = open(self.segment_path(base_id), 'ab')
+        self.index = open(self.index_path(base_id), 'ab')
+        self.size = self.file.tell()
+
+        if not self.segments or self.segments[-1] != base_id:
+            self.segments.append(base_id)
+
+    def write(self, message_id, line, segment_size):
+        """Append one serialized message, rolling over to a new segment when the active one is full"""
+        if self.file is None or self.size >= segment_size:
+            if self.file is not None:
+                # Seal the full segment on disk before starting the next one
+                for file in (self.file, self.index):
+                    file.flush()
+                    os.fsync(file.fileno())
+            self.open_segment(message_id)
+
+        self.index.write(OFFSET.pack(self.size))
+        self.file.write(line)
+        self.size += len(line)
+        self.count = message_id
+        self.dirty = True
+
+    def sync(self):
+        """Flush and fsync everything written since the last sync, making it readable"""
+        if self.dirty:
+            for file in (self.file, self.index):
+                file.flush()
+                os.fsync(file.fileno())
+            self.dirty = False
+        self.committed_id = self.count
+
+    def close(self):
+        """Close the active segment and its index"""
+        for file in (self.file, self.index):
+            if file:
+                file.close()
+        self.file = None
+        self.index = None
+
+    def mapped(self, base_id):
+        """Return the memory maps of a segment and its offset index"""
+        maps = self.maps.get(base_id)
+        if maps is None:
+            maps = (MappedFile(self.segment_path(base_id)), MappedFile(self.index_path(base_id)))
+            self.maps[base_id] = maps
+        return maps
+
+    def read_range(self, start, end):
+        """Read the committed messages with IDs from start to end (inclusive) from disk"""
+        records = []
+        end = min(end, self.committed_id)
+        message_id = max(start, 1)
+
+        while message_id <= end:
+            # Find the segment holding the message and how far into it the range goes
+            position = bisect.bisect_right(self.segments, message_id) - 1
+            base_id = self.segments[position]
+            last_id = end
+            if position + 1 < len(self.segments):
+                last_id = min(end, self.segments[position + 1] - 1)
+
+            # Look up where the first message starts and where the last one ends
+            segment, index = self.mapped(base_id)
+            first_entry, last_entry = message_id - base_id, last_id - base_id
+            offsets = index.view((last_entry + 1) * OFFSET.size)
+            begin = OFFSET.unpack_from(offsets, first_entry * OFFSET.size)[0]
+            finish = OFFSET.unpack_from(offsets, last_entry * OFFSET.size)[0]
+
+            # Slice the lines straight out of the mapped segment
+            data = segment.view(finish + 1)
+            stop = data.find(b'\n', finish)
+            if stop == -1:
+                # The map was made while the last line was only partly written, map it again
+                data = segment.view(len(data) + 1)
+                stop = data.find(b'\n', finish)
+            records.extend(json.loads(line) for line in data[begin:stop].split(b'\n'))
+
+            message_id = last_id + 1
+
+        return records
+
+    def read(self, message_id):
+        """Read a single committed message from disk, or None if it is not there"""
+        records = self.read_range(message_id, message_id)
+        return records[0] if records else None
+
+    def load(self):
+        """
+        Find the board's segments and make the offset index of the newest one match its log.
+        Only the tail written after the last indexed message is scanned, a torn
+        write at the very end is cut off.
+        """
+        if os.path.isdir(self.directory):
+            self.segments = sorted(int(entry[:-4]) for entry in os.listdir(self.directory) if entry.endswith('.log'))
+
+        # Sealed segments and their indexes were synced before the next segment was started,
+        # only the newest one can have been cut short by a crash
+        if self.segments:
+            base_id = self.segments[-1]
+            self.count = base_id + self.repair_segment(base_id) - 1
+
+        self.committed_id = self.count
+        if self.segments:
+            self.open_segment(self.segments[-1])
+
+    def repair_segment(self, base_id):
+        """Bring a segment's offset index up to date with its log and return the number of messages"""
+        log_path, index_path = self.segment_path(base_id), self.index_path(base_id)
+
+        # Read the existing index, ignoring a partially written trailing entry
+        offsets = b''
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as index:
+                offsets = index.read()
+        entries = len(offsets) // OFFSET.size
+        position = 0
+        added = []
+
+        with open(log_path, 'rb') as segment:
+            if entries:
+                # Re-check the last indexed message, it may have been torn after its entry was written
+                position = OFFSET.unpack_from(offsets, (entries - 1) * OFFSET.size)[0]
+                entries -= 1
+            segment.seek(position)
+
+            # Index every complete message after the last indexed one
+            for line in segment:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete record')
+                    json.loads(line)
+                except ValueError:
+                    # Cut the torn write off so new messages are appended after the last good one
+                    logger.warning('Truncating torn write at the end of %s', log_path)
+                    with open(log_path, 'r+b') as torn:
+                        torn.truncate(position)
+                    break
+
+                added.append(OFFSET.pack(position))
+                position += len(line)
+
+        # Rewrite the index tail to match the log
+        with open(index_path, 'r+b' if os.path.exists(index_path) else 'wb') as index:
+            index.truncate(entries * OFFSET.size)
+            index.seek(entries * OFFSET.size)
+            index.write(b''.join(added))
+            index.flush()
+            os.fsync(index.fileno())
+
+        return entries + len(added)
+
+
+class MessageLog:
+    """
+    Persistent, append-only log of every board's message history.
+
+    Posting threads only queue messages, a single commit thread writes whatever
+    has queued up since its last pass and fsyncs each touched segment once for
+    the whole batch (group commit). Posters wait for their batch (see wait())
+    before the post is acknowledged, every poster that queued up during the
+    previous sync shares the next one, so post throughput is not bound by disk
+    sync latency. If a batch can not be written the log stops: nothing queued
+    after it is written either and every poster waiting on it gets an error.
+    Old messages are read back through memory maps of the segments, so the
+    server's memory does not grow with the size of the history. A board's files
+    are only opened when the board is first used (see open()), and can be
+    released again while it is idle.
+    """
+
+    SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        """MessageLog constructor, starts the commit thread"""
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        # Files of each board that is in use, keyed by board name
+        self.boards = {}
+        self.boards_lock = threading.Lock()
+
+        # Work queued for the commit thread and sequence numbers used by wait()
+        self.condition = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.committed = 0
+        self.closed = False
+
+        # Error that stopped the log (None while it works), committed never moves past the failed batch
+        self.error = None
+
+        self.thread = threading.Thread(target=self.commit_loop, name='message-log', daemon=True)
+        self.thread.start()
+
+    def append(self, board, record):
+        """
+        Queue a message for the next group commit and return its sequence number, without waiting
+        for the disk (see wait()). Raises OSError once the log has stopped.
+        """
+        with self.condition:
+            if self.error is not None:
+                raise OSError(f'The message log stopped after a failed write: {self.error}')
+            self.pending.append((board, record))
+            self.appended += 1
+            self.condition.notify()
+            return self.appended
+
+    def wait(self, sequence):
+        """Block until the message with the given sequence number, and every one before it, is synced to disk"""
+        with self.condition:
+            while self.committed < sequence and self.error is None and self.thread.is_alive():
+                self.condition.wait()
+            if self.committed < sequence:
+                raise OSError(f'Message {sequence} was not written: {self.error or "the log is closed"}')
+
+    def flush(self):
+        """Block until everything queued so far has been written and synced (raises OSError if it could not be)"""
+        with self.condition:
+            target = self.appended
+        self.wait(target)
+
+    def close(self):
+        """Commit everything still queued, stop the commit thread and close the segments"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+        for board_log in self.boards.values():
+            board_log.close()
+
+    def commit_loop(self):
+        """Write and sync queued messages in batches until the log is closed"""
+        while True:
+            # Take everything that queued up while the previous batch was being synced
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+                target = self.appended
+
+            try:
+                self.commit(batch)
+            except OSError as e:
+                # A batch that may be partly on disk can not be retried, stop the log and fail its posters
+                logger.error('Error writing the message log, no more messages are accepted: %s', e)
+                with self.condition:
+                    self.error = e
+                    self.pending = []
+                    self.condition.notify_all()
+                return
+
+            # Wake anyone waiting in wait()
+            with self.condition:
+                self.committed = target
+                self.condition.notify_all()
+
+    def commit(self, batch):
+        """Write one batch of queued messages and fsync each segment it touched once"""
+        touched = {}
+        for board, record in batch:
+            board_log = self.open(board)
+            line = (json.dumps(record) + '\n').encode()
+            board_log.write(record['id'], line, self.segment_size)
+            touched[board] = board_log
+
+        for board_log in touched.values():
+            board_log.sync()
+
+    def open(self, board):
+        """Return the BoardLog of a board with its segments loaded, loading them on first use"""
+        with self.boards_lock:
+            board_log = self.boards.get(board)
+            if board_log is None:
+                board_log = BoardLog(self.board_directory(board), board)
+                board_log.load()
+                self.boards[board] = board_log
+            return board_log
+
+    def count(self, board):
+        """Number of messages in a board's log, a board that is not in use has its files closed again"""
+        with self.boards_lock:
+            board_log = self.boards.get(board)
+            if board_log is None:
+                board_log = BoardLog(self.board_directory(board), board)
+                board_log.load()
+                board_log.close()
+        return board_log.count
+
+    def release(self, board):
+        """
+        Close a board's files and forget its BoardLog, it is loaded again by the next open().
+        The caller makes sure nothing is queued for the board (e.g. by calling flush() first).
+        """
+        with self.boards_lock:
+            board_log = self.boards.pop(board, None)
+        if board_log:
+            board_log.close()
+
+    def board_directory(self, board):
+        """Path of the directory holding a board's files"""
+        return os.path.join(self.directory, directory_name(board))
+
+    def remove(self, board):
+        """Delete a board's files from the log directory"""
+        path = self.board_directory(board)
+        if os.path.dirname(os.path.realpath(path)) != os.path.realpath(self.directory):
+            raise ValueError(f'The files of {board!r} are not inside the log directory')
+
+        try:
+            self.flush()
+        except OSError:
+            # Nothing is written once the log stopped, the board's files can go all the same
+            pass
+        self.release(board)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def names(self):
+        """Return the name of every board that has files in the log directory"""
+        return [unquote(entry) for entry in sorted(os.listdir(self.directory))
+                if os.path.isdir(os.path.join(self.directory, entry))]
@@ -0,0 +1,283 @@
+from datetime import datetime
+from time import monotonic
+from locks import InstrumentedLock
+
+
+class Board:
+    """
+    Message history of a single board.
+
+    Message IDs on a board start at 1 and increase by one per post, so lookups,
+    range fetches and "last K" history are plain indexing and slicing instead
+    of a scan. Without a log every message is kept in memory. With a BoardLog
+    only the newest messages (and any not yet synced to disk) are kept, older
+    ones are read back from the memory-mapped log, so memory stays flat no
+    matter how long the history grows.
+    """
+
+    # Number of newest messages kept in memory when the board has a log
+    CACHE_SIZE = 1024
+
+    def __init__(self, name, log=None):
+        """Board constructor"""
+        self.name = name
+        self.log = log
+
+        # Serializes posts so IDs are handed out exactly once and reach the log in order
+        self.lock = InstrumentedLock(f'board:{name}')
+
+        # Messages already on disk when the board was loaded
+        self.count = log.count if log else 0
+
+        # (ID of the first cached message, cached messages), replaced as a whole so readers never see it half trimmed
+        self.cache = (self.count + 1, [])
+
+        # When the board was last used, and whether the store has let go of it (evicted or deleted)
+        self.used = monotonic()
+        self.evicted = False
+        self.deleted = False
+
+    def __len__(self):
+        """Number of messages posted to the board"""
+        return self.count
+
+    def next_id(self):
+        """ID the next message posted to the board will get"""
+        return self.count + 1
+
+    def append(self, record):
+        """Append a message record (its ID must be the board's next ID)"""
+        base_id, records = self.cache
+        records.append(record)
+        self.count = record['id']
+
+        # Let go of old messages once the log has them, half a cache at a time to amortize the copy
+        if self.log and len(records) >= self.CACHE_SIZE * 3 // 2:
+            drop = min(len(records) - self.CACHE_SIZE, self.log.committed_id - base_id + 1)
+            if drop > 0:
+                self.cache = (base_id + drop, records[drop:])
+
+    def get(self, message_id):
+        """Return the message with the given ID, or None if there is no such message"""
+        records = self.range(message_id, message_id)
+        return records[0] if records else None
+
+    def range(self, start, end=None):
+        """Return the messages with IDs from start to end (inclusive, end defaults to the newest)"""
+        base_id, records = self.cache
+        start = max(start, 1)
+
+        # Messages still waiting for their group commit are not shown, their posts have not been acknowledged
+        newest = self.log.committed_id if self.log else self.count
+        end = newest if end is None else min(end, newest)
+        if start > end:
+            return []
+
+        # Messages older than the cache come from the log, the rest straight from memory
+        history = []
+        if start < base_id:
+            history = self.log.read_range(start, min(end, base_id - 1))
+            start = base_id
+        if start <= end:
+            history.extend(records[start - base_id:end - base_id + 1])
+        return history
+
+    def last(self, count):
+        """Return the newest count messages, oldest first"""
+        if count <= 0:
+            return []
+        return self.range(self.count - count + 1)
+
+
+class MessageStore:
+    """
+    ID-indexed message history for every board on the server.
+
+    A board's history is only allocated the first time the board is used, so
+    a server with thousands of groups only holds the ones clients are active
+    in. If a MessageLog is given, a board's history is loaded from it on first
+    use and every new message is appended to it; boards that have been idle
+    for a while can then be evicted (see evict()) and are loaded again from
+    the log the next time they are used.
+    """
+
+    def __init__(self, boards=(), log=None):
+        """MessageStore constructor, allocating the history of the given boards straight away"""
+        self.log = log
+        self.boards = {}
+
+        # Guards allocating, evicting and deleting histories, never held while posting
+        self.lock = InstrumentedLock('boards')
+
+        for name in boards:
+            self.history(name)
+
+    def __contains__(self, board):
+        """Whether the history of the given board is currently in memory"""
+        return board in self.boards
+
+    def __getitem__(self, board):
+        """Return the Board for the given name, allocating (or loading) it on first use"""
+        return self.history(board)
+
+    def history(self, board):
+        """Return the Board for the given name, allocating (or loading) it on first use"""
+        history = self.boards.get(board)
+        if history is None:
+            with self.lock:
+                history = self.boards.get(board)
+                if history is None:
+                    history = self.boards[board] = Board(board, self.log.open(board) if self.log else None)
+        history.used = monotonic()
+        return history
+
+    def names(self):
+        """Return the name of every board with a history, in memory or on disk"""
+        names = set(self.boards)
+        if self.log:
+            names.update(self.log.names())
+        return sorted(names)
+
+    def counts(self):
+        """Number of messages posted to every board with a history, in memory or on disk"""
+        counts = {name: len(history) for name, history in list(self.boards.items())}
+        if self.log:
+            for name in self.log.names():
+                if name not in counts:
+                    counts[name] = self.log.count(name)
+        return counts
+
+    def add(self, board, sender, subject, message, durable=True):
+        """
+        Add a message to a board's history and return the stored record. With a log the record is only
+        returned once it is synced to disk (OSError if it could not be), unless durable is False, in
+        which case the caller waits for it with sync().
+        """
+        # Get the current timestamp and format into a readable form
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        while True:
+            history = self.history(board)
+
+            # Allocate the ID, store and queue the message atomically (readers never take the lock)
+            with history.lock:
+                # The board was evicted while waiting for the lock, load it again
+                if history.evicted:
+                    if history.deleted:
+                        raise KeyError(board)
+                    continue
+
+                # Create a dictionary to represent the message
+                record = {
+                    'id': history.next_id(),
+                    'sender': sender,
+                    'timestamp': timestamp,
+                    'subject': subject,
+                    'message': message
+                }
+
+                # Queue the message for the next group commit (a log that stopped refuses it, the ID is not used)
+                sequence = self.log.append(board, record) if self.log else 0
+                history.append(record)
+
+            # Wait for the batch outside the lock, so posts queued meanwhile share its sync
+            if sequence and durable:
+                self.log.wait(sequence)
+            return record
+
+    def replicate(self, board, record):
+        """
+        Add a message that was assigned its ID elsewhere (by the broker of a cluster).
+        Messages arrive in ID order, one that is already stored is ignored.
+        """
+        while True:
+            history = self.history(board)
+            with history.lock:
+                if history.evicted:
+                    if history.deleted:
+                        raise KeyError(board)
+                    continue
+                if record['id'] <= len(history):
+                    return
+                if record['id'] != history.next_id():
+                    raise ValueError(f"Message {record['id']} of {board} arrived out of order, expected {history.next_id()}")
+                history.append(record)
+                if self.log:
+                    self.log.append(board, record)
+            return
+
+    def sync(self):
+        """Block until every message added so far is synced to disk (raises OSError if it could not be)"""
+        if self.log:
+            self.log.flush()
+
+    def get(self, board, message_id):
+        """Return a single message from a board, or None if the ID does not exist"""
+        return self.history(board).get(message_id)
+
+    def range(self, board, start, end=None):
+        """Return the messages of a board with IDs from start to end (inclusive)"""
+        return self.history(board).range(start, end)
+
+    def last(self, board, count):
+        """Return the newest count messages of a board, oldest first"""
+        return self.history(board).last(count)
+
+    def count(self, board):
+        """Number of messages posted to a board"""
+        return len(self.history(board))
+
+    def evict(self, max_idle, keep=()):
+        """
+        Let go of the history of every board not used for max_idle seconds, except those in keep,
+        and return their names. Only boards backed by the log are evicted (the rest would be lost),
+        their messages are synced to disk first and read back from it on next use.
+        """
+        if not self.log:
+            return []
+
+        cutoff = monotonic() - max_idle
+        evicted = []
+        for name, history in list(self.boards.items()):
+            if name in keep or history.used > cutoff:
+                continue
+
+            # Holding the board's lock keeps posts out while its messages are synced and its files closed
+            with history.lock:
+                try:
+                    self.log.flush()
+                except OSError:
+                    # Messages that never reached the disk can not be read back, keep the board
+                    continue
+                with self.lock:
+                    if history.used > cutoff or self.boards.get(name) is not history:
+                        continue
+                    del self.boards[name]
+                    history.evicted = True
+                    self.log.release(name)
+            evicted.append(name)
+        return evicted
+
+    def delete(self, board):
+        """Drop a board's history for good, along with its files in the log"""
+        with self.lock:
+            history = self.boards.get(board)
+        if history is not None:
+            with history.lock:
+                with self.lock:
+                    self.boards.pop(board, None)
+                    history.evicted = history.deleted = True
+                    if self.log:
+                        self.log.remove(board)
+        elif self.log:
+            with self.lock:
+                self.log.remove(board)
+
+    def locks(self):
+        """Return the lock of every board in memory"""
+        return [self.lock, *(history.lock for history in list(self.boards.values()))]
+
+    def close(self):
+        """Write out anything not yet persisted and close the log"""
+        if self.log:
+            self.log.close()
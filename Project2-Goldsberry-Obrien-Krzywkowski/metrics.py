@@ -0,0 +1,232 @@
+import threading
+from bisect import bisect_left
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def format_labels(names, values):
+    """Render label names and values as a Prometheus label set, e.g. {command="post"}"""
+    if not names:
+        return ''
+    pairs = (f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def escape(value):
+    """Escape a label value for the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    """Render a sample value, whole numbers without a fraction"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A value that only goes up, optionally split by labels (e.g. requests per command)."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        """Counter constructor"""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        """Add to the counter of the given label values"""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """Yield (suffix, label names, label values, value) for every labelled value"""
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield '', self.labels, labels, value
+
+
+class Gauge:
+    """
+    A value that goes up and down, read when the metrics are collected.
+
+    The collect function returns a list of (label values, value) pairs, so
+    gauges like the number of connections cost nothing until someone asks.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, collect, labels=()):
+        """Gauge constructor"""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        """Yield (suffix, label names, label values, value) for every labelled value"""
+        for labels, value in self.collect():
+            yield '', self.labels, labels, value
+
+
+class Histogram:
+    """
+    Distribution of observed values (e.g. handler latency) in cumulative buckets.
+
+    Every observation only bumps one bucket counter, the running sum and the
+    count, the buckets are made cumulative when the metrics are collected.
+    """
+
+    kind = 'histogram'
+
+    # Seconds, from 50 µs up to 2.5 s
+    LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """Histogram constructor"""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+
+        # Upper bounds as they appear in the le label, the last bucket catches everything
+        self.bounds = (*(format_value(float(bound)) for bound in self.buckets), '+Inf')
+
+        # Label values to [bucket counts (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        """Record a single observation"""
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        """Yield (suffix, label names, label values, value) for every bucket, sum and count"""
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+
+        names = (*self.labels, 'le')
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.bounds, counts):
+                cumulative += count
+                yield '_bucket', names, (*labels, bound), cumulative
+            yield '_sum', self.labels, labels, total
+            yield '_count', self.labels, labels, cumulative
+
+
+class Registry:
+    """
+    Every metric the server keeps, rendered on request in the Prometheus text format.
+
+    Metrics are created once (usually at import time) through counter(),
+    gauge() and histogram() and then updated on the hot path without any
+    formatting, the text is only built when render() is called by the stats
+    command or the admin endpoint.
+    """
+
+    def __init__(self):
+        """Registry constructor"""
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, replacing one registered earlier under the same name"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """Create and register a Counter"""
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, collect, labels=()):
+        """Create and register a Gauge read through the collect function"""
+        return self.register(Gauge(name, help, collect, labels))
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.LATENCY_BUCKETS):
+        """Create and register a Histogram"""
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, names, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{format_labels(names, labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Registry shared by every module of the server
+REGISTRY = Registry()
+
+
+class MetricsEndpoint:
+    """
+    Admin endpoint serving the registry over HTTP (GET /metrics) so Prometheus can scrape it.
+    Other admin pages can be added with route(). Runs in its own daemon thread and is meant
+    to listen on a local address only.
+    """
+
+    def __init__(self, host, port, registry=REGISTRY):
+        """MetricsEndpoint constructor, binds the admin socket"""
+        metrics = lambda query: registry.render()
+        routes = self.routes = {'/': metrics, '/metrics': metrics}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                render = routes.get(path)
+                if render is None:
+                    self.send_error(404)
+                    return
+                try:
+                    body = render(parse_qs(query)).encode('utf-8')
+                except (ValueError, RuntimeError) as e:
+                    self.send_error(400, str(e))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are not worth a log line each
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def route(self, path, render):
+        """Serve the text returned by render(query) at path, query maps each parameter to its list of values"""
+        self.routes[path] = render
+
+    @property
+    def address(self):
+        """The (host, port) the endpoint listens on"""
+        return self.httpd.server_address[:2]
+
+    def start(self):
+        """Serve scrapes in a background thread"""
+        threading.Thread(target=self.httpd.serve_forever, name='metrics-endpoint', daemon=True).start()
+
+    def stop(self):
+        """Stop serving and close the admin socket"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
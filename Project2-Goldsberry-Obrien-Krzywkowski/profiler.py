@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+class SamplingProfiler:
+    """
+    Stack sampling profiler that can be switched on and off in a running server.
+
+    While running, a background thread looks at the stack of every thread a
+    hundred times a second and counts each distinct stack, rooted at the
+    command the thread was handling at the time. Handlers also record the CPU
+    time they used per command. Nothing is measured while it is stopped apart
+    from a single flag check per request.
+
+    dump_folded() writes the stacks in the folded format read by flamegraph.pl,
+    speedscope and similar tools (one "frame;frame;frame count" line per stack).
+    """
+
+    INTERVAL = 0.01
+
+    def __init__(self, interval=INTERVAL):
+        """SamplingProfiler constructor"""
+        self.interval = interval
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.cpu_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything measured so far"""
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+
+        # Thread ident to the command it is currently handling
+        self.active = {}
+
+        # Command to [requests handled, CPU seconds used]
+        self.cpu = {}
+
+    def start(self):
+        """Start sampling (from scratch), returns False if the profiler was already running"""
+        with self.lock:
+            if self.running:
+                return False
+            self.reset()
+            self.started_at = time.time()
+            self.running = True
+            self.thread = threading.Thread(target=self.sample_loop, name='profiler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """Stop sampling, returns False if the profiler was not running"""
+        with self.lock:
+            if not self.running:
+                return False
+            self.running = False
+            thread = self.thread
+        thread.join()
+        self.stopped_at = time.time()
+        return True
+
+    def profile(self, seconds):
+        """Sample for the given number of seconds and return the folded stacks"""
+        if not self.start():
+            raise RuntimeError('The profiler is already running')
+        try:
+            time.sleep(seconds)
+        finally:
+            self.stop()
+        return self.folded()
+
+    @contextmanager
+    def command(self, name):
+        """Attribute the calling thread's samples and CPU time to a command while it is handled"""
+        ident = threading.get_ident()
+        self.active[ident] = name
+        started = time.thread_time()
+        try:
+            yield
+        finally:
+            used = time.thread_time() - started
+            self.active.pop(ident, None)
+            with self.cpu_lock:
+                entry = self.cpu.setdefault(name, [0, 0.0])
+                entry[0] += 1
+                entry[1] += used
+
+    def sample_loop(self):
+        """Take a sample every interval until stopped"""
+        own = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[self.collapse(self.active.get(ident), frame)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    @staticmethod
+    def collapse(command, frame):
+        """Turn a stack into a single ';' separated line, outermost frame first"""
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        frames.append(f'command:{command}' if command else 'idle')
+        return ';'.join(reversed(frames))
+
+    def folded(self):
+        """Return the sampled stacks in the folded flamegraph format"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def summary(self):
+        """Return a table of the CPU time used by each command, the most expensive first"""
+        lines = [f'{"command":<14}{"requests":>10}{"cpu ms":>12}{"cpu µs/req":>12}']
+        with self.cpu_lock:
+            commands = sorted(self.cpu.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (requests, cpu) in commands:
+            lines.append(f'{name:<14}{requests:>10}{cpu * 1000:>12.2f}{cpu / requests * 1e6:>12.1f}')
+        return '\n'.join(lines) + '\n'
+
+    def dump_folded(self, directory):
+        """Write the folded stacks and the per-command summary to a directory, returning the stacks' path"""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at or time.time()))
+        path = os.path.join(directory, f'profile-{stamp}.folded')
+        with open(path, 'w') as stacks:
+            stacks.write(self.folded())
+        with open(os.path.join(directory, f'profile-{stamp}.txt'), 'w') as summary:
+            summary.write(self.summary())
+        return path
@@ -1,32 +1,441 @@
 import json
+import zlib
+import struct
 
 class Protocol:
     """Handles message construction according to protocol specifications."""
 
-    def build_request(command, username=None, group=None, data=None):
-        """Build the JSON request."""
+    # Every command and status has a small code in the binary encoding (0 is an unknown command / no status)
+    COMMANDS = ('connect', 'join', 'groupjoin', 'post', 'users', 'message', 'groupleave', 'leave', 'exit',
+                'groups', 'grouppost', 'groupusers', 'groupmessage', 'notify', 'error', 'stats', 'groupcreate',
+                'groupdelete', 'search', 'history')
+    STATUSES = ('OK', 'FAIL')
+
+    def build_request(command, username=None, group=None, data=None, request_id=None, sequence=None):
+        """
+        Build the JSON request.
+        The optional request_id is echoed back in the response so several requests
+        can be in flight on one connection and matched up when they are answered.
+        The optional sequence numbers the notifications the server sends on a board
+        (see BulletinBoardServer.notify()), the header only has it if it is given.
+        """
         request = {
             "header": {
                 "command": command,
                 "username": username,
-                "group": group
+                "group": group,
+                "request_id": request_id
             },
             "body": {
                 "data": data,
             },
         }
+        if sequence is not None:
+            request["header"]["sequence"] = sequence
         return json.dumps(request)
     
-    def build_response(command, status, data=None):
-        """Build the JSON response."""
+    def build_response(command, status, data=None, request_id=None):
+        """Build the JSON response, tagged with the ID of the request it answers."""
         response = \
         {
             "header" : {
                 "status": status,
-                "command": command
+                "command": command,
+                "request_id": request_id
             },
             "body": {
                 "data": data
             }
         }
-        return json.dumps(response)
\ No newline at end of file
+        return json.dumps(response)
+
+    def frame(message):
+        """Encode a built request/response as a newline-delimited frame ready to send."""
+        return (message + '\n').encode()
+
+
+class JsonCodec:
+    """
+    Default encoding: every message is a newline-delimited JSON document.
+    Easy to read on the wire, so it stays available for debugging.
+    """
+
+    name = 'json'
+    length_prefixed = False
+    compression = None
+
+    @property
+    def base(self):
+        """The codec itself, see DeflateCodec"""
+        return self
+
+    def encode_request(self, command, username=None, group=None, data=None, request_id=None, sequence=None):
+        """Build a request and encode it as a frame ready to send"""
+        return Protocol.frame(Protocol.build_request(command, username, group, data, request_id, sequence))
+
+    def encode_response(self, command, status, data=None, request_id=None):
+        """Build a response and encode it as a frame ready to send"""
+        return Protocol.frame(Protocol.build_response(command, status, data, request_id))
+
+    def decode(self, frame):
+        """Decode a received frame into a message dictionary (raises ValueError if it is malformed)"""
+        return json.loads(frame)
+
+    def template(self, command, status, data=None):
+        """
+        Encode a response ahead of time, leaving a gap for the request ID (see Reply).
+        The header is serialized before the body, so the first request ID in the document is the header's.
+        """
+        encoded = self.encode_response(command, status, data)
+        prefix, suffix = encoded.split(b'"request_id": null', 1)
+        return encoded, prefix + b'"request_id": ', suffix
+
+    def render(self, template, request_id):
+        """Fill the request ID into a response encoded by template()"""
+        encoded, prefix, suffix = template
+        if request_id is None:
+            return encoded
+        if type(request_id) is int:
+            return prefix + str(request_id).encode() + suffix
+        return prefix + json.dumps(request_id).encode() + suffix
+
+
+class BinaryCodec:
+    """
+    Compact encoding for high-volume clients, negotiated on connect.
+
+    Every frame is a 4 byte big-endian length followed by the message:
+        command code, status code (0 for requests), request ID (0 for none)   >BBI
+        username and group (requests only), each a >H length and UTF-8 bytes
+        (0xFFFF for None)
+        sequence (requests only, 0 for none)                                   >Q
+        data: a type tag followed by a UTF-8 string, a >q integer or, for
+        lists and dictionaries such as message history, a JSON document
+    Decoded messages have the same header/body layout as JSON ones, so the
+    handlers do not care which encoding a client uses.
+    """
+
+    name = 'binary'
+    length_prefixed = True
+    compression = None
+
+    LENGTH = struct.Struct('>I')
+    HEADER = struct.Struct('>BBI')
+    STRING = struct.Struct('>H')
+    INTEGER = struct.Struct('>q')
+    SEQUENCE = struct.Struct('>Q')
+    NONE_STRING = 0xFFFF
+
+    # Type tags of the data field
+    NONE, TEXT, INTEGER_DATA, DOCUMENT = range(4)
+
+    def __init__(self):
+        """BinaryCodec constructor, building the code lookup tables"""
+        self.command_codes = {command: code for code, command in enumerate(Protocol.COMMANDS, 1)}
+        self.status_codes = {status: code for code, status in enumerate(Protocol.STATUSES, 1)}
+
+    @property
+    def base(self):
+        """The codec itself, see DeflateCodec"""
+        return self
+
+    def encode_request(self, command, username=None, group=None, data=None, request_id=None, sequence=None):
+        """Build a request and encode it as a frame ready to send"""
+        parts = [self.HEADER.pack(self.command_codes.get(command, 0), 0, request_id or 0),
+                 self.encode_string(username), self.encode_string(group), self.SEQUENCE.pack(sequence or 0),
+                 self.encode_data(data)]
+        return self.frame(parts)
+
+    def encode_response(self, command, status, data=None, request_id=None):
+        """Build a response and encode it as a frame ready to send"""
+        parts = [self.HEADER.pack(self.command_codes.get(command, 0), self.status_codes[status], request_id or 0),
+                 self.encode_data(data)]
+        return self.frame(parts)
+
+    def frame(self, parts):
+        """Join the encoded parts of a message behind its length"""
+        size = sum(len(part) for part in parts)
+        return b''.join([self.LENGTH.pack(size), *parts])
+
+    def encode_string(self, value):
+        """Encode an optional short string (usernames and group names)"""
+        if value is None:
+            return self.STRING.pack(self.NONE_STRING)
+        encoded = value.encode()
+        if len(encoded) >= self.NONE_STRING:
+            raise ValueError('String is too long for the binary encoding')
+        return self.STRING.pack(len(encoded)) + encoded
+
+    def template(self, command, status, data=None):
+        """Encode a response ahead of time, leaving out the header that holds the request ID (see Reply)"""
+        encoded_data = self.encode_data(data)
+        return self.LENGTH.pack(self.HEADER.size + len(encoded_data)), self.command_codes.get(command, 0), self.status_codes[status], encoded_data
+
+    def render(self, template, request_id):
+        """Fill the request ID into a response encoded by template()"""
+        length, command_code, status_code, encoded_data = template
+        return length + self.HEADER.pack(command_code, status_code, request_id or 0) + encoded_data
+
+    def encode_data(self, data):
+        """Encode the data field, tagged with its type"""
+        if data is None:
+            return bytes((self.NONE,))
+        if isinstance(data, str):
+            return bytes((self.TEXT,)) + data.encode()
+        if isinstance(data, int) and not isinstance(data, bool):
+            return bytes((self.INTEGER_DATA,)) + self.INTEGER.pack(data)
+        return bytes((self.DOCUMENT,)) + json.dumps(data).encode()
+
+    def decode(self, frame):
+        """Decode a received frame (without its length) into a message dictionary (raises ValueError if it is malformed)"""
+        try:
+            command_code, status_code, request_id = self.HEADER.unpack_from(frame)
+            offset = self.HEADER.size
+            header = {}
+
+            if status_code:
+                header['status'] = Protocol.STATUSES[status_code - 1]
+            header['command'] = Protocol.COMMANDS[command_code - 1] if 0 < command_code <= len(Protocol.COMMANDS) else None
+            if not status_code:
+                header['username'], offset = self.decode_string(frame, offset)
+                header['group'], offset = self.decode_string(frame, offset)
+                header['sequence'] = self.SEQUENCE.unpack_from(frame, offset)[0] or None
+                offset += self.SEQUENCE.size
+            header['request_id'] = request_id or None
+
+            return {'header': header, 'body': {'data': self.decode_data(frame, offset)}}
+
+        except (struct.error, IndexError) as e:
+            raise ValueError(f'Malformed binary frame: {e}') from e
+
+    def decode_string(self, frame, offset):
+        """Decode an optional short string, returning it and the offset after it"""
+        size = self.STRING.unpack_from(frame, offset)[0]
+        offset += self.STRING.size
+        if size == self.NONE_STRING:
+            return None, offset
+        if offset + size > len(frame):
+            raise ValueError('Malformed binary frame: string runs past the end')
+        return bytes(frame[offset:offset + size]).decode(), offset + size
+
+    def decode_data(self, frame, offset):
+        """Decode the tagged data field at the end of a frame"""
+        tag = frame[offset]
+        payload = frame[offset + 1:]
+        if tag == self.NONE:
+            return None
+        if tag == self.TEXT:
+            return bytes(payload).decode()
+        if tag == self.INTEGER_DATA:
+            return self.INTEGER.unpack(payload)[0]
+        if tag == self.DOCUMENT:
+            return json.loads(payload)
+        raise ValueError(f'Malformed binary frame: unknown data type {tag}')
+
+
+class DeflateCodec:
+    """
+    Compression on top of a length-prefixed codec, negotiated on connect.
+
+    Frames longer than THRESHOLD (large posts, history windows) are deflated
+    and marked with a leading 0xFF byte, which is never a command code. Every
+    frame is compressed on its own, primed with a dictionary of strings that
+    show up in almost every message. That keeps most of the gain of a streaming
+    compressor on short messages, while a broadcast is still compressed once for
+    all recipients, and the slow consumer policy can drop frames without
+    breaking the stream.
+    """
+
+    compression = 'zlib'
+    length_prefixed = True
+
+    THRESHOLD = 512
+    LEVEL = 6
+    MARKER = 0xFF
+
+    # Preset dictionary shared by both ends, the most common strings go last (closest to the data)
+    DICTIONARY = (
+        b'notifications were skipped because the connection could not keep up.'
+        b' has joined the message board. has left the message board. has joined the server has left the server'
+        b'group one; group two; group three; group four; group five; '
+        b'", "timestamp": "20", "subject": "", "message": "'
+        b'}, {"id": , "sender": "'
+        b'public board; Message ID: , Sender: , Time Posted: 20, Subject: \\n\t'
+    )
+
+    def __init__(self, base):
+        """DeflateCodec constructor, wrapping the codec that encodes the messages"""
+        self.base = base
+        self.name = base.name
+
+    def compress(self, frame):
+        """Compress an encoded frame if it is large enough to be worth it"""
+        if len(frame) <= self.THRESHOLD:
+            return frame
+
+        compressor = zlib.compressobj(self.LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self.DICTIONARY)
+        payload = compressor.compress(memoryview(frame)[BinaryCodec.LENGTH.size:]) + compressor.flush()
+        if len(payload) + 1 >= len(frame) - BinaryCodec.LENGTH.size:
+            return frame
+        return BinaryCodec.LENGTH.pack(len(payload) + 1) + bytes((self.MARKER,)) + payload
+
+    def encode_request(self, command, username=None, group=None, data=None, request_id=None, sequence=None):
+        """Build a request, encode it and compress it if it is large"""
+        return self.compress(self.base.encode_request(command, username, group, data, request_id, sequence))
+
+    def encode_response(self, command, status, data=None, request_id=None):
+        """Build a response, encode it and compress it if it is large"""
+        return self.compress(self.base.encode_response(command, status, data, request_id))
+
+    def template(self, command, status, data=None):
+        """Encode a response ahead of time (see Reply)"""
+        return self.base.template(command, status, data)
+
+    def render(self, template, request_id):
+        """Fill the request ID into a response encoded by template() and compress it if it is large"""
+        return self.compress(self.base.render(template, request_id))
+
+    def decode(self, frame):
+        """Decompress a received frame if it is compressed and decode it (raises ValueError if it is malformed)"""
+        if frame[:1] == bytes((self.MARKER,)):
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.DICTIONARY)
+            try:
+                frame = decompressor.decompress(memoryview(frame)[1:], FrameBuffer.MAX_FRAME_SIZE)
+            except zlib.error as e:
+                raise ValueError(f'Malformed compressed frame: {e}') from e
+
+            # Refuse frames that inflate past the frame size limit
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError('Malformed compressed frame: too large or truncated')
+        return self.base.decode(frame)
+
+
+# Encodings a client can ask for when it connects, JSON is what every connection starts with
+CODECS = {codec.name: codec for codec in (JsonCodec(), BinaryCodec())}
+JSON = CODECS['json']
+
+# Compressed variants of the encodings, compression needs length-prefixed frames
+COMPRESSIONS = {'zlib': {codec: DeflateCodec(codec) for codec in CODECS.values() if codec.length_prefixed}}
+
+
+def negotiate(encoding, compression=None):
+    """
+    Return the codec for the encoding and compression a client asked for.
+    Anything the server does not support falls back to JSON and no compression respectively.
+    """
+    codec = CODECS.get(encoding, JSON)
+    return COMPRESSIONS.get(compression, {}).get(codec, codec)
+
+
+class Reply:
+    """
+    A response whose command, status and data never change.
+    It is encoded for every codec once, when it is created, so sending it
+    only takes filling in the ID of the request it answers.
+    """
+
+    __slots__ = ('templates',)
+
+    def __init__(self, command, status, data=None):
+        """Reply constructor, encoding the response for every codec"""
+        self.templates = {codec: codec.template(command, status, data) for codec in CODECS.values()}
+
+    def encode(self, codec, request_id=None):
+        """Return the response encoded with the given codec and tagged with a request ID"""
+        return codec.render(self.templates[codec.base], request_id)
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a peer sends more than the maximum frame size without a delimiter."""
+
+
+class FrameBuffer:
+    """
+    Per-connection receive buffer that splits a byte stream into frames.
+
+    Messages are newline-delimited (json.dumps never emits a raw newline), so a
+    request may arrive split over several reads, or several requests may arrive
+    in a single read. Bytes are read into one reusable chunk and appended to a
+    bytearray, and already scanned bytes are never searched again. Once a
+    connection switches to the binary encoding, length_prefixed is set and
+    frames are split by their length instead; the switch takes effect from the
+    next frame, even in the middle of frames().
+    """
+
+    DELIMITER = b'\n'
+    CHUNK_SIZE = 65536
+    MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """FrameBuffer constructor"""
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+        # Reusable chunk that recv_into reads into, avoiding a new bytes object per read
+        self.chunk = bytearray(self.CHUNK_SIZE)
+        self.view = memoryview(self.chunk)
+
+        # Position up to which the buffer is known to contain no delimiter
+        self.scanned = 0
+
+        # Whether frames are length-prefixed (binary encoding) rather than newline-delimited
+        self.length_prefixed = False
+
+    def read_from(self, sock):
+        """
+        Read whatever is available from a blocking socket into the buffer.
+        Returns the number of bytes read, 0 means the peer closed the connection.
+        """
+        received = sock.recv_into(self.chunk)
+        if received:
+            self.buffer += self.view[:received]
+        return received
+
+    def feed(self, data):
+        """Append bytes that were read elsewhere (e.g. from an asyncio stream)"""
+        self.buffer += data
+
+    def frames(self):
+        """Remove and yield every complete frame currently in the buffer"""
+        start = 0
+        buffer = self.buffer
+        length = BinaryCodec.LENGTH
+
+        # Whether the search for a delimiter ran to the end of the buffer (the caller may stop early)
+        exhausted = False
+
+        try:
+            while True:
+                if self.length_prefixed:
+                    # Split out the next frame by its length, once all of it has arrived
+                    if len(buffer) - start < length.size:
+                        break
+                    size = length.unpack_from(buffer, start)[0]
+                    if size > self.max_frame_size:
+                        raise FrameTooLarge(f'Frame exceeds {self.max_frame_size} bytes')
+                    end = start + length.size + size
+                    if end > len(buffer):
+                        break
+                    frame = bytes(buffer[start + length.size:end])
+                    start = end
+                else:
+                    # Split out the next delimited frame, skipping empty ones
+                    end = buffer.find(self.DELIMITER, max(start, self.scanned))
+                    if end == -1:
+                        exhausted = True
+                        break
+                    frame = bytes(buffer[start:end])
+                    start = end + 1
+                    if not frame:
+                        continue
+                yield frame
+
+        finally:
+            # Drop the consumed bytes in one go and remember how far the remainder was scanned
+            if start:
+                del buffer[:start]
+            self.scanned = len(buffer) if exhausted and not self.length_prefixed else 0
+
+        # Refuse to buffer an endless frame from a misbehaving peer
+        if not self.length_prefixed and len(buffer) > self.max_frame_size:
+            raise FrameTooLarge(f'Frame exceeds {self.max_frame_size} bytes')
\ No newline at end of file
@@ -0,0 +1,73 @@
+from protocol import Reply
+from groups import GroupRegistry
+
+# Every fixed response the server sends, encoded once when the server starts (see Reply)
+
+INVALID_REQUEST = Reply("error", "FAIL", "Invalid request format.")
+
+# connect
+USERNAME_REQUIRED = Reply("connect", "FAIL", "Username is required to connect.")
+CONNECTED = Reply("connect", "OK")
+CONNECT_FAILED = Reply("connect", "FAIL")
+
+# join
+ALREADY_ON_BOARD = Reply("join", "FAIL", "You are already connected to the message board.")
+NO_NEW_BOARD_MESSAGES = Reply("join", "OK", "There are no new messages on the board.")
+NO_BOARD_MESSAGES = Reply("join", "OK", "There are no messages on the board yet.")
+
+# groupjoin
+GROUPJOIN_NOT_ON_BOARD = Reply("groupjoin", "FAIL", "You are not a member of the public message board.")
+GROUPJOIN_NO_SUCH_GROUP = Reply("groupjoin", "FAIL", "The specified group does not exist.")
+ALREADY_IN_GROUP = Reply("groupjoin", "FAIL", "You are already a member of this group.")
+NO_NEW_GROUP_MESSAGES = Reply("groupjoin", "OK", "There are no new messages in this group.")
+NO_GROUP_MESSAGES = Reply("groupjoin", "OK", "There are no messages in this group yet.")
+
+# groupcreate and groupdelete
+GROUPCREATE_NOT_ON_BOARD = Reply("groupcreate", "FAIL", "You are not a member of the public message board.")
+GROUPCREATE_INVALID_NAME = Reply("groupcreate", "FAIL", f"Invalid group name. Use 1 to {GroupRegistry.MAX_NAME_LENGTH} printable characters"
+                                f" (not . or ..).")
+GROUPCREATE_EXISTS = Reply("groupcreate", "FAIL", "A group with that name already exists.")
+GROUPCREATE_FAILED = Reply("groupcreate", "FAIL", "The group could not be created.")
+GROUPDELETE_NOT_ON_BOARD = Reply("groupdelete", "FAIL", "You are not a member of the public message board.")
+GROUPDELETE_NO_SUCH_GROUP = Reply("groupdelete", "FAIL", "The specified group does not exist.")
+GROUPDELETE_NOT_CREATOR = Reply("groupdelete", "FAIL", "Only the user who created a group can delete it.")
+GROUPDELETE_FAILED = Reply("groupdelete", "FAIL", "The group could not be deleted.")
+
+# post and grouppost, keyed by the command
+POST_INCOMPLETE = {command: Reply(command, "FAIL", "Invalid message. Please ensure both username and message are provided.") for command in ('post', 'grouppost')}
+POST_BAD_FORMAT = {command: Reply(command, "FAIL", "Invalid message format. Both subject and content are required.") for command in ('post', 'grouppost')}
+POST_NOT_ON_BOARD = {command: Reply(command, "FAIL", "You are not a member of the public message board.") for command in ('post', 'grouppost')}
+POST_NO_SUCH_GROUP = {command: Reply(command, "FAIL", "You are not a member of the specified group.") for command in ('post', 'grouppost')}
+POSTED = {command: Reply(command, "OK") for command in ('post', 'grouppost')}
+POST_FAILED = {command: Reply(command, "FAIL", "Invalid Message") for command in ('post', 'grouppost')}
+
+# groupleave and leave
+GROUPLEAVE_NO_SUCH_GROUP = Reply("groupleave", "FAIL", "Invalid group name. The group does not exist.")
+GROUPLEAVE_NOT_MEMBER = Reply("groupleave", "FAIL", "You are not a member of this group.")
+LEAVE_NOT_ON_BOARD = Reply("leave", "FAIL", "You are not currently connected to the message board.")
+LEFT_BOARD = Reply("leave", "OK", "You have left the message board.")
+
+# exit
+EXITED = Reply("exit", "OK", "You have successfully exited.")
+
+# users and groupusers
+USERS_NOT_ON_BOARD = Reply("users", "FAIL", "Current user is not in a message board.")
+USERS_NO_SUCH_GROUP = Reply("users", "FAIL", "Group does not exist.")
+USERS_NOT_IN_GROUP = Reply("users", "FAIL", "Current user is not in the group. Access Denied.")
+USERS_FAILED = Reply("users", "FAIL")
+
+# message and groupmessage
+MESSAGE_NOT_ON_BOARD = Reply("message", "FAIL", "Current user is not in a message board.")
+INVALID_MESSAGE_ID = Reply("message", "FAIL", "Invalid message ID.")
+MESSAGE_NOT_IN_GROUP = Reply("message", "FAIL", "Current user is not in the group. Access Denied.")
+MESSAGE_FAILED = Reply("message", "FAIL")
+
+# search
+SEARCH_NOT_ON_BOARD = Reply("search", "FAIL", "Current user is not in a message board.")
+SEARCH_NOT_IN_GROUP = Reply("search", "FAIL", "Current user is not in the group. Access Denied.")
+SEARCH_FAILED = Reply("search", "FAIL")
+
+# history
+HISTORY_NOT_ON_BOARD = Reply("history", "FAIL", "Current user is not in a message board.")
+HISTORY_NOT_IN_GROUP = Reply("history", "FAIL", "Current user is not in the group. Access Denied.")
+HISTORY_FAILED = Reply("history", "FAIL")
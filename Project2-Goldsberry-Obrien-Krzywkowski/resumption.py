@@ -0,0 +1,191 @@
+import secrets
+from collections import deque
+from itertools import islice
+from time import monotonic
+from locks import InstrumentedLock
+
+
+class EventRing:
+    """
+    The most recent notifications sent to the clients of one board.
+
+    Notifications are numbered in the order they were sent and carry their
+    number to the clients, the ring only keeps the newest size of them and
+    drops the oldest as new ones come in, so a busy board costs the same memory
+    as a quiet one. A resuming client is sent everything after the last number
+    it received.
+    """
+
+    __slots__ = ('name', 'events', 'sequence', 'lock')
+
+    def __init__(self, name, size):
+        """EventRing constructor"""
+        self.name = name
+        self.events = deque(maxlen=size)
+
+        # Number of the newest notification (0 before the first one)
+        self.sequence = 0
+
+        # Held while a notification is recorded and handed to the board's members, and while a resuming
+        # client rejoins the board and is sent what it missed, so it gets every notification exactly once
+        self.lock = InstrumentedLock(f'ring:{name}')
+
+    def append(self, data):
+        """Record a notification (called with the lock held)"""
+        self.events.append(data)
+        self.sequence += 1
+
+    def since(self, position):
+        """
+        Return (how many notifications after position are no longer kept, [(number, notification)] of the
+        ones that are, oldest first) (called with the lock held)
+        """
+        first = self.sequence - len(self.events) + 1
+        missed = max(first - position - 1, 0)
+        skip = min(max(position - first + 1, 0), len(self.events))
+        return missed, list(enumerate(islice(self.events, skip, None), first + skip))
+
+    def clear(self):
+        """Drop the kept notifications, their numbering carries on"""
+        self.events.clear()
+
+
+class DetachedSession:
+    """Where a client that lost its connection was: its username, and its position in the ring of every board it was on."""
+
+    __slots__ = ('username', 'positions', 'expires')
+
+    def __init__(self, username, positions, expires):
+        """DetachedSession constructor"""
+        self.username = username
+        self.positions = positions
+        self.expires = expires
+
+
+class ResumableSessions:
+    """
+    Session tokens, and what a client needs to pick up where it left off after its connection dropped.
+
+    Every client gets a token when it connects. When its connection is lost the
+    boards and groups it was on are remembered under the token for a while, and
+    a client that reconnects with the token is put straight back on them and
+    sent the notifications it missed in the same round trip. The client says
+    which notification of every board it received last (see
+    BulletinBoardServer.notify()), anything it never got is sent again, even if
+    it was still in flight or queued when the connection dropped. For a board
+    it received nothing on, it is sent what came after the point its connection
+    was found to be gone. A reconnect that arrives before the server noticed
+    the old connection was gone takes the session over from it. Notifications
+    are only kept by the node (or worker) that sent them, so a session can only
+    be resumed on the node it was started on.
+
+    The server-wide notifications (e.g. clients joining the server) go to
+    every client and are kept in the ring of board None.
+    """
+
+    # Notifications kept for every board, and how long a dropped client's session can be resumed
+    RING_SIZE = 1000
+    RESUME_SECONDS = 120
+
+    def __init__(self, ring_size=RING_SIZE, resume_seconds=RESUME_SECONDS):
+        """ResumableSessions constructor"""
+        self.ring_size = ring_size
+        self.resume_seconds = resume_seconds
+
+        # Ring of every board a notification was sent to
+        self.rings = {}
+        self.rings_lock = InstrumentedLock('rings')
+
+        # Token to the session of a connected client, and to a dropped client that can still resume
+        self.live = {}
+        self.detached = {}
+        self.lock = InstrumentedLock('sessions')
+
+    def ring(self, board):
+        """Return the EventRing of a board, creating it on first use"""
+        ring = self.rings.get(board)
+        if ring is None:
+            with self.rings_lock:
+                ring = self.rings.get(board)
+                if ring is None:
+                    ring = self.rings[board] = EventRing(board, self.ring_size)
+        return ring
+
+    def positions(self, boards):
+        """Position in the ring of each of the given boards, and of the server-wide notifications"""
+        return {board: self.ring(board).sequence for board in (None, *boards)}
+
+    def issue(self, session):
+        """Give a newly connected client a fresh token and return it"""
+        token = secrets.token_urlsafe(16)
+        with self.lock:
+            if session.token:
+                self.live.pop(session.token, None)
+            session.token = token
+            self.live[token] = session
+        return token
+
+    def resume(self, session, token, username, seen=None):
+        """
+        Hand a dropped client's session over to its new connection. seen maps boards to the number of the
+        last notification the client received on them. Returns (the ring position of every board it was on,
+        the old connection if it was still open) or None if the token is unknown, has expired or belongs to
+        someone else, in which case the new connection has no token yet.
+        """
+        with self.lock:
+            previous = self.live.get(token)
+            if previous is not None and previous is not session and previous.username == username:
+                # The old connection is half open, it is dropped in favour of the new one
+                del self.live[token]
+                state = DetachedSession(username, self.positions(previous.boards), None)
+            else:
+                previous = None
+                state = self.detached.get(token)
+                if state is None or state.username != username or state.expires < monotonic():
+                    return None
+                del self.detached[token]
+
+            if session.token:
+                self.live.pop(session.token, None)
+            session.token = token
+            self.live[token] = session
+
+        # What the client says it received beats where the server thinks it was when the connection dropped
+        positions = {board: (seen or {}).get(board, position) for board, position in state.positions.items()}
+        return positions, previous
+
+    def detach(self, session):
+        """Remember where a client whose connection was lost was, so it can resume its session"""
+        with self.lock:
+            if session.token is None or self.live.get(session.token) is not session:
+                return
+            del self.live[session.token]
+            self.detached[session.token] = DetachedSession(session.username, self.positions(session.boards),
+                                                           monotonic() + self.resume_seconds)
+
+    def discard(self, session):
+        """Forget the session of a client that left for good (exit)"""
+        with self.lock:
+            if session.token is not None and self.live.get(session.token) is session:
+                del self.live[session.token]
+
+    def expire(self):
+        """Forget the dropped clients that did not come back in time, returns how many"""
+        now = monotonic()
+        with self.lock:
+            expired = [token for token, state in self.detached.items() if state.expires < now]
+            for token in expired:
+                del self.detached[token]
+        return len(expired)
+
+    def drop(self, *boards):
+        """Drop the notifications kept for boards that were evicted or deleted"""
+        for board in boards:
+            ring = self.rings.get(board)
+            if ring is not None:
+                with ring.lock:
+                    ring.clear()
+
+    def locks(self):
+        """Return the lock of the sessions, of the rings and of every board's ring"""
+        return [self.lock, self.rings_lock, *(ring.lock for ring in list(self.rings.values()))]
@@ -0,0 +1,217 @@
+import re
+import heapq
+from math import log
+from array import array
+from bisect import bisect_left, bisect_right
+from locks import InstrumentedLock
+
+# Words are runs of letters, digits and underscores, matched case-insensitively
+WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Split text into lowercase search terms"""
+    return WORD.findall(text.lower())
+
+
+class BoardIndex:
+    """
+    Inverted index of a single board's messages.
+
+    Every term maps to the IDs of the messages containing it (its postings)
+    and how often it occurs in each, kept in typed arrays so a posting costs
+    five bytes instead of a Python object. Message IDs only grow, so postings
+    are appended in order and stay sorted, which lets a query walk them
+    with binary searches instead of building sets.
+
+    Messages are added under the index's lock, searches do not take it: they
+    only look at messages up to the newest one indexed when they started.
+    Queries made only of words that occur in a large share of the messages
+    rank the newest MAX_CANDIDATES matching messages and estimate the total,
+    so no query has to score millions of messages.
+    """
+
+    # BM25 parameters: how quickly repeated terms stop adding to the score, and how much long messages are penalized
+    K1 = 1.2
+    B = 0.75
+
+    # Occurrences of a term in the subject count this many times
+    SUBJECT_WEIGHT = 2
+
+    # Most messages scored for a single query
+    MAX_CANDIDATES = 50000
+
+    def __init__(self, name):
+        """BoardIndex constructor"""
+        self.name = name
+
+        # Term to (message IDs, occurrences in each message)
+        self.postings = {}
+
+        # Number of terms in every indexed message, by ID - 1
+        self.lengths = array('I')
+        self.total_length = 0
+
+        # Newest message in the index, messages are indexed in ID order
+        self.indexed_id = 0
+
+        # Serializes adding messages
+        self.lock = InstrumentedLock(f'search:{name}')
+
+    def add(self, record):
+        """Index a message, it must be the one after the newest indexed message (called with the lock held)"""
+        terms = {}
+        for term in tokenize(record['subject']):
+            terms[term] = terms.get(term, 0) + self.SUBJECT_WEIGHT
+        for term in tokenize(record['message']):
+            terms[term] = terms.get(term, 0) + 1
+
+        message_id = record['id']
+        for term, occurrences in terms.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = (array('I'), array('B'))
+            postings[0].append(message_id)
+            postings[1].append(min(occurrences, 255))
+
+        length = sum(terms.values())
+        self.lengths.append(length)
+        self.total_length += length
+        self.indexed_id = message_id
+
+    def search(self, terms, limit):
+        """
+        Return (hits, total, exact) for the messages containing every term. hits are the best
+        limit (score, message ID) pairs, highest score first (newest first on equal scores),
+        total is the number of messages that matched, an estimate if exact is False.
+        """
+        newest = self.indexed_id
+        if not newest or not terms:
+            return [], 0, True
+
+        postings = []
+        for term in set(terms):
+            entry = self.postings.get(term)
+            if entry is None:
+                return [], 0, True
+            postings.append(entry)
+
+        # Walk the rarest term's messages newest first, looking each one up in the other (longer) lists
+        postings.sort(key=lambda entry: len(entry[0]))
+        average = self.total_length / newest
+        weights = [log(1 + (newest - len(ids) + 0.5) / (len(ids) + 0.5)) for ids, _ in postings]
+        positions = [len(ids) for ids, _ in postings]
+        lengths = self.lengths
+
+        best = []
+        total = 0
+        rarest_ids, rarest_counts = postings[0]
+        last = bisect_right(rarest_ids, newest)
+        first = max(last - self.MAX_CANDIDATES, 0)
+        for position in range(last - 1, first - 1, -1):
+            message_id = rarest_ids[position]
+
+            # Score the message if every other term occurs in it too
+            norm = self.K1 * (1 - self.B + self.B * lengths[message_id - 1] / average)
+            occurrences = rarest_counts[position]
+            score = weights[0] * occurrences * (self.K1 + 1) / (occurrences + norm)
+            for index in range(1, len(postings)):
+                ids, counts = postings[index]
+                found = bisect_left(ids, message_id, 0, positions[index])
+                positions[index] = found
+                if found == len(ids) or ids[found] != message_id:
+                    break
+                occurrences = counts[found]
+                score += weights[index] * occurrences * (self.K1 + 1) / (occurrences + norm)
+            else:
+                total += 1
+                entry = (score, message_id)
+                if len(best) < limit:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+
+        # Only the newest candidates were scored, scale the matches up to every candidate
+        if first:
+            return sorted(best, reverse=True), round(total * last / (last - first)), False
+        return sorted(best, reverse=True), total, True
+
+
+class SearchIndex:
+    """
+    Full-text search over the history of every board.
+
+    Each board gets a BoardIndex the first time it is searched, built from
+    the message store once. From then on new messages are added as they are
+    posted (add()), and any the index missed (posted while it was being built,
+    or replicated from another node of a cluster) are picked up from the store
+    before the next search, so searches never scan the history. A board's
+    index is kept while its messages are evicted from the store, it holds far
+    less than the messages themselves and rebuilding it would read the whole
+    history back, so it is only dropped when the board is deleted.
+    """
+
+    # Messages read from the store at a time while an index catches up
+    BATCH = 1000
+
+    def __init__(self, messages):
+        """SearchIndex constructor"""
+        self.messages = messages
+        self.boards = {}
+
+        # Guards creating and dropping board indexes
+        self.lock = InstrumentedLock('search')
+
+    def board_index(self, board):
+        """Return the BoardIndex of a board, creating an empty one on first use"""
+        index = self.boards.get(board)
+        if index is None:
+            with self.lock:
+                index = self.boards.get(board)
+                if index is None:
+                    index = self.boards[board] = BoardIndex(board)
+        return index
+
+    def add(self, board, record):
+        """Index a newly posted message, if the board's index is in use and the message is the next one"""
+        index = self.boards.get(board)
+        if index is None and record['id'] == 1:
+            index = self.board_index(board)
+        if index is None:
+            return
+        with index.lock:
+            if record['id'] == index.indexed_id + 1:
+                index.add(record)
+
+    def catch_up(self, board):
+        """Bring a board's index up to date with the store and return it"""
+        index = self.board_index(board)
+        count = self.messages.count(board)
+        if index.indexed_id < count:
+            with index.lock:
+                while index.indexed_id < count:
+                    records = self.messages.range(board, index.indexed_id + 1, index.indexed_id + self.BATCH)
+                    if not records:
+                        break
+                    for record in records:
+                        index.add(record)
+        return index
+
+    def search(self, board, query, limit=20, offset=0):
+        """
+        Search a board for the messages containing every word of the query, best match first.
+        Returns ([(score, message ID)] for the requested page, total number of matches, whether
+        the total is exact or an estimate).
+        """
+        hits, total, exact = self.catch_up(board).search(tokenize(query), offset + limit)
+        return hits[offset:], total, exact
+
+    def drop(self, *boards):
+        """Forget the indexes of deleted boards"""
+        with self.lock:
+            for board in boards:
+                self.boards.pop(board, None)
+
+    def locks(self):
+        """Return the lock of every board index"""
+        return [self.lock, *(index.lock for index in list(self.boards.values()))]
@@ -1,16 +1,74 @@
 # import necessary libraries
 from socket import *
 import threading
-from datetime import datetime
-import json
 import signal
-from protocol import Protocol
+import argparse
+import os
+from functools import partial
+from time import perf_counter, sleep
+from protocol import FrameBuffer, negotiate
+from message_store import MessageStore
+from message_log import MessageLog
+from membership import Membership
+from groups import GroupRegistry
+from search import SearchIndex
+from resumption import ResumableSessions
+from commands import CommandRegistry
+import replies
+from connection import Session, SocketConnection, WriterPool, RECEIVED_BYTES
+from async_engine import AsyncioEngine
+from metrics import REGISTRY, MetricsEndpoint
+from profiler import SamplingProfiler
+from logger import logger, configure as configure_logging, LEVELS
+
+# Hot path metrics, only counted here and rendered when someone asks for them (stats command or admin endpoint)
+REQUESTS = REGISTRY.counter('bulletin_requests_total', 'Requests handled, by command', labels=('command',))
+REQUEST_LATENCY = REGISTRY.histogram('bulletin_request_duration_seconds', 'Time spent handling a request, by command', labels=('command',))
+NOTIFICATIONS = REGISTRY.counter('bulletin_notifications_total', 'Notifications queued on clients')
+NOTIFY_LATENCY = REGISTRY.histogram('bulletin_notify_duration_seconds', 'Time taken to queue a notification on every recipient')
+POSTED_MESSAGES = REGISTRY.counter('bulletin_messages_posted_total', 'Messages added to the history, by board', labels=('board',))
+ADD_MESSAGE_LATENCY = REGISTRY.histogram('bulletin_add_message_duration_seconds', 'Time taken to store a posted message')
+EVICTED_BOARDS = REGISTRY.counter('bulletin_boards_evicted_total', 'Idle board and group histories dropped from memory')
+RESUMED_SESSIONS = REGISTRY.counter('bulletin_session_resumes_total', 'Reconnecting clients that asked to resume their session, by outcome',
+                                    labels=('outcome',))
 
 
 class BulletinBoardServer(threading.Thread):
     
 
-    def __init__(self, host='localhost', port=6789):
+    # Engines that can be selected at startup to serve client connections
+    ENGINES = ('threaded', 'asyncio')
+
+    # Private groups every new server starts with, more are created (and deleted) by clients at runtime
+    GROUPS = ("group one", "group two", "group three", "group four", "group five")
+
+    # Number of names in a page of the users, groupusers and groups listings by default, and at most
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 500
+
+    # Number of search hits in a page by default and at most, and how deep into the ranking a client can page
+    SEARCH_RESULTS = 20
+    MAX_SEARCH_RESULTS = 50
+    MAX_SEARCH_DEPTH = 1000
+
+    # Seconds a group's history and roster stay in memory after their last use, and how often idle ones are dropped
+    GROUP_IDLE_SECONDS = 300
+    EVICT_INTERVAL = 60
+
+    # Number of messages sent on join when the client does not ask for a specific history window
+    HISTORY_DEPTH = 2
+
+    # Upper bound on the number of messages a single join (or one response to a history request) can return
+    MAX_HISTORY = 500
+
+    # Messages in each response to a history request by default, and the share of its queue limit a client
+    # may have left unread before the next response is sent
+    HISTORY_CHUNK = 100
+    STREAM_WINDOW = 0.25
+
+    def __init__(self, host='localhost', port=6789, engine='threaded', history_depth=HISTORY_DEPTH, data_dir=None,
+                 slow_consumer_policy='disconnect', max_queue_bytes=Session.MAX_QUEUE_BYTES, writer_threads=WriterPool.WORKERS,
+                 profile_dir=None, reuse_port=False):
         """Bulletin Board Server Constructor"""
 
         # Initialize the thread 
@@ -21,38 +79,64 @@ class BulletinBoardServer(threading.Thread):
         self.host = host
         self.port = port
 
+        # Select the engine used to serve clients (thread-per-connection or a single event loop)
+        if engine not in self.ENGINES:
+            raise ValueError(f'Unknown engine {engine!r}, expected one of {self.ENGINES}')
+        self.engine = engine
+
+        # Default number of past messages sent to a client when it joins a board or group
+        self.history_depth = history_depth
+
+        # Every connection gets a bounded outbound queue, drained by writer threads (threaded engine)
+        # or the event loop (asyncio engine), with a policy for clients that can not keep up
+        if slow_consumer_policy not in Session.POLICIES:
+            raise ValueError(f'Unknown slow consumer policy {slow_consumer_policy!r}, expected one of {Session.POLICIES}')
+        self.connection_options = {'policy': slow_consumer_policy, 'max_queue_bytes': max_queue_bytes}
+        self.writer_threads = writer_threads
+
         # Create a socket using IPv4 (AF_INET) and TCP (SOCK_STREAM)
         self.socket = socket(AF_INET, SOCK_STREAM)
 
-        # Initialize bulletin board specific lists
-        self.clients = []
-        self.messages = \
-            {
-                "public board": [],
-                "group one": [],
-                "group two": [],
-                "group three": [],
-                "group four": [],
-                "group five": []
-            }
-        self.message_board_clients = []
-        self.message_board_users = []
-        self.private_group_clients = \
-            {
-                "group one": [],
-                "group two": [],
-                "group three": [],
-                "group four": [],
-                "group five": []
-            }
-        self.private_group_users = \
-            {
-                "group one": [],
-                "group two": [],
-                "group three": [],
-                "group four": [],
-                "group five": []
-            }
+        # Let a restarted server bind straight away instead of waiting for old connections to time out
+        self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+
+        # Workers of a multi-process server all listen on the same port, the kernel spreads connections over them
+        if reuse_port:
+            self.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+
+        # Every private group, saved next to the message log (kept in memory only if data_dir is None)
+        self.groups = GroupRegistry(os.path.join(data_dir, 'groups.json') if data_dir else None, defaults=self.GROUPS)
+
+        # Message history is persisted to an append-only log in data_dir (kept in memory only if it is None),
+        # a group's history is only loaded once it is used and evicted again while idle
+        log = MessageLog(data_dir) if data_dir else None
+        self.messages = MessageStore(["public board"], log=log)
+
+        # Inverted index of every board's messages, built on a board's first search and kept up to date as messages are posted
+        self.search = SearchIndex(self.messages)
+
+        # Connected clients and the roster of the public board and each group in use, every roster has
+        # its own lock so handlers working on different boards never wait on each other
+        self.membership = Membership(["public board"])
+
+        # Session tokens and the recent notifications of every board, so a client whose connection
+        # dropped can reconnect straight onto its boards and be sent what it missed
+        self.resumption = ResumableSessions()
+
+        # Handlers of every command the server understands
+        self.commands = CommandRegistry()
+        self.register_commands()
+
+        # Gauges read from the server's state whenever the metrics are collected
+        self.register_metrics()
+
+        # Sampling profiler, switched on and off while the server runs (SIGUSR1 or the admin endpoint),
+        # reports are written to profile_dir (the signal is left alone if it is None)
+        self.profiler = SamplingProfiler()
+        self.profile_dir = profile_dir
+
+        # Backplane to the rest of the cluster when running as one of several nodes or workers (see cluster.py)
+        self.cluster = None
 
         # Boolean flag to help gracefully shutdown server with SIGINT
         self.running = True
@@ -61,13 +145,17 @@ class BulletinBoardServer(threading.Thread):
     def signal_handler(self, signum, frame):
         """Handle termination signals to stop the server gracefully"""
 
-        print('\nReceived termination signal. Gracefully shutting down the server...')
+        # Workers of a multi-process server may get the signal from the terminal and from the broker
+        if not self.running:
+            return
+
+        logger.info('Received termination signal. Gracefully shutting down the server...')
 
         # Set flag to stop server loop
         self.running = False
 
         # Close all client connections
-        for client in self.clients:
+        for client in self.members():
             client.close()
 
 
@@ -76,12 +164,36 @@ class BulletinBoardServer(threading.Thread):
 
         # Bind socket to the specified host and port
         self.socket.bind((self.host, self.port))
-        self.socket.listen()
-        print(f'Server started on host {self.host}: port {self.port}')
-
-        # Register the signal handler for graceful shutdown
-        signal.signal(signal.SIGINT, self.signal_handler)
+        self.socket.listen(SOMAXCONN)
+        logger.info('Server started on host %s: port %s (%s engine)', self.host, self.port, self.engine)
+
+        # Register the signal handlers, only possible when the server runs on the main thread
+        # (several servers started as threads in one process are stopped by clearing running)
+        if threading.current_thread() is threading.main_thread():
+            # Graceful shutdown
+            signal.signal(signal.SIGINT, self.signal_handler)
+
+            # Let the profiler be toggled with kill -USR1 <pid> (not available on Windows)
+            if self.profile_dir and hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, self.toggle_profiler)
+
+        # Drop the state of idle groups in the background
+        threading.Thread(target=self.evict_loop, name='group-evictor', daemon=True).start()
+
+        # Hand the listening socket to the event loop engine if it was selected
+        if self.engine == 'asyncio':
+            try:
+                AsyncioEngine(self).serve()
+            finally:
+                self.socket.close()
+                self.leave_cluster()
+                self.messages.close()
+                self.report_lock_contention()
+            return
     
+        # Writer threads that deliver queued responses and notifications to the clients
+        self.writers = WriterPool(self.writer_threads)
+
         try:
             # Continuously accept new connections 
             while self.running:
@@ -91,10 +203,13 @@ class BulletinBoardServer(threading.Thread):
                 try:
                     # Accept new connection
                     client_socket, addr = self.socket.accept()
-                    print(f'New client connection from {addr}')
+                    logger.debug('New client connection from %s', addr)
+
+                    # Wrap the socket so handlers can be shared with the asyncio engine
+                    client_socket = SocketConnection(client_socket, addr, self.writers, **self.connection_options)
 
                     # Add cleint socket to the clients list
-                    self.clients.append(client_socket)
+                    self.add_client(client_socket)
 
                     # Start new thread to handle client request
                     client_thread = threading.Thread(target=self.processRequest, args=(client_socket, addr))
@@ -106,200 +221,426 @@ class BulletinBoardServer(threading.Thread):
         
         except Exception as e:
             # Display if any error occurs in server loop
-            print(f'Server Error: {e}')
+            logger.error('Server Error: %s', e)
 
         finally:
             # Before exiting out of the server loop completely, close down the server socket
             self.socket.close()
 
+            # Leave the cluster and make sure every posted message has reached the disk
+            self.leave_cluster()
+            self.messages.close()
+            self.report_lock_contention()
+
+
+    def attach(self, cluster):
+        """Join a cluster through a backplane: posts are sequenced by its broker, notifications and roster changes shared"""
+        self.cluster = cluster
+        self.membership.observer = cluster.roster_change
+
+
+    def leave_cluster(self):
+        """Detach from the cluster on shutdown, the other nodes drop this node's clients from their rosters"""
+        if self.cluster:
+            self.cluster.close()
+
+
+    def evict_loop(self):
+        """Evict idle groups every EVICT_INTERVAL seconds while the server runs"""
+        while self.running:
+            sleep(self.EVICT_INTERVAL)
+            self.evict_idle()
+
+
+    def evict_idle(self, max_idle=GROUP_IDLE_SECONDS):
+        """
+        Drop the history of boards nobody used for max_idle seconds (it stays on disk and is loaded
+        again on next use, their search indexes are kept) and the rosters of groups nobody is in
+        """
+        evicted = self.messages.evict(max_idle, keep=("public board",))
+        self.resumption.drop(*evicted)
+        self.resumption.expire()
+        swept = self.membership.sweep()
+        EVICTED_BOARDS.inc(len(evicted))
+        if evicted or swept:
+            logger.debug('Evicted %d idle histories and %d empty rosters', len(evicted), swept)
+
+
+    def toggle_profiler(self, signum=None, frame=None):
+        """Start the profiler, or stop it and write its report to the profile directory if it is running"""
+        if self.profiler.start():
+            logger.info('Profiler started, send the same signal again to stop it and write the report')
+            return
+
+        self.profiler.stop()
+        path = self.profiler.dump_folded(self.profile_dir)
+        logger.info('Profiler stopped after %d samples, flamegraph stacks written to %s', self.profiler.samples, path)
+
+
+    def profile_report(self, query):
+        """
+        Profile the running server for ?seconds=<n> (10 by default) and return the folded stacks,
+        or the CPU time per command with &format=summary (served by the admin endpoint)
+        """
+        seconds = float(query.get('seconds', ['10'])[0])
+        if not 0 < seconds <= 300:
+            raise ValueError('seconds must be between 0 and 300')
+        stacks = self.profiler.profile(seconds)
+        return self.profiler.summary() if query.get('format') == ['summary'] else stacks
+
 
     def processRequest(self, client_socket, addr):
         """Handle Client Requests"""
 
-        # Initialize username to None
-        username = None
+        # Per-connection buffer that splits the byte stream into individual requests
+        buffer = FrameBuffer()
 
         try:
             # Continuously receive messages from the client
             while True:
-                # Receive and decode the message from the client
-                message = client_socket.recv(1024).decode().strip()
-                if not message:
-                    continue
-                
-                # print(f"Received message from {addr}: {message}")  # Debug log
+                # Read whatever the client sent, an empty read means it closed the connection
+                received = buffer.read_from(client_socket)
+                if not received:
+                    logger.debug('Connection to %s closed by client', addr)
+                    break
+                RECEIVED_BYTES.inc(received)
+
+                # Handle every complete request that arrived, in order, coalescing their responses
+                client_socket.begin_batch()
+                for message in buffer.frames():
+                    # Dispatch the request, stop handling the client if the connection was ended
+                    if not self.handle_request(client_socket, addr, message):
+                        return
 
-                # Parse the message using the Protocol class
-                try:
-                    request = json.loads(message)
-                    header = request.get('header')
-                    command = header.get('command')
-                    username = header.get('username')
-                    group = header.get('group')
-                    body = request.get('body')
-                    data = body.get('data')
-
-                except json.JSONDecodeError:
-                    # Invalid JSON sent by the client
-                    response = Protocol.build_response("error", "FAIL", "Invalid request format.")
-                    client_socket.send((response + '\n').encode())
-                    continue
+                    # Send the rest of a streamed response as fast as the client reads it, before its next request
+                    while client_socket.stream:
+                        client_socket.flush()
+                        client_socket.wait_for_room(int(client_socket.max_queue_bytes * self.STREAM_WINDOW))
+                        self.advance_stream(client_socket)
 
-                # Handle the connect command
-                if command == 'connect':
-                    self.client_connection(client_socket, username)
-                    if not username:
-                        return
+                    # The client may have switched to the binary encoding on connect
+                    buffer.length_prefixed = client_socket.codec.length_prefixed
 
-                # Handle the join command
-                elif command == 'join':
-                    self.client_join(client_socket, username)
-
-                elif command == 'groupjoin':
-                    self.client_groupjoin(client_socket, username, group)
-                    print(f"Processing groupjoin request for group: {group}")
-
-                # Handle the post command
-                elif command == 'post':
-                    self.client_post(client_socket, username, data)
-                    if not username or not data:
-                        continue
-                    
-                # Handle the users command
-                elif command == 'users':
-                    self.get_users(client_socket)
-                    
-                # Handle the message command
-                elif command == 'message':
-                    self.get_message(client_socket, data)
-
-                elif command == 'groupleave':
-                    self.client_groupleave(client_socket, username, group)
-
-                # Handle the leave command
-                elif command == 'leave':
-                    self.client_leave(client_socket, username)
-
-                # Handle the exit command
-                elif command == 'exit':
-                    self.client_exit(client_socket, username)
-                    return
-                
-                # Handle the groups command
-                elif command == 'groups':
-                    self.client_groups(client_socket)
-
-                elif command == 'grouppost':
-                    self.client_post(client_socket, username=username, data=data, group=group)
-
-                # Handle the groupusers command
-                elif command == 'groupusers':
-                    self.get_users(client_socket, username=username, group=group)
-                    
-                # Handle the groupmessage command
-                elif command == 'groupmessage':
-                    self.get_message(client_socket, data=data, group=group, username=username)
-
-                else:
-                    # Command not recognized
-                    response = Protocol.build_response("error", "FAIL", f"Unknown command: {command}")
-                    client_socket.send((response + '\n').encode())  
+                # Write all of the responses to the batch at once
+                client_socket.flush()
+
+                # Stop reading from a client that is not reading its responses until it catches up
+                client_socket.wait_for_room()
+
+        except ConnectionError as e:
+            logger.debug('Connection to %s lost: %s', addr, e)
 
         except Exception as e:
             # Notify if any error occurs within this function
-            print(f'Error when handling request from {addr}: {e}')
+            logger.error('Error when handling request from %s: %s', addr, e)
+
+        # The client went away without an exit command, drop it from every list and close
+        self.remove_client(client_socket, client_socket.username)
+        client_socket.close()
+
+
+    def handle_request(self, client_socket, addr, message):
+        """
+        Parse a single request and dispatch it to its handler.
+        Returns False once the connection has been closed and no more requests should be read.
+        """
+
+        # Parse the message with the encoding the client uses
+        try:
+            request = client_socket.codec.decode(message)
+            header = request.get('header')
+            body = request.get('body')
+            fields = {'username': header.get('username'), 'group': header.get('group'), 'data': body.get('data')}
+
+        except (ValueError, AttributeError):
+            # Invalid request sent by the client, JSON or binary (it has no readable request ID to echo)
+            client_socket.request_id = None
+            REQUESTS.inc(labels=('invalid',))
+            self.send_reply(client_socket, replies.INVALID_REQUEST)
+            return True
+
+        # Remember who is on the other end so the engine can clean up after a dropped connection
+        if fields['username'] and isinstance(fields['username'], str):
+            client_socket.username = fields['username']
+
+        # Responses to this request are tagged with its ID so pipelined requests can be matched up
+        client_socket.request_id = header.get('request_id')
+
+        # Look the command up in the registry and check the request against its schema
+        # (anything but a string, e.g. a list, is an unknown command rather than a failed lookup)
+        name = header.get('command')
+        command = self.commands.get(name) if isinstance(name, str) else None
+        if command is None:
+            # Command not recognized
+            REQUESTS.inc(labels=('unknown',))
+            self.respond(client_socket, "error", "FAIL", f"Unknown command: {header.get('command')}")
+            return True
+
+        error = command.validate(fields)
+        if error:
+            self.respond(client_socket, command.name, "FAIL", error)
+            return True
+
+        # A handler that may wait on the disk or the broker must not hold up the event loop, the asyncio
+        # engine runs it on a thread and only reads the client's next request once it is done
+        if command.blocking and self.engine == 'asyncio':
+            client_socket.deferred = partial(self.run_command, client_socket, command, fields)
+            return True
+
+        self.run_command(client_socket, command, fields)
+
+        # Stop reading once the handler closed the connection (exit, or connect without a username)
+        return not (client_socket.closing or client_socket.closed)
+
+
+    def run_command(self, client_socket, command, fields):
+        """Run a command's handler on a validated request, timing it"""
+        started = perf_counter()
+        if self.profiler.running:
+            with self.profiler.command(command.name):
+                command.handler(client_socket, **command.arguments(fields))
+        else:
+            command.handler(client_socket, **command.arguments(fields))
+        REQUESTS.inc(labels=(command.name,))
+        REQUEST_LATENCY.observe(perf_counter() - started, (command.name,))
+
+
+    def register_commands(self):
+        """Register the handler of every command along with the request fields it takes"""
+        optional_text = (str, None)
+
+        self.commands.register('connect', self.client_connection, username=optional_text, data=(dict, None))
+        self.commands.register('join', self.client_join, username=optional_text, data=(dict, None))
+        self.commands.register('groupjoin', self.client_groupjoin, username=optional_text, group=str, data=(dict, None))
+        self.commands.register('post', self.client_post, username=optional_text, data=optional_text, blocking=True)
+        self.commands.register('grouppost', self.client_post, username=optional_text, group=str, data=optional_text, blocking=True)
+        self.commands.register('users', self.get_users, data=(dict, None))
+        self.commands.register('groupusers', self.get_users, username=optional_text, group=str, data=(dict, None))
+        self.commands.register('message', self.get_message, data=(str, int))
+        self.commands.register('groupmessage', self.get_message, username=optional_text, group=str, data=(str, int))
+        self.commands.register('groupleave', self.client_groupleave, username=optional_text, group=str)
+        self.commands.register('leave', self.client_leave, username=optional_text)
+        self.commands.register('exit', self.client_exit, username=optional_text)
+        self.commands.register('groups', self.client_groups, data=(dict, None))
+        self.commands.register('groupcreate', self.client_groupcreate, username=optional_text, group=str, blocking=True)
+        self.commands.register('groupdelete', self.client_groupdelete, username=optional_text, group=str, blocking=True)
+        self.commands.register('stats', self.client_stats)
+        self.commands.register('search', self.client_search, username=optional_text, group=(str, None), data=dict, blocking=True)
+        self.commands.register('history', self.client_history, username=optional_text, group=(str, None), data=dict)
+
+
+    def register_metrics(self):
+        """Register the gauges describing the server's current state"""
+        def queue_depths():
+            depths = [client.queued_bytes + client.backlog() for client in self.members()]
+            return [(('total',), sum(depths)), (('max',), max(depths, default=0))]
+
+        REGISTRY.gauge('bulletin_connections', 'Connected clients',
+                       lambda: [((), len(self.membership.clients))])
+        REGISTRY.gauge('bulletin_board_subscribers', 'Clients on each board and group',
+                       lambda: [((board,), len(roster.members)) for board, roster in self.membership.rosters.items()],
+                       labels=('board',))
+        REGISTRY.gauge('bulletin_groups', 'Private groups, in total and with their history loaded in memory',
+                       lambda: [(('total',), len(self.groups)), (('loaded',), len(self.messages.boards) - 1)],
+                       labels=('state',))
+        REGISTRY.gauge('bulletin_detached_sessions', 'Clients that lost their connection and can still resume their session',
+                       lambda: [((), len(self.resumption.detached))])
+        REGISTRY.gauge('bulletin_outbound_queue_bytes', 'Bytes waiting to be written to clients, in total and for the most backed up client',
+                       queue_depths, labels=('aggregate',))
 
     
-    def client_connection(self, client_socket, username):
+    def client_connection(self, client_socket, username, data=None):
         # If there is not a username then a failure occurs
         if not username:
-            response = Protocol.build_response("connect", "FAIL", "Username is required to connect.")
-            client_socket.send((response + '\n').encode())
+            self.send_reply(client_socket, replies.USERNAME_REQUIRED)
             client_socket.close()
             return
 
         try:
-            # Display that a user has connected
-            print(f'{username} connected')
+            options = data if isinstance(data, dict) else {}
+
+            # A client that lost its connection can pick its session up again with
+            # {"resume": <token>, "seen": [[<board>, <number of the last notification it received>], ...]}
+            resumed = None
+            if options.get('resume'):
+                seen = self.parse_seen(options.get('seen'))
+                resumed = self.resumption.resume(client_socket, options['resume'], username, seen)
+                RESUMED_SESSIONS.inc(labels=('resumed' if resumed else 'expired',))
+            if resumed:
+                logger.info('%s reconnected', username)
+                positions, previous = resumed
+
+                # The old connection was never closed properly (e.g. half open after a network blip)
+                if previous is not None:
+                    self.remove_client(previous, username)
+                    previous.abort()
+
+                # Boards and groups the client is put back on, unless they were deleted in the meantime
+                boards = [board for board in positions if board == 'public board' or board is not None and board in self.groups]
+            else:
+                # Display that a user has connected and notify all clients in message board about the new connection
+                logger.info('%s connected', username)
+                self.broadcast(f'{username} has joined the server')
+                self.resumption.issue(client_socket)
+
+            # Agree on the encoding for the rest of the connection, the client asks for one with
+            # {"encoding": <name>, "compression": <name>} and gets JSON / no compression if the
+            # server does not support what it asked for (compression needs the binary encoding).
+            # The response still goes out in JSON, both sides switch right after it. It carries
+            # the session token, and the boards the client is back on if it resumed its session.
+            if not options:
+                self.send_reply(client_socket, replies.CONNECTED)
+            else:
+                codec = negotiate(options.get('encoding'), options.get('compression'))
+                self.respond(client_socket, "connect", "OK", {'encoding': codec.name, 'compression': codec.compression,
+                                                               'session': client_socket.token,
+                                                               'resumed': boards if resumed else None},
+                             codec=codec if options.get('encoding') else None)
 
-            # Notify all clients in message board about new connection
-            self.notify(f'{username} has joined the server', clients=self.clients)
+            # Put the client back on its boards and send what it missed, in the encoding it just switched to
+            if resumed:
+                self.resume_session(client_socket, positions, boards)
 
-            # Build and Send Response
-            response = Protocol.build_response("connect", "OK")
-            client_socket.send((response + '\n').encode())
-        
         except Exception as e:
             # Notify if any error occurs within this function
-            print(f'Error when handling request from {username}: {e}')
-            response = Protocol.build_response("connect", "FAIL")
-            client_socket.send((response + '\n').encode())
+            logger.error('Error when handling request from %s: %s', username, e)
+            self.send_reply(client_socket, replies.CONNECT_FAILED)
 
     
-    def client_join(self, client_socket, username):
+    def parse_seen(self, seen):
+        """
+        Read the number of the last notification a resuming client received on each board, sent as
+        [[<board>, <number>], ...] with board null for the server-wide notifications. Returns {board: number},
+        malformed entries are left out (the client is then sent what came after its connection dropped).
+        """
+        if not isinstance(seen, list):
+            return {}
+        return {entry[0]: entry[1] for entry in seen
+                if isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], (str, type(None)))
+                and type(entry[1]) is int and entry[1] >= 0}
+
+
+    def resume_session(self, client_socket, positions, boards):
+        """
+        Put a reconnected client back on the given boards and groups without announcing it, and send it the
+        notifications of each board (and the server-wide ones) sent since its position in the board's ring,
+        with their numbers. Rejoining and reading the ring happen under the ring's lock, so every notification
+        reaches the client exactly once, either replayed or live. The rest of the cluster only hears about the
+        rejoin once the lock is released, the broker relays notifications to this node under its own lock.
+        If the ring no longer holds some of them, the client is told how many it missed (it can fetch the
+        messages with the history command).
+        """
+        for board in (None, *boards):
+            ring = self.resumption.ring(board)
+            with ring.lock:
+                joined = board is not None and self.membership.join(board, client_socket, announce=False)
+                missed, events = ring.since(positions[board])
+                if missed:
+                    self.notify(f'{missed} notifications {f"on {board} " if board else ""}were missed while you were disconnected.',
+                                clients=[client_socket])
+                for sequence, data in events:
+                    self.notify(data, clients=[client_socket], board=board, sequence=sequence)
+            if joined:
+                self.membership.announce(board, client_socket.username, 1)
+
+
+    def client_join(self, client_socket, username, data=None):
         """Handle a client joining the message board."""
-        if client_socket in self.message_board_clients:
-            response = Protocol.build_response("join", "FAIL", "You are already connected to the message board.")
-            client_socket.send((response + '\n').encode())
+        # Make sure the requested history window is valid before joining
+        try:
+            history = self.parse_history_request(data)
+        except ValueError as e:
+            self.respond(client_socket, "join", "FAIL", str(e))
             return
 
-        # Add the client to the message board list
-        self.message_board_clients.append(client_socket)
-        print(f"{username} joined the message board.")
-        
-        # Add the username to the default board users list
-        self.message_board_users.append(username)
-
-        # Send the last two messages in the message history
-        if len(self.messages["public board"]) > 0:
-            history_data = [json.loads(msg) for msg in (self.messages["public board"][-2:] if len(self.messages["public board"]) >= 2 else self.messages["public board"])]
-            response = Protocol.build_response("join", "OK", history_data)
+        # Check and update the roster in one step so two joins can not race
+        if not self.membership.join("public board", client_socket):
+            self.send_reply(client_socket, replies.ALREADY_ON_BOARD)
+            return
+        logger.info('%s joined the message board.', username)
+
+        # Send the requested window of the message history (by default the last two messages)
+        history_data = self.join_history("public board", history)
+        if history_data:
+            self.respond(client_socket, "join", "OK", history_data)
+        elif history[0] == 'since':
+            self.send_reply(client_socket, replies.NO_NEW_BOARD_MESSAGES)
         else:
-            response = Protocol.build_response("join", "OK", "There are no messages on the board yet.")
-        client_socket.send((response + '\n').encode())
+            self.send_reply(client_socket, replies.NO_BOARD_MESSAGES)
 
         # Notify others on the board
-        self.notify(f"{username} has joined the message board.", clients=self.message_board_clients, sender=client_socket)
+        self.broadcast(f"{username} has joined the message board.", "public board", sender=client_socket)
 
 
-    def client_groupjoin(self, client_socket, username, group):
+    def client_groupjoin(self, client_socket, username, group, data=None):
+        logger.debug('Processing groupjoin request for group: %s', group)
         group = group.strip().lower()  # Clean up input
 
         """Handle a client joining a private group."""
         # Check if the user has joined the public message board
-        if client_socket not in self.message_board_clients:
-            response = Protocol.build_response("groupjoin", "FAIL", "You are not a member of the public message board.")
-            client_socket.send((response + '\n').encode())
+        if not self.membership.is_member("public board", client_socket):
+            self.send_reply(client_socket, replies.GROUPJOIN_NOT_ON_BOARD)
             return
 
-        if not group or group not in self.private_group_users:
-            response = Protocol.build_response("groupjoin", "FAIL", "The specified group does not exist.")
-            client_socket.send((response + '\n').encode())
+        if not group or group not in self.groups:
+            self.send_reply(client_socket, replies.GROUPJOIN_NO_SUCH_GROUP)
             return
 
-        # Check if already in the group
-        if client_socket in self.private_group_clients[group]:
-            response = Protocol.build_response("groupjoin", "FAIL", "You are already a member of this group.")
-            client_socket.send((response + '\n').encode())
+        # Make sure the requested history window is valid before joining
+        try:
+            history = self.parse_history_request(data)
+        except ValueError as e:
+            self.respond(client_socket, "groupjoin", "FAIL", str(e))
             return
 
-        # Add the client to the group
-        self.private_group_clients[group].append(client_socket)
-        print(f"{username} joined {group}.")
-        
-        # Add the username to the private group users list
-        self.private_group_users[group].append(username)
+        # Check if already in the group and add the client in one step so two joins can not race
+        if not self.membership.join(group, client_socket):
+            self.send_reply(client_socket, replies.ALREADY_IN_GROUP)
+            return
+        logger.info('%s joined %s.', username, group)
 
-        # Send group history or no messages notice
-        group_messages = [json.loads(msg) for msg in self.messages[group]]
+        # Send the requested window of the group history or no messages notice
+        group_messages = self.join_history(group, history)
         if group_messages:
-            response = Protocol.build_response("groupjoin", "OK", group_messages[-2:])
+            self.respond(client_socket, "groupjoin", "OK", group_messages)
+        elif history[0] == 'since':
+            self.send_reply(client_socket, replies.NO_NEW_GROUP_MESSAGES)
         else:
-            response = Protocol.build_response("groupjoin", "OK", "There are no messages in this group yet.")
-        client_socket.send((response + '\n').encode())
+            self.send_reply(client_socket, replies.NO_GROUP_MESSAGES)
 
         # Notify other group members
-        self.notify(f"{username} has joined {group}.", clients=self.private_group_clients[group], sender=client_socket)
+        self.broadcast(f"{username} has joined {group}.", group, sender=client_socket)
+
+
+    def parse_history_request(self, data):
+        """
+        Parse the history window a client asked for when joining a board or group.
+        The data field may be empty (the server default), {"last": K} for the newest K
+        messages, or {"since": ID} for every message posted after the given ID.
+        Returns a (mode, value) pair or raises ValueError if the request is malformed.
+        """
+        if not data:
+            return 'last', self.history_depth
+
+        if isinstance(data, dict) and len(data) == 1:
+            mode, value = next(iter(data.items()))
+            if mode in ('last', 'since') and isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+                return mode, value
+
+        raise ValueError('Invalid history request. Use {"last": <count>} or {"since": <message id>}.')
+
+
+    def join_history(self, board, history):
+        """
+        Return the window of a board's history described by a parsed history request.
+        Only the returned messages are touched, no matter how long the history is.
+        """
+        mode, value = history
+        if mode == 'since':
+            # Everything after the given ID, up to the limit for a single response
+            return self.messages.range(board, value + 1, value + self.MAX_HISTORY)
+
+        return self.messages.last(board, min(value, self.MAX_HISTORY))
 
 
     def client_post(self, client_socket, username, data, group=None):
@@ -310,8 +651,7 @@ class BulletinBoardServer(threading.Thread):
 
             # Check for valid data and return fail if not
             if not username or not data:
-                response = Protocol.build_response(command, "FAIL", "Invalid message. Please ensure both username and message are provided.")
-                client_socket.send((response + '\n').encode())
+                self.send_reply(client_socket, replies.POST_INCOMPLETE[command])
                 return
 
             # Grab the subject and message out of data field
@@ -320,43 +660,39 @@ class BulletinBoardServer(threading.Thread):
 
             if len(parts) < 2 or not parts[0].strip() or not parts[1].strip():
                 # Ensure both subject and message exist and are non-empty
-                response = Protocol.build_response(command, "FAIL", "Invalid message format. Both subject and content are required.")
-                client_socket.send((response + '\n').encode())
+                self.send_reply(client_socket, replies.POST_BAD_FORMAT[command])
                 return
             
             # Now that the subject and message are separated they get stored in subject and message variables
             subject, message = parts[0].strip(), parts[1].strip()
 
             # Check if the user has joined the public message board
-            if client_socket not in self.message_board_clients:
-                response = Protocol.build_response(command, "FAIL", "You are not a member of the public message board.")
-                client_socket.send((response + '\n').encode())
+            if not self.membership.is_member("public board", client_socket):
+                self.send_reply(client_socket, replies.POST_NOT_ON_BOARD[command])
                 return
 
             # Check if the the user is in the specified private group
-            if group and group not in self.private_group_users:
-                response = Protocol.build_response(command, "FAIL", "You are not a member of the specified group.")
-                client_socket.send((response + '\n').encode())
+            if group and group not in self.groups:
+                self.send_reply(client_socket, replies.POST_NO_SUCH_GROUP[command])
                 return
 
             # Add client's message to the board's history
-            message_id, timestamp = self.add_message(sender=username, subject=subject, message=message, group=group)
-
-            # Notify all in the board or group of the new message with the sender specified
             board = group if group else 'public board'
-            clients = self.private_group_clients[group] if group else self.message_board_clients
-            self.notify(f'{board}; Message ID: {message_id}, Sender: {username}, Time Posted: {timestamp}, Subject: {subject}\n\t{message}', clients=clients)
+            record = self.add_message(sender=username, subject=subject, message=message, group=group)
+
+            # Notify all in the board or group of the new message with the sender specified (on a
+            # cluster every node does so as messages arrive from the broker, in ID order)
+            if not self.cluster:
+                self.deliver(self.post_notice(board, record), board)
 
             # Send Response
-            response = Protocol.build_response(command, "OK")
-            client_socket.send((response + '\n').encode())
+            self.send_reply(client_socket, replies.POSTED[command])
 
         # Send Bad Response
         except Exception as e:
             # Notify if any error occurs within this function
-            print(f'Error when handling request from {username}: {e}')
-            response = Protocol.build_response(command, "FAIL", "Invalid Message")
-            client_socket.send((response + '\n').encode())
+            logger.error('Error when handling request from %s: %s', username, e)
+            self.send_reply(client_socket, replies.POST_FAILED[command])
 
 
     def client_groupleave(self, client_socket, username, group):
@@ -364,59 +700,40 @@ class BulletinBoardServer(threading.Thread):
         group = group.strip().lower()  # Clean up input
 
         # Check if the group exists
-        if not group or group not in self.private_group_users:
-            response = Protocol.build_response("groupleave", "FAIL", "Invalid group name. The group does not exist.")
-            client_socket.send((response + '\n').encode())
+        if not group or group not in self.groups:
+            self.send_reply(client_socket, replies.GROUPLEAVE_NO_SUCH_GROUP)
             return
 
-        # Check if the client is a member of the group
-        if client_socket not in self.private_group_clients[group]:
-            response = Protocol.build_response("groupleave", "FAIL", "You are not a member of this group.")
-            client_socket.send((response + '\n').encode())
+        # Check if the client is a member of the group and remove it in one step
+        if not self.membership.leave(group, client_socket):
+            self.send_reply(client_socket, replies.GROUPLEAVE_NOT_MEMBER)
             return
-
-        # Remove the client from the group
-        self.private_group_clients[group].remove(client_socket)
-        print(f"{username} left {group}.")
-        
-        # Remove the username from the private group users list
-        self.private_group_users[group].remove(username)
+        logger.info('%s left %s.', username, group)
 
         # Notify the user that they have successfully left the group
-        confirmation = Protocol.build_response("groupleave", "OK", f"You have left {group}.")
-        client_socket.send((confirmation + '\n').encode())
+        self.respond(client_socket, "groupleave", "OK", f"You have left {group}.")
 
         # Notify other group members
-        self.notify(f"{username} has left {group}.", clients=self.private_group_clients[group], sender=client_socket)
+        self.broadcast(f"{username} has left {group}.", group, sender=client_socket)
 
         # Add the client back to the main message board
-        if client_socket not in self.message_board_clients:
-            self.message_board_clients.append(client_socket)
-            if username not in self.message_board_users:  
-                self.message_board_users.append(username)
-            print(f"{username} rejoined the message board.")
+        if self.membership.join("public board", client_socket):
+            logger.info('%s rejoined the message board.', username)
 
 
     def client_leave(self, client_socket, username):
         """Handle a client leaving the message board."""
-        if client_socket not in self.message_board_clients:
-            response = Protocol.build_response("leave", "FAIL", "You are not currently connected to the message board.")
-            client_socket.send((response + '\n').encode())
+        # Check the client is on the board and remove it in one step
+        if not self.membership.leave("public board", client_socket):
+            self.send_reply(client_socket, replies.LEAVE_NOT_ON_BOARD)
             return
-
-        # Remove the client from the message board list
-        self.message_board_clients.remove(client_socket)
-        print(f"{username} left the message board.")
-        
-        # Remove the username from the default board list
-        self.message_board_users.remove(username)
+        logger.info('%s left the message board.', username)
 
         # Notify the leaving client
-        response = Protocol.build_response("leave", "OK", "You have left the message board.")
-        client_socket.send((response + '\n').encode())
+        self.send_reply(client_socket, replies.LEFT_BOARD)
 
         # Notify others on the board
-        self.notify(f"{username} has left the message board.", clients=self.message_board_clients, sender=client_socket)
+        self.broadcast(f"{username} has left the message board.", "public board", sender=client_socket)
 
     
     def client_exit(self, client_socket, username=None):
@@ -424,104 +741,308 @@ class BulletinBoardServer(threading.Thread):
         try:
             # If there is a username, notify all (including the server) that <username> has left
             if username:
-                self.notify(f'{username} has left the server', clients=self.clients, sender=client_socket)
-                print(f'{username} disconnected')
-
-            # Remove the client socket and username from any lists they may be in
-            if client_socket in self.message_board_clients:
-                self.message_board_clients.remove(client_socket)
-            if username in self.message_board_users:
-                self.message_board_users.remove(username)
-            for key in self.private_group_clients.keys():
-                if client_socket in self.private_group_clients.get(key, []):
-                    self.private_group_clients[key].remove(client_socket)
-                if username in self.private_group_users.get(key, []):
-                    self.private_group_users[key].remove(username)
+                self.broadcast(f'{username} has left the server', sender=client_socket)
+                logger.info('%s disconnected', username)
 
-            # Send a success response to the client for the exit command
-            response = Protocol.build_response("exit", "OK", "You have successfully exited.")
-            client_socket.send((response + '\n').encode())
+            # Remove the client socket and username from any lists they may be in, for good
+            self.resumption.discard(client_socket)
+            self.remove_client(client_socket, username)
 
-            # Remove the client socket from connected clients list
-            self.clients.remove(client_socket)
+            # Send a success response to the client for the exit command
+            self.send_reply(client_socket, replies.EXITED)
 
             # Close down the socket
             client_socket.close()
             
         except Exception as e:
             # Notify if any error occurs within this function
-            print(f'Error when handling request from {username}: {e}')
-            response = Protocol.build_response("exit", "FAIL", f"An error occurred while processing the exit request: {e}")
-            client_socket.send((response + '\n').encode())
+            logger.error('Error when handling request from %s: %s', username, e)
+            self.respond(client_socket, "exit", "FAIL", f"An error occurred while processing the exit request: {e}")
+
 
+    def add_client(self, client_socket):
+        """Add a newly accepted client to the connected clients"""
+        self.membership.connect(client_socket)
 
-    def client_groups(self, client_socket):
-        """Display a lists of groups"""
+
+    def members(self, board=None):
+        """Return a snapshot of the clients on a board or group (every connected client if board is None)"""
+        return self.membership.members(board)
+
+
+    def remove_client(self, client_socket, username=None):
+        """
+        Remove a client from the boards it is on (found through its own list of boards) and the connected clients.
+        Unless it exited, the client can resume its session for a while (see resume_session()).
+        """
+        self.resumption.detach(client_socket)
+        self.membership.disconnect(client_socket)
+
+
+    def report_lock_contention(self):
+        """Log how often each lock on the shared state was contended and how long it was held"""
+        locks = [*self.membership.locks(), *self.messages.locks(), *self.groups.locks(), *self.search.locks(),
+                 *self.resumption.locks()]
+        for stats in sorted((lock.stats() for lock in locks), key=lambda stats: stats['wait_seconds'], reverse=True):
+            if stats['acquisitions']:
+                logger.info('Lock %s: %d acquisitions, %d contended, waited %.3f ms (max %.3f ms), held %.3f ms (max %.3f ms)',
+                            stats['name'], stats['acquisitions'], stats['contended'],
+                            stats['wait_seconds'] * 1000, stats['max_wait_seconds'] * 1000,
+                            stats['hold_seconds'] * 1000, stats['max_hold_seconds'] * 1000)
+
+
+    def client_groups(self, client_socket, data=None):
+        """
+        Send one page of group names in alphabetical order, or only how many there are.
+        See parse_page_request for the page a client can ask for.
+        """
         try:
-            # Grab the list of groups and format into a string seperated by commas
-            groups = [key for key in self.private_group_users.keys()]
-            formatted_groups = ", ".join(groups)
+            # Pick the page the client asked for
+            try:
+                after, limit, prefix, count_only = self.parse_page_request(data)
+            except ValueError as e:
+                self.respond(client_socket, "groups", "FAIL", str(e))
+                return
+
+            # Only the names on the page are copied out of the registry's sorted index
+            if count_only:
+                listing = {'total': self.groups.count(prefix)}
+            else:
+                names, cursor = self.groups.page(after, limit, prefix)
+                listing = {'groups': names, 'next': cursor, 'total': self.groups.count(prefix)}
 
-            # Build and send a response containing the string list of the groups
-            response = Protocol.build_response("groups", "OK", formatted_groups)
-            client_socket.send((response + '\n').encode())
+            # Build and send a response containing the page and where the next one starts
+            self.respond(client_socket, "groups", "OK", listing)
 
         except Exception as e:
             # If any point in the process above failed, send a FAIL response
-            response = Protocol.build_response("groups", "FAIL", f"An error occurred while retrieving group information: {e}")
-            client_socket.send((response + '\n'))
+            self.respond(client_socket, "groups", "FAIL", f"An error occurred while retrieving group information: {e}")
+
+
+    def parse_page_request(self, data):
+        """
+        Parse the page of a listing (users, groupusers, groups) a client asked for. The data field may
+        be empty (the first page), {"after": <name>, "limit": <count>, "prefix": <text>} with any of
+        the keys, or {"count": true, "prefix": <text>} for only the number of (matching) names.
+        Responses carry the page, the name to ask for the next page after (null on the last page)
+        and the total number of matches. Returns (after, limit, prefix, count only) or raises ValueError.
+        """
+        if not data:
+            return None, self.PAGE_SIZE, '', False
+
+        after, limit = data.get('after'), data.get('limit', self.PAGE_SIZE)
+        prefix, count_only = data.get('prefix', ''), data.get('count', False)
+        if (set(data) <= {'after', 'limit', 'prefix', 'count'} and isinstance(after, (str, type(None)))
+                and isinstance(limit, int) and not isinstance(limit, bool) and limit > 0
+                and isinstance(prefix, str) and isinstance(count_only, bool)):
+            return after, min(limit, self.MAX_PAGE_SIZE), prefix, count_only
+
+        raise ValueError('Invalid page request. Use {"after": <name>, "limit": <count>, "prefix": <text>} or {"count": true}.')
+
+
+    def client_groupcreate(self, client_socket, username, group):
+        """Create a new private group, the creator is the only one who can delete it again"""
+        group = group.strip().lower()  # Clean up input
+
+        # Check if the user has joined the public message board
+        if not self.membership.is_member("public board", client_socket):
+            self.send_reply(client_socket, replies.GROUPCREATE_NOT_ON_BOARD)
+            return
 
+        if not GroupRegistry.valid_name(group):
+            self.send_reply(client_socket, replies.GROUPCREATE_INVALID_NAME)
+            return
+
+        try:
+            # Register the group (through the broker on a cluster, so two nodes can not create the same name)
+            if self.cluster:
+                created = self.cluster.group_change('create', group, username)
+            else:
+                created = self.groups.create(group, username) is not None
+        except Exception as e:
+            logger.error('Error when handling request from %s: %s', username, e)
+            self.send_reply(client_socket, replies.GROUPCREATE_FAILED)
+            return
+
+        if not created:
+            self.send_reply(client_socket, replies.GROUPCREATE_EXISTS)
+            return
+        logger.info('%s created %s.', username, group)
+
+        self.respond(client_socket, "groupcreate", "OK", f"Group {group} created.")
+
+
+    def client_groupdelete(self, client_socket, username, group):
+        """Delete a private group created by the client, its members are removed and its history discarded"""
+        group = group.strip().lower()  # Clean up input
+
+        # Check if the user has joined the public message board
+        if not self.membership.is_member("public board", client_socket):
+            self.send_reply(client_socket, replies.GROUPDELETE_NOT_ON_BOARD)
+            return
+
+        existing = self.groups.get(group)
+        if existing is None:
+            self.send_reply(client_socket, replies.GROUPDELETE_NO_SUCH_GROUP)
+            return
+
+        # The built-in groups have no creator and can not be deleted
+        if existing.creator is None or existing.creator != username:
+            self.send_reply(client_socket, replies.GROUPDELETE_NOT_CREATOR)
+            return
+
+        try:
+            # Every node of a cluster drops the group once the broker has deleted it
+            if self.cluster:
+                deleted = self.cluster.group_change('delete', group, username)
+            else:
+                deleted = self.remove_group(group, username)
+        except Exception as e:
+            logger.error('Error when handling request from %s: %s', username, e)
+            self.send_reply(client_socket, replies.GROUPDELETE_FAILED)
+            return
+
+        if not deleted:
+            self.send_reply(client_socket, replies.GROUPDELETE_NO_SUCH_GROUP)
+            return
+
+        self.respond(client_socket, "groupdelete", "OK", f"Group {group} deleted.")
+
+
+    def remove_group(self, group, username):
+        """Delete a group: drop it from the registry, remove and notify its members and discard its history"""
+        if self.groups.delete(group) is None:
+            return False
+        logger.info('%s deleted %s.', username, group)
+
+        # Remove and notify whoever was still in the group
+        members = self.membership.drop(group)
+        self.notify(f"{group} was deleted by {username}.", clients=members)
+
+        self.messages.delete(group)
+        self.search.drop(group)
+        self.resumption.drop(group)
+        return True
 
-    def notify(self, data, clients, sender=None):
-        """Broadcast message to a selected group of clients except the sender."""
+
+    def client_stats(self, client_socket):
+        """Send the server's metrics in the Prometheus text format"""
+        self.respond(client_socket, "stats", "OK", REGISTRY.render())
+
+
+    def send_reply(self, client_socket, reply):
+        """Send a fixed, already encoded response to the client's current request"""
+        client_socket.send(reply.encode(client_socket.codec, client_socket.request_id))
+
+
+    def respond(self, client_socket, command, status, data=None, codec=None):
+        """
+        Build a response to the client's current request, tagged with its request ID, and send it.
+        If a codec is given the client switches to it once the response is queued.
+        """
+        response = client_socket.codec.encode_response(command, status, data, request_id=client_socket.request_id)
+        client_socket.send(response, codec=codec)
+
+
+    def notify(self, data, clients, sender=None, board=None, sequence=None):
+        """
+        Broadcast message to a selected group of clients except the sender.
+        The notification is only queued on each client, so posting never waits on a slow subscriber.
+        A notification kept in a board's ring (see deliver()) carries the board in its group field (null for
+        the server-wide ones) and its number in the ring in its sequence field, a client resuming its
+        session says which number it got to on every board.
+        """
+        started = perf_counter()
         escaped_data = data.replace('\n', '\\n')
-        notification_payload = Protocol.build_request("notify", data=escaped_data)
-        encoded_message = (notification_payload + '\n').encode()
 
-        # Iterate through each client and send the encoded message
+        # Encode the notification once per encoding in use
+        encoded_messages = {}
+        def encode(codec):
+            encoded_message = encoded_messages.get(codec)
+            if encoded_message is None:
+                encoded_message = encoded_messages[codec] = codec.encode_request("notify", group=board, data=escaped_data,
+                                                                                 sequence=sequence)
+            return encoded_message
+
+        # Queue the same encoded bytes on every client (nothing is copied per recipient),
+        # the slow consumer policy applies to full queues
+        recipients = 0
         for client in clients:
             if client != sender: 
-                try: 
-                    client.send(encoded_message)
-                except Exception as e:
-                    print(f'Failed to send message to a client ({client}): {e}')
+                client.notify(encode)
+                recipients += 1
+
+        NOTIFICATIONS.inc(recipients)
+        NOTIFY_LATENCY.observe(perf_counter() - started)
     
 
-    def add_message(self, sender, subject, message, group=None):
-        """Add message to the server's message history"""
+    def deliver(self, data, board=None, sender=None):
+        """
+        Notify the clients on a board (every client if board is None) except the sender, on this node only.
+        The notification is kept in the board's ring for clients that resume their session later,
+        see resume_session().
+        """
+        ring = self.resumption.ring(board)
+        with ring.lock:
+            ring.append(data)
+            sequence = ring.sequence
+            clients = self.members(board)
+        self.notify(data, clients=clients, sender=sender, board=board, sequence=sequence)
 
-        # Get the current timestamp and format into a readable form
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        # Determine the key to use for access the message history dictionary
+    def broadcast(self, data, board=None, sender=None):
+        """Notify the clients on a board (every client if board is None) except the sender, on every node of the cluster"""
+        self.deliver(data, board, sender=sender)
+        if self.cluster:
+            self.cluster.notify(board, data)
+
+
+    def post_notice(self, board, record):
+        """Notification announcing a new message to the board's members"""
+        return (f"{board}; Message ID: {record['id']}, Sender: {record['sender']}, Time Posted: {record['timestamp']}, "
+                f"Subject: {record['subject']}\n\t{record['message']}")
+
+
+    def add_message(self, sender, subject, message, group=None):
+        """Add message to the server's message history and return the stored record"""
+
+        # Determine the key to use for access the message history
         group = 'public board' if not group else group
 
-        # Create a dictionary (that will be converted to JSON) to represent the message
-        formatted_message = {
-            'id': len(self.messages[group]) + 1,
-            'sender': sender,
-            'timestamp': timestamp,
-            'subject': subject,
-            'message': message
-        }
+        # Store the message, the store (or the broker of a cluster) assigns
+        # the next ID on the board and the timestamp
+        started = perf_counter()
+        if self.cluster:
+            record = self.cluster.post(group, sender=sender, subject=subject, message=message)
+        else:
+            record = self.messages.add(group, sender=sender, subject=subject, message=message)
+        ADD_MESSAGE_LATENCY.observe(perf_counter() - started)
+        POSTED_MESSAGES.inc(labels=(group,))
 
-        # Convert the dictionary to JSON-formatted string and append to message history
-        self.messages[group].append(json.dumps(formatted_message))
+        # Make the message searchable straight away
+        self.search.add(group, record)
 
-        return formatted_message['id'], timestamp
+        return record
 
-    def get_users(self, client_socket, username=None, group=None):
+    def get_users(self, client_socket, username=None, group=None, data=None):
         """ 
         Retrieve a list of users in the same group.
         If they aren't in a group, get the list of users
         from the default (public) board. 
+        The list comes a page at a time in alphabetical order (see parse_page_request).
         """
         
         try:
             # Check if the client is in the message board clients list
-            if client_socket not in self.message_board_clients:
-                response = Protocol.build_response("users", "FAIL", "Current user is not in a message board.")
-                client_socket.send((response + '\n').encode())
+            if not self.membership.is_member("public board", client_socket):
+                self.send_reply(client_socket, replies.USERS_NOT_ON_BOARD)
+                return
+
+            # Pick the page the client asked for
+            try:
+                after, limit, prefix, count_only = self.parse_page_request(data)
+            except ValueError as e:
+                self.respond(client_socket, "users", "FAIL", str(e))
                 return
 
             # If a group is specified, retrieve users in that group
@@ -530,38 +1051,33 @@ class BulletinBoardServer(threading.Thread):
                 group = group.strip('"').strip().lower()
 
                 # Check if the group exists
-                if group not in self.private_group_users:
-                    response = Protocol.build_response("users", "FAIL", "Group does not exist.")
-                    client_socket.send((response + '\n').encode())
+                if group not in self.groups:
+                    self.send_reply(client_socket, replies.USERS_NO_SUCH_GROUP)
                     return
                               
                 # If the current user is not in the group, return a failure response
-                # based on username
-                if username not in self.private_group_users[group]:
-                    response = Protocol.build_response("users", "FAIL", "Current user is not in the group. Access Denied.")
-                    client_socket.send((response + '\n').encode())
+                if not self.membership.is_member(group, client_socket):
+                    self.send_reply(client_socket, replies.USERS_NOT_IN_GROUP)
                     return
 
-                # Retrieve the list of users in the specified group
-                group_users = self.private_group_users[group]
-                user_list = ', '.join(group_users)
-            else:
-                # Retrieve the list of users in the default group
-                user_list = ', '.join(self.message_board_users)
+            board = group if group else "public board"
 
-            # Build response from users list
-            response = Protocol.build_response("users", "OK", user_list)
+            # Retrieve one page of the users on the board or group from its sorted index
+            if count_only:
+                listing = {'total': self.membership.count(board, prefix)}
+            else:
+                usernames, cursor, total = self.membership.page(board, after, limit, prefix)
+                listing = {'users': usernames, 'next': cursor, 'total': total}
 
-            # Send response
-            client_socket.send((response + '\n').encode())
+            # Build and send response from users list
+            self.respond(client_socket, "users", "OK", listing)
 
         except Exception as e:
             # Notify if any error occurs within this function
-            print(f'Error when handling users request: {e}')
+            logger.error('Error when handling users request: %s', e)
 
             # Send a failure response
-            response = Protocol.build_response("users", "FAIL")
-            client_socket.send((response + '\n').encode())
+            self.send_reply(client_socket, replies.USERS_FAILED)
             
     def get_message(self, client_socket, data, group=None, username=None):
         """ 
@@ -574,50 +1090,263 @@ class BulletinBoardServer(threading.Thread):
             message_id = int(data)
 
             # Check if the client is in the message board clients list
-            if client_socket not in self.message_board_clients:
-                response = Protocol.build_response("message", "FAIL", "Current user is not in a message board.")
-                client_socket.send((response + '\n').encode())
+            if not self.membership.is_member("public board", client_socket):
+                self.send_reply(client_socket, replies.MESSAGE_NOT_ON_BOARD)
                 return
 
             # If a group is specified, check if the client is a member of the group
             if group:
                 group = group.strip('"').strip().lower()
 
-            # Check if there is an invalid ID given
+            # Check access first, so the history of a group is only ever loaded for its members
             message_group = 'public board' if not group else group
-            if message_id < 0 or message_id > len(self.messages[message_group]):
-                # Return a failure response
-                response = Protocol.build_response("message", "FAIL", "Invalid message ID.")
-                client_socket.send((response + '\n').encode())
+            if group and not self.membership.is_member(message_group, client_socket):
+                # search in the group for the current username to check their access
+                # if they are not in the group return an error
+                self.send_reply(client_socket, replies.MESSAGE_NOT_IN_GROUP)
                 return
 
-            # Search through messages for the message with the given id
-            for message in self.messages[message_group]:
-                # Format the message into a dictionary for ease of use
-                message_dict = json.loads(message)
-                # Search by ID
-                if int(message_dict['id']) == message_id:
-                    if group and username not in self.private_group_users[message_group]:
-                        # search in the group for the current username to check their access
-                        # if they are not in the group return an error
-                        response = Protocol.build_response("message", "FAIL", "Current user is not in the group. Access Denied.")
-                        client_socket.send((response + '\n').encode())
-                        return
-                    formatted_message = f"Subject: {message_dict['subject']}\nMessage: {message_dict['message']}"
-                    response = Protocol.build_response("message", "OK", formatted_message)
-                    client_socket.send((response + '\n').encode())
-                    return
+            # Look the message up directly by its ID
+            message_dict = self.messages.get(message_group, message_id)
+            if message_dict is None:
+                # Return a failure response if there is an invalid ID given
+                self.send_reply(client_socket, replies.INVALID_MESSAGE_ID)
+                return
+
+            formatted_message = f"Subject: {message_dict['subject']}\nMessage: {message_dict['message']}"
+            self.respond(client_socket, "message", "OK", formatted_message)
 
         except ValueError:
             # If the data represents a non-integer
-            response = Protocol.build_response("message", "FAIL", "Invalid message ID.")
-            client_socket.send((response + '\n').encode())
+            self.send_reply(client_socket, replies.INVALID_MESSAGE_ID)
         except Exception as e:
-            print(f'Error when handling message request: {e}')
-            response = Protocol.build_response("message", "FAIL")
-            client_socket.send((response + '\n').encode())
+            logger.error('Error when handling message request: %s', e)
+            self.send_reply(client_socket, replies.MESSAGE_FAILED)
+
+
+    def client_search(self, client_socket, data, username=None, group=None):
+        """
+        Search the history of the message board, or of a group the client is in, for the messages
+        containing every word of a query. The data field is {"query": <words>, "limit": <count>,
+        "offset": <hits to skip>}. The hits come best match first (BM25 over subject and message,
+        newest first on a tie), along with the offset of the next page (null on the last one) and
+        the total number of matches (exact is false if it was estimated, see BoardIndex).
+        """
+        try:
+            # Make sure the query is valid before looking anything up
+            try:
+                query, limit, offset = self.parse_search_request(data)
+            except ValueError as e:
+                self.respond(client_socket, "search", "FAIL", str(e))
+                return
+
+            # Check if the client is in the message board clients list
+            if not self.membership.is_member("public board", client_socket):
+                self.send_reply(client_socket, replies.SEARCH_NOT_ON_BOARD)
+                return
+
+            # Only members of a group can search it, the same check as for reading its messages
+            if group:
+                group = group.strip('"').strip().lower()
+            board = group if group else 'public board'
+            if group and not self.membership.is_member(board, client_socket):
+                self.send_reply(client_socket, replies.SEARCH_NOT_IN_GROUP)
+                return
+
+            # Rank through the board's index, only the messages on the page are read from the history
+            hits, total, exact = self.search.search(board, query, limit, offset)
+            results = []
+            for score, message_id in hits:
+                record = self.messages.get(board, message_id)
+                if record:
+                    results.append({**record, 'score': round(score, 3)})
+
+            end = offset + len(hits)
+            cursor = end if end < min(total, self.MAX_SEARCH_DEPTH) else None
+            self.respond(client_socket, "search", "OK", {'hits': results, 'next': cursor, 'total': total, 'exact': exact})
+
+        except Exception as e:
+            logger.error('Error when handling search request: %s', e)
+            self.send_reply(client_socket, replies.SEARCH_FAILED)
+
+
+    def parse_search_request(self, data):
+        """Parse a search request's data field, returns (query, limit, offset) or raises ValueError if it is malformed"""
+        query = data.get('query')
+        limit, offset = data.get('limit', self.SEARCH_RESULTS), data.get('offset', 0)
+        if (set(data) <= {'query', 'limit', 'offset'} and isinstance(query, str) and query.strip()
+                and isinstance(limit, int) and not isinstance(limit, bool) and limit > 0
+                and isinstance(offset, int) and not isinstance(offset, bool) and 0 <= offset < self.MAX_SEARCH_DEPTH):
+            return query, min(limit, self.MAX_SEARCH_RESULTS, self.MAX_SEARCH_DEPTH - offset), offset
+
+        raise ValueError(f'Invalid search request. Use {{"query": <words>, "limit": <count>, "offset": <hits to skip>}}'
+                         f' (offset below {self.MAX_SEARCH_DEPTH}).')
+
+
+    def client_history(self, client_socket, data, username=None, group=None):
+        """
+        Send a stretch of the history of the message board, or of a group the client is in. The data
+        field is {"since": ID} for every message posted after the given ID or {"from": ID, "to": ID}
+        for the messages in that range, optionally with "chunk": <messages per response>. The messages
+        are streamed oldest first in several responses to the same request, {"messages": [...], "next": ID}
+        where next is the last ID sent so far (null on the final response), see stream_history().
+        """
+        try:
+            # Make sure the requested range is valid before looking anything up
+            try:
+                start, end, chunk = self.parse_history_range(data)
+            except ValueError as e:
+                self.respond(client_socket, "history", "FAIL", str(e))
+                return
+
+            # Check if the client is in the message board clients list
+            if not self.membership.is_member("public board", client_socket):
+                self.send_reply(client_socket, replies.HISTORY_NOT_ON_BOARD)
+                return
+
+            # Only members of a group can read its history, the same check as for a single message
+            if group:
+                group = group.strip('"').strip().lower()
+            board = group if group else 'public board'
+            if group and not self.membership.is_member(board, client_socket):
+                self.send_reply(client_socket, replies.HISTORY_NOT_IN_GROUP)
+                return
+
+            # The stream stops at the newest message right now, later ones reach the client as notifications
+            count = self.messages.count(board)
+            end = count if end is None else min(end, count)
+
+            # Send the first chunk, the engine sends the rest as the client reads them
+            client_socket.stream = self.stream_history(client_socket, board, start, end, chunk)
+            self.advance_stream(client_socket)
+
+        except Exception as e:
+            logger.error('Error when handling history request: %s', e)
+            self.send_reply(client_socket, replies.HISTORY_FAILED)
+
+
+    def parse_history_range(self, data):
+        """
+        Parse a history request's data field, returns (first ID, last ID or None for the newest message,
+        messages per response) or raises ValueError if it is malformed
+        """
+        def valid(value, minimum):
+            return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+        chunk = data.get('chunk', self.HISTORY_CHUNK)
+        keys = set(data) - {'chunk'}
+        if valid(chunk, 1):
+            if keys == {'since'} and valid(data['since'], 0):
+                return data['since'] + 1, None, min(chunk, self.MAX_HISTORY)
+            if keys == {'from', 'to'} and valid(data['from'], 1) and valid(data['to'], data['from']):
+                return data['from'], data['to'], min(chunk, self.MAX_HISTORY)
+
+        raise ValueError('Invalid history request. Use {"since": <message id>} or {"from": <message id>, "to": <message id>},'
+                         ' optionally with "chunk": <messages per response>.')
+
+
+    def stream_history(self, client_socket, board, start, end, chunk):
+        """
+        Generator sending the messages of a board from start to end (inclusive), one response of up to
+        chunk messages each time it is advanced. Only the messages of the current chunk are read from
+        the history, so a long stretch costs as much memory as a short one.
+        """
+        try:
+            while True:
+                records = self.messages.range(board, start, min(start + chunk - 1, end))
+                last = records[-1]['id'] if records else end
+                self.respond(client_socket, "history", "OK", {'messages': records, 'next': last if last < end else None})
+                if last >= end:
+                    return
+                start = last + 1
+                yield
+
+                # The group may have been deleted while the client was reading the previous chunk
+                if not self.membership.is_member(board, client_socket):
+                    self.send_reply(client_socket, replies.HISTORY_NOT_IN_GROUP)
+                    return
+
+        except Exception as e:
+            logger.error('Error when streaming history: %s', e)
+            self.send_reply(client_socket, replies.HISTORY_FAILED)
+
+
+    def advance_stream(self, client_socket):
+        """Queue the next chunk of the client's streamed response, forgetting the stream once it is done (or the client is gone)"""
+        if client_socket.closed:
+            client_socket.stream = None
+            return
+        try:
+            next(client_socket.stream)
+        except StopIteration:
+            client_socket.stream = None
         
 
 if __name__ == "__main__":
-    server = BulletinBoardServer('', 6789)
+    # Allow the serving engine to be selected at startup
+    parser = argparse.ArgumentParser(description='Bulletin Board Server')
+    parser.add_argument('--host', default='',
+                        help='address to listen on (all interfaces by default)')
+    parser.add_argument('--port', type=int, default=6789,
+                        help='port to listen on')
+    parser.add_argument('--engine', choices=BulletinBoardServer.ENGINES, default='threaded',
+                        help='threaded: one thread per client, asyncio: single event loop for many idle clients')
+    parser.add_argument('--history-depth', type=int, default=BulletinBoardServer.HISTORY_DEPTH,
+                        help='number of past messages sent when a client joins a board without asking for a window')
+    parser.add_argument('--data-dir', default='board_data',
+                        help='directory the message history is persisted to')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='keep the message history in memory only (lost on restart)')
+    parser.add_argument('--slow-consumer-policy', choices=Session.POLICIES, default='disconnect',
+                        help='what to do with notifications for a client whose outbound queue is full')
+    parser.add_argument('--max-queue-bytes', type=int, default=Session.MAX_QUEUE_BYTES,
+                        help='size of the outbound queue of every client')
+    parser.add_argument('--writer-threads', type=int, default=WriterPool.WORKERS,
+                        help='threads writing to clients (threaded engine only)')
+    parser.add_argument('--log-level', choices=LEVELS, default='info',
+                        help='least severe log messages to show (debug also logs every connection)')
+    parser.add_argument('--admin-port', type=int,
+                        help='serve metrics for Prometheus at http://127.0.0.1:<port>/metrics (off by default)')
+    parser.add_argument('--profile-dir',
+                        help='enable the sampling profiler: SIGUSR1 starts and stops it and writes the report here, '
+                             'the admin endpoint also serves /profile?seconds=<n>')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port (SO_REUSEPORT), each with its own metrics on admin port + n')
+    parser.add_argument('--cluster', metavar='ADDRESS',
+                        help='join the cluster whose broker listens on host:port (or a Unix socket path), '
+                             'the history is then kept by the broker')
+    parser.add_argument('--broker', metavar='ADDRESS',
+                        help='only run the broker of a cluster, listening on host:port (or a Unix socket path)')
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+    data_dir = None if args.in_memory else args.data_dir
+    options = {'host': args.host, 'port': args.port, 'engine': args.engine, 'history_depth': args.history_depth,
+               'slow_consumer_policy': args.slow_consumer_policy, 'max_queue_bytes': args.max_queue_bytes,
+               'writer_threads': args.writer_threads}
+
+    # A cluster's broker and several workers are run by cluster.py
+    if args.broker:
+        from cluster import serve_broker
+        serve_broker(args.broker, data_dir)
+        raise SystemExit
+
+    if args.workers > 1:
+        from cluster import serve_workers
+        serve_workers(args.workers, options, data_dir, log_level=args.log_level,
+                      admin_port=args.admin_port, profile_dir=args.profile_dir, broker_address=args.cluster)
+        raise SystemExit
+
+    # A node of a cluster gets the history from the broker instead of keeping its own
+    server = BulletinBoardServer(**options, data_dir=None if args.cluster else data_dir, profile_dir=args.profile_dir)
+    if args.cluster:
+        from cluster import SocketBackplane
+        server.attach(SocketBackplane(args.cluster, server))
+
+    if args.admin_port is not None:
+        admin = MetricsEndpoint('127.0.0.1', args.admin_port)
+        if args.profile_dir:
+            admin.route('/profile', server.profile_report)
+        admin.start()
+
     server.run()
\ No newline at end of file
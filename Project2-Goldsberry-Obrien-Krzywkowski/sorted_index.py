@@ -0,0 +1,82 @@
+from bisect import bisect_left, bisect_right
+
+# Sorts after every character a name can contain, so prefix + LAST_CHARACTER bounds the names starting with prefix
+LAST_CHARACTER = '\U0010ffff'
+
+
+class SortedIndex:
+    """
+    Distinct names in sorted order, along with how many times each was added.
+
+    Backs the listings clients page through (the users of a board, the
+    groups): a page is found with two binary searches and copied out as a
+    slice, so producing it costs the same whether there are ten names or a
+    hundred thousand. Prefix filters and counts are binary searches too.
+    Adding a new name or removing the last copy of one shifts the list once.
+
+    The index has no lock of its own, its owner guards it.
+    """
+
+    def __init__(self):
+        """SortedIndex constructor"""
+        self.names = []
+        self.counts = {}
+
+    def __len__(self):
+        """Number of distinct names"""
+        return len(self.names)
+
+    def __contains__(self, name):
+        """Whether the name is in the index"""
+        return name in self.counts
+
+    def __iter__(self):
+        """Iterate over the names in sorted order"""
+        return iter(self.names)
+
+    def add(self, name, count=1):
+        """Add a name count times, returns True if it was not in the index before"""
+        previous = self.counts.get(name, 0)
+        self.counts[name] = previous + count
+        if previous:
+            return False
+        self.names.insert(bisect_left(self.names, name), name)
+        return True
+
+    def remove(self, name, count=1):
+        """Remove a name count times, returns True if that was its last copy and it left the index"""
+        remaining = self.counts.get(name, 0) - count
+        if remaining > 0:
+            self.counts[name] = remaining
+            return False
+        if self.counts.pop(name, None) is None:
+            return False
+        del self.names[bisect_left(self.names, name)]
+        return True
+
+    def clear(self):
+        """Remove every name"""
+        self.names = []
+        self.counts = {}
+
+    def bounds(self, prefix=''):
+        """Return the (start, end) positions of the names starting with prefix"""
+        if not prefix:
+            return 0, len(self.names)
+        return bisect_left(self.names, prefix), bisect_left(self.names, prefix + LAST_CHARACTER)
+
+    def count(self, prefix=''):
+        """Number of distinct names starting with prefix"""
+        start, end = self.bounds(prefix)
+        return end - start
+
+    def page(self, after=None, limit=50, prefix=''):
+        """
+        Return (names, next) for up to limit names starting with prefix that sort after the given
+        name. next is the name to continue after, or None if this is the last page.
+        """
+        start, end = self.bounds(prefix)
+        if after:
+            start = max(start, bisect_right(self.names, after))
+        names = self.names[start:min(start + limit, end)]
+        return names, names[-1] if start + limit < end and names else None
@@ -0,0 +1,166 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import message_log
+from message_log import MessageLog
+from protocol import JSON, FrameBuffer
+from server import BulletinBoardServer
+
+
+def free_port():
+    """Return a port nothing is listening on"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class Client:
+    """Bare JSON client that keeps the notifications it reads while waiting for a response"""
+
+    def __init__(self, port, username):
+        """Client constructor, connecting to the server"""
+        self.username = username
+        self.socket = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.buffer = FrameBuffer()
+        self.request_id = 0
+        self.notifications = []
+
+    def call(self, command, **fields):
+        """Send a request and return (status, data) of its response"""
+        self.request_id += 1
+        self.socket.sendall(JSON.encode_request(command, self.username, request_id=self.request_id, **fields))
+        while True:
+            for frame in self.buffer.frames():
+                message = JSON.decode(frame)
+                header = message['header']
+                if header.get('status'):
+                    return header['status'], message['body']['data']
+                self.notifications.append((header.get('group'), header.get('sequence'), message['body']['data']))
+            if not self.buffer.read_from(self.socket):
+                raise ConnectionError('Server closed the connection')
+
+    def seen(self):
+        """The last notification number received on each board"""
+        return [[board, sequence] for board, sequence, _ in self.notifications if sequence is not None]
+
+    def close(self):
+        """Close the connection"""
+        self.socket.close()
+
+
+@pytest.fixture
+def server(tmp_path):
+    """A server persisting its history to a temporary directory"""
+    server = BulletinBoardServer('127.0.0.1', free_port(), data_dir=str(tmp_path))
+    server.start()
+    deadline = time.time() + 5
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', server.port), timeout=1).close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    yield server
+    server.running = False
+    server.join(timeout=5)
+
+
+def connect(server, username, **options):
+    """Connect a client and join the public board, returning it and its session token"""
+    client = Client(server.port, username)
+    status, data = client.call('connect', data={'encoding': 'json', **options})
+    assert status == 'OK'
+    client.call('join')
+    return client, data['session']
+
+
+def test_torn_record_is_truncated_on_reopen(tmp_path):
+    log = MessageLog(str(tmp_path))
+    for message_id in range(1, 4):
+        log.wait(log.append('board', {'id': message_id, 'message': f'message {message_id}'}))
+    log.close()
+
+    # A crash in the middle of writing the fourth message leaves half a record at the end of the segment
+    directory = os.path.join(str(tmp_path), 'board')
+    segment = os.path.join(directory, next(entry for entry in os.listdir(directory) if entry.endswith('.log')))
+    intact = os.path.getsize(segment)
+    with open(segment, 'ab') as torn:
+        torn.write(b'{"id": 4, "mess')
+
+    log = MessageLog(str(tmp_path))
+    board = log.open('board')
+    assert board.count == 3
+    assert os.path.getsize(segment) == intact
+    assert [record['id'] for record in board.read_range(1, 3)] == [1, 2, 3]
+
+    # New messages go after the last complete one
+    log.wait(log.append('board', {'id': 4, 'message': 'message 4'}))
+    assert board.read(4) == {'id': 4, 'message': 'message 4'}
+    log.close()
+
+
+def test_post_is_acknowledged_only_after_its_batch_is_synced(server, monkeypatch):
+    synced = threading.Event()
+    sync = message_log.BoardLog.sync
+
+    def gated_sync(self):
+        if self.dirty:
+            synced.wait(5)
+        sync(self)
+
+    monkeypatch.setattr(message_log.BoardLog, 'sync', gated_sync)
+    client, _ = connect(server, 'alice')
+
+    responses = []
+    poster = threading.Thread(target=lambda: responses.append(client.call('post', data='subject\nbody')))
+    poster.start()
+    poster.join(0.5)
+    assert poster.is_alive() and not responses
+
+    synced.set()
+    poster.join(5)
+    assert responses == [('OK', responses[0][1])]
+    client.close()
+
+
+def test_post_that_can_not_be_synced_is_not_acknowledged(server, monkeypatch):
+    def failing_sync(self):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(message_log.BoardLog, 'sync', failing_sync)
+    client, _ = connect(server, 'alice')
+    assert client.call('post', data='subject\nbody')[0] == 'FAIL'
+    client.close()
+
+
+def test_resume_replays_what_came_after_the_last_seen_notification(server):
+    alice, token = connect(server, 'alice')
+    bob, _ = connect(server, 'bob')
+
+    bob.call('post', data='seen\nalice reads this one')
+    alice.call('users')
+    assert any('Subject: seen' in data for _, _, data in alice.notifications)
+
+    # Alice's connection drops without her reading any of these
+    for number in range(3):
+        bob.call('post', data=f'missed {number}\nbody')
+    alice.close()
+
+    resumed = Client(server.port, 'alice')
+    status, data = resumed.call('connect', data={'encoding': 'json', 'resume': token, 'seen': alice.seen()})
+    assert status == 'OK' and data['resumed'] == ['public board']
+    resumed.call('users')
+
+    replayed = [data for board, _, data in resumed.notifications if board == 'public board']
+    assert [data.split('Subject: ')[1].split('\\n')[0] for data in replayed] == ['missed 0', 'missed 1', 'missed 2']
+    numbers = [sequence for board, sequence, _ in resumed.notifications if board == 'public board']
+    last_seen = dict(map(tuple, alice.seen()))['public board']
+    assert numbers == [last_seen + 1, last_seen + 2, last_seen + 3]
+    resumed.close()
+    bob.close()